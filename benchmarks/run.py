@@ -0,0 +1,368 @@
+# -*- coding: utf-8 -*-
+"""
+Run the pipeline stages on a synthetic working directory and time them.
+
+Make the working directory with benchmarks/synthetic.py first. The stages
+run in pipeline order, each one on the outputs of the previous ones, and
+the timings are written to a JSON report:
+
+    {
+        "machine": {...},
+        "config": {... contents of bench.json ...},
+        "stages": [
+            {"name": "read_eurostat", "status": "ok", "seconds": [1.2],
+             "best": 1.2, "max_rss_mb": 95.1, "items": 5},
+            ...
+        ]
+    }
+
+A failing stage is reported with status "error" and the error message, and
+the later stages are still run (but may fail for lack of inputs).
+
+Each stage runs in a forked child process, so that max_rss_mb is the peak
+of that stage (including the memory of the runner when it forked) rather
+than of all stages so far. The state passed between stages is sent back
+from the child. Without fork (e.g., Windows), the stages run in the
+runner process and max_rss_mb is not reported.
+"""
+
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import sys
+import time
+import traceback
+
+import click
+
+try:
+    import resource
+except ImportError: # Not available on Windows
+    resource = None
+
+SAMPLING = 'bench'
+DENSITIES = ('glw_cattle', 'glw_pigs', 'glw_chickens', 'cropland')
+EUROSTAT_TABLES = (
+    'agr_r_animal', 'agr_r_crops', 'apro_cpp_crop', 'ef_olsaareg',
+    'ef_oluaareg')
+
+
+def max_rss_mb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kB on Linux, bytes on macOS
+    return rss / (1024 ** 2 if sys.platform == 'darwin' else 1024)
+
+
+def invoke(group, name, *args):
+    """Run a command of a click group, as from the command line."""
+    if name not in group.commands:
+        name = name.replace('_', '-') # Command names in click >= 7
+    group.main(args=[name] + list(args), standalone_mode=False)
+
+
+class Stages(object):
+    """
+    The benchmarked stages.
+
+    Each stage is a method returning the number of items it processed
+    (e.g., files, samples or LP rows), for throughput.
+    """
+    def __init__(self):
+        super(Stages, self).__init__()
+        self.substrates = None
+        self.production = None
+
+    def read_eurostat(self):
+        import biogasrm.prep_data as prep_data
+        os.makedirs('outdata/eurostat', exist_ok=True)
+        for table in EUROSTAT_TABLES:
+            invoke(
+                prep_data.cli, 'read_eurostat',
+                'indata/Eurostat/{}.tsv'.format(table),
+                'outdata/eurostat/{}.pkl'.format(table))
+        return len(EUROSTAT_TABLES)
+
+    def animal_pop(self):
+        import biogasrm.prep_data as prep_data
+        invoke(
+            prep_data.cli, 'animal_pop',
+            'outdata/eurostat/ef_olsaareg.pkl', 'outdata/animal_pop.pkl')
+        return 1
+
+    def manure_mgmt(self):
+        import biogasrm.prep_data as prep_data
+        invoke(
+            prep_data.cli, 'manure_mgmt',
+            'indata/NIRs', 'outdata/manure_mgmt.pkl')
+        return len(os.listdir('indata/NIRs'))
+
+    def cropland(self):
+        import biogasrm.prep_data as prep_data
+        invoke(
+            prep_data.cli, 'cropland',
+            'outdata/clc.tif', 'outdata/cropland.tif')
+        import rasterio
+        with rasterio.open('outdata/cropland.tif') as src:
+            return src.width * src.height
+
+    def coverage(self):
+        import biogasrm.prep_data as prep_data
+        os.makedirs('outdata/coverage', exist_ok=True)
+        for density in DENSITIES:
+            invoke(
+                prep_data.cli, 'coverage',
+                'outdata/{}.tif'.format(density),
+                'outdata/included_NUTS.geojson',
+                '--key-property', 'NUTS_ID',
+                '--output', 'outdata/coverage/{}.json'.format(density))
+        return len(DENSITIES)
+
+    def regional_sums(self):
+        import biogasrm.prep_data as prep_data
+        os.makedirs('outdata/regional_sums', exist_ok=True)
+        for density in DENSITIES:
+            invoke(
+                prep_data.cli, 'regional_sums',
+                'outdata/{}.tif'.format(density),
+                'outdata/included_NUTS.geojson',
+                '--output', 'outdata/regional_sums/{}.json'.format(density))
+        return len(DENSITIES)
+
+    # Directories written by a stage, removed before each run of it so that
+    # repeats do not run on the outputs of the previous repeat
+    OUTPUTS = {
+        'disks': 'outdata/sampling/{}'.format(SAMPLING),
+        'fused_sampling': 'outdata/sampling/{}-fused'.format(SAMPLING),
+    }
+
+    def clean(self, name):
+        path = self.OUTPUTS.get(name)
+        if path is not None and os.path.exists(path):
+            shutil.rmtree(path)
+
+    def disks(self):
+        import biogasrm.sample as sample
+        with open('sampling-settings/{}'.format(SAMPLING)) as f:
+            settings = f.read().split()
+        path = 'outdata/sampling/{}/samples.shp'.format(SAMPLING)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        invoke(
+            sample.cli, 'disks',
+            'outdata/included_NUTS.geojson', path, *settings)
+        import fiona
+        with fiona.open(path) as src:
+            return len(src)
+
+    def sample_region_fracs(self):
+        import biogasrm.sample as sample
+        for density in DENSITIES:
+            invoke(
+                sample.cli, 'sample_region_fracs',
+                'outdata/sampling/{}/samples.shp'.format(SAMPLING),
+                'outdata/{}.tif'.format(density),
+                'outdata/regional_sums/{}.json'.format(density),
+                'outdata/sampling/{}/{}_fracs.pkl'.format(SAMPLING, density))
+        import fiona
+        with fiona.open(
+                'outdata/sampling/{}/samples.shp'.format(SAMPLING)) as src:
+            return len(src) * len(DENSITIES)
+
+    def fused_sampling(self):
+        import biogasrm.sample as sample
+        with open('sampling-settings/{}'.format(SAMPLING)) as f:
+            settings = f.read().split()
+        for density in DENSITIES:
+            settings += [
+                '--density', 'outdata/{}.tif'.format(density),
+                'outdata/regional_sums/{}.json'.format(density)]
+        invoke(
+            sample.cli, 'run', 'outdata/included_NUTS.geojson',
+            'outdata/sampling/{}-fused'.format(SAMPLING), *settings)
+        import pandas
+        sums = pandas.read_pickle(
+            'outdata/sampling/{}-fused/sums.pkl'.format(SAMPLING))
+        return len(sums) * len(DENSITIES)
+
+    def get_sample_substrates(self):
+        import biogasrm.results as results
+        import biogasrm.parameters as parameters
+        self.substrates = results.get_sample_substrates(
+            SAMPLING, parameters.defaults())
+        return len(self.substrates)
+
+    def maximize_prod(self):
+        import biogasrm.results as results
+        import biogasrm.parameters as parameters
+        params = parameters.defaults()
+        radii = self.substrates.index.get_level_values('r')
+        radius = params['RADIUS'] if params['RADIUS'] in radii else radii[0]
+        substrates = self.substrates.xs(radius, level='r')
+        utilized = results.maximize_prod(substrates, params)
+        self.production = results.biogas_prod(utilized, params)
+        return len(substrates)
+
+    def make_raster_array(self):
+        import biogasrm.spatial_util as spatial_util
+        import biogasrm.results as results
+        settings = results.read_sampling_settings(SAMPLING)
+        spatial_util.make_raster_array(
+            self.production.to_dict(), settings['step'] * 1000, nodata=-1,
+            lattice=settings['lattice'])
+        return len(self.production)
+
+    ORDER = (
+        'read_eurostat', 'animal_pop', 'manure_mgmt', 'cropland', 'coverage',
+        'regional_sums', 'disks', 'sample_region_fracs', 'fused_sampling',
+        'get_sample_substrates', 'maximize_prod', 'make_raster_array')
+
+
+def _run_stage(stages, name, runs):
+    """Run a stage, returning its report entry without name."""
+    result = {'seconds': []}
+    try:
+        for i in range(runs):
+            stages.clean(name)
+            start = time.perf_counter()
+            items = getattr(stages, name)()
+            result['seconds'].append(time.perf_counter() - start)
+        result.update(
+            status='ok',
+            best=min(result['seconds']),
+            items=items,
+            items_per_second=items / min(result['seconds']))
+    except Exception as e:
+        traceback.print_exc()
+        result.update(status='error', error='{}: {}'.format(
+            type(e).__name__, e))
+    return result
+
+
+def _run_stage_child(stages, name, runs, connection):
+    result = _run_stage(stages, name, runs)
+    result['max_rss_mb'] = max_rss_mb()
+    connection.send((result, stages.__dict__))
+    connection.close()
+
+
+def run_stage(stages, name, runs):
+    """
+    Run a stage in a forked child process, if possible.
+
+    The state of stages is updated from the child, and the report entry
+    has the peak RSS of the child as max_rss_mb.
+    """
+    if resource is None or 'fork' not in multiprocessing.get_all_start_methods():
+        result = _run_stage(stages, name, runs)
+        result['max_rss_mb'] = None
+        return result
+
+    context = multiprocessing.get_context('fork')
+    receiver, sender = context.Pipe(duplex=False)
+    child = context.Process(
+        target=_run_stage_child, args=(stages, name, runs, sender))
+    child.start()
+    sender.close()
+    try:
+        result, state = receiver.recv()
+    except EOFError:
+        result, state = {
+            'seconds': [], 'status': 'error', 'max_rss_mb': None,
+            'error': 'stage process exited with code {}'.format(
+                child.exitcode)}, {}
+    child.join()
+    if child.exitcode and result['status'] == 'ok':
+        result.update(status='error', error='stage process exited with '
+                      'code {}'.format(child.exitcode))
+    stages.__dict__.update(state)
+    return result
+
+
+def compare(report, baseline, threshold):
+    """
+    Compare the best times with a baseline report.
+
+    Returns: A list of (stage, baseline seconds, seconds) for the stages
+        which are slower than threshold times the baseline.
+    """
+    old = {s['name']: s for s in baseline['stages'] if s['status'] == 'ok'}
+    slower = []
+    for stage in report['stages']:
+        if stage['status'] != 'ok' or stage['name'] not in old:
+            continue
+        before = old[stage['name']]['best']
+        if stage['best'] > threshold * before:
+            slower.append((stage['name'], before, stage['best']))
+    return slower
+
+
+@click.command()
+@click.argument('workdir', type=click.Path(exists=True, file_okay=False))
+@click.option('--output', '-o', type=click.File('w', lazy=False),
+              default='-',
+              help='Where to write the report (JSON). Default stdout.')
+@click.option('--repeat', '-n', type=int, default=1,
+              help='Number of times to run each stage. Default 1.')
+@click.option('--stage', '-s', 'only', multiple=True,
+              type=click.Choice(Stages.ORDER),
+              help='Only report these stages (all stages still run once).')
+@click.option('--baseline', type=click.File('r'), default=None,
+              help='A previous report to compare with.')
+@click.option('--threshold', type=float, default=1.2,
+              help='Slowdown relative to the baseline which counts as a '
+                   'regression. Default 1.2.')
+@click.option('--memory-budget', type=float, default=None,
+              help='Memory budget (MB) for the raster processing.')
+def cli(workdir, output, repeat, only, baseline, threshold, memory_budget):
+    """Benchmark the pipeline in WORKDIR (see benchmarks/synthetic.py)."""
+
+    # biogasrm reads its inputs relative to the working directory
+    os.chdir(workdir)
+    with open('bench.json') as f:
+        config = json.load(f)
+
+    if memory_budget is not None:
+        # Read by the commands' --memory-budget options
+        from biogasrm.raster_options import MEMORY_BUDGET_ENV_VAR
+        os.environ[MEMORY_BUDGET_ENV_VAR] = str(memory_budget)
+        config['memory_budget'] = memory_budget
+
+    import numpy
+    import pandas
+    report = {
+        'machine': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'numpy': numpy.__version__,
+            'pandas': pandas.__version__,
+        },
+        'config': config,
+        'stages': [],
+    }
+
+    stages = Stages()
+    for name in Stages.ORDER:
+        runs = repeat if not only or name in only else 1
+        result = dict(name=name, **run_stage(stages, name, runs))
+        if not only or name in only:
+            report['stages'].append(result)
+        click.echo('{:24s} {}'.format(name, result.get(
+            'best', result.get('error'))), err=True)
+
+    json.dump(report, output, indent=2)
+
+    if baseline is not None:
+        slower = compare(report, json.load(baseline), threshold)
+        for name, before, after in slower:
+            click.echo('{}: {:.3f} s -> {:.3f} s'.format(
+                name, before, after), err=True)
+        if slower:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    cli()
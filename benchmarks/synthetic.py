@@ -0,0 +1,479 @@
+# -*- coding: utf-8 -*-
+"""
+Generate a synthetic working directory for benchmarks.
+
+The result has the layout of the real working directory after the
+"preparations" stage, except that the outputs of the benchmarked stages
+(Eurostat pickles, manure_mgmt.pkl, cropland.tif, etc.) are left to the
+benchmark runner. All data are random but have the same formats as the
+licensed inputs:
+
+    outdata/NUTS_2010.xls               NUTS codes and labels
+    outdata/included_NUTS.geojson       Region polygons (EPSG:3035)
+    outdata/clc.tif                     CLC-like land cover classes
+    outdata/glw_{cattle,pigs,chickens}.tif
+                                        Livestock density rasters
+    indata/Eurostat/*.tsv               Eurostat tables
+    indata/NIRs/XXX-2014-YYYY-v1.1.xls  CRF-like workbooks
+    sampling-settings/bench             Sampling settings
+
+The workbooks are written in the xlsx format (with the .xls file names that
+the pipeline expects), using only the standard library.
+"""
+
+import json
+import math
+import os
+import zipfile
+from collections import OrderedDict
+from xml.sax.saxutils import escape
+
+import click
+import numpy as np
+import fiona
+import rasterio
+import rasterio.transform
+
+# NUTS0 codes of the generated countries, in order. Malta is excluded from
+# the results, and Spain's manure management is replaced by Portugal's.
+COUNTRIES = (
+    ('AUT', 'AT'), ('BEL', 'BE'), ('BGR', 'BG'), ('CYP', 'CY'), ('CZE', 'CZ'),
+    ('DEU', 'DE'), ('DNK', 'DK'), ('EST', 'EE'), ('GRC', 'EL'), ('FIN', 'FI'),
+    ('FRA', 'FR'), ('HRV', 'HR'), ('HUN', 'HU'), ('IRL', 'IE'), ('ITA', 'IT'),
+    ('LTU', 'LT'), ('LUX', 'LU'), ('LVA', 'LV'), ('NLD', 'NL'), ('POL', 'PL'),
+    ('PRT', 'PT'), ('ROU', 'RO'), ('SWE', 'SE'), ('SVN', 'SI'), ('SVK', 'SK'),
+    ('GBR', 'UK'))
+
+# Region code characters below each NUTS level.
+CODE_CHARS = '123456789ABCDEFGHJKLMNPQRSTUVWXYZ'
+
+YEARS = [2012, 2011, 2010, 2009, 2008]
+
+EF_OLSAAREG_VARIABLES = (
+    'C_2_1_HEADS', 'C_2_2_HEADS', 'C_2_3_HEADS', 'C_2_4_HEADS', 'C_2_5_HEADS',
+    'C_2_99_HEADS', 'C_2_6_HEADS', 'C_3_1_HEADS', 'C_4_2_HEADS',
+    'C_4_99_HEADS', 'C_5_1_1000_HEADS', 'C_5_2_1000_HEADS')
+
+EF_OLUAAREG_VARIABLES = (
+    'B_1_1_1_HA', 'B_1_1_2_HA', 'B_1_1_3_HA', 'B_1_1_4_HA', 'B_1_1_5_HA',
+    'B_1_1_6_HA', 'B_1_4_HA', 'B_1_6_4_HA', 'B_1_6_5_HA')
+
+CROPS = (
+    'C1120', 'C1130', 'C1140', 'C1150', 'C1160', 'C1180', 'C1200', 'C1201',
+    'C1370', 'C1420', 'C1450')
+
+ANIMALS = ('A2010', 'A2300F', 'A2300G', 'A3100', 'A3120', 'A4100', 'A5110O')
+
+# CRF Table4.B(a)s2: 13 animal categories x 3 climate regions x 2
+# indicators = the 78 data rows read by prep_data._CRF_4Bas2().
+CRF_ANIMALS = (
+    'Dairy Cattle', 'Non-Dairy Cattle', 'Sheep', 'Swine', 'Buffalo',
+    'Camels', 'Deer', 'Goats', 'Horses', 'Mules and Asses', 'Poultry',
+    'Rabbit', 'Other')
+CRF_CLIMATES = ('Cool', 'Temperate', 'Warm')
+CRF_SYSTEMS = (
+    'Anaerobic lagoon', 'Liquid system', 'Daily spread', 'Solid storage',
+    'Dry lot', 'Pasture range paddock', 'Other')
+
+# Corine Land Cover classes (1-44), with crop land in 12-22
+CLC_CLASSES = np.arange(1, 45)
+
+# Not a round number, so that disks are not tangent to region borders
+ORIGIN = (3001234.5, 2002345.5)
+CRS = {'init': 'epsg:3035'}
+
+
+def nuts_codes(countries, regions):
+    """
+    Make a NUTS hierarchy.
+
+    Each country has 2 level 1 regions, each with `regions` level 2
+    regions, each with 2 level 3 regions.
+
+    Returns: An OrderedDict of {country: {level 1 code: [level 2 codes]}}.
+    """
+    if regions > len(CODE_CHARS):
+        raise ValueError(
+            'at most {} regions per level 1 region'.format(len(CODE_CHARS)))
+    result = OrderedDict()
+    for iso, nuts0 in countries:
+        result[nuts0] = OrderedDict(
+            (nuts0 + CODE_CHARS[i],
+             [nuts0 + CODE_CHARS[i] + CODE_CHARS[j] for j in range(regions)])
+            for i in range(2))
+    return result
+
+
+def all_codes(hierarchy, max_level=3):
+    codes = []
+    for country, level1 in hierarchy.items():
+        codes.append(country)
+        for code1, level2 in level1.items():
+            codes.append(code1)
+            for code2 in level2:
+                codes.append(code2)
+                if max_level >= 3:
+                    codes.extend(code2 + c for c in CODE_CHARS[:2])
+    return codes
+
+
+def write_xlsx(path, sheets):
+    """
+    Write a minimal xlsx workbook.
+
+    Args:
+        path: The path to write to.
+        sheets: OrderedDict of sheet names and lists of rows. Each row is a
+            list of cell values (str, number or None).
+    """
+
+    def column_name(i):
+        name = ''
+        i += 1
+        while i:
+            i, rem = divmod(i - 1, 26)
+            name = chr(65 + rem) + name
+        return name
+
+    def sheet_xml(rows):
+        parts = []
+        for r, row in enumerate(rows, 1):
+            cells = []
+            for c, value in enumerate(row):
+                ref = '{}{}'.format(column_name(c), r)
+                if value is None:
+                    continue
+                if isinstance(value, str):
+                    cells.append(
+                        '<c r="{}" t="inlineStr"><is><t>{}</t></is></c>'
+                        .format(ref, escape(value)))
+                else:
+                    cells.append('<c r="{}"><v>{!r}</v></c>'.format(
+                        ref, float(value)))
+            parts.append('<row r="{}">{}</row>'.format(r, ''.join(cells)))
+        return (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<worksheet xmlns="http://schemas.openxmlformats.org/'
+            'spreadsheetml/2006/main"><sheetData>{}</sheetData></worksheet>'
+            .format(''.join(parts)))
+
+    ns = 'http://schemas.openxmlformats.org'
+    names = list(sheets)
+    content_types = (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="{ns}/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/'
+        'vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" ContentType="application/'
+        'vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '{sheets}</Types>').format(ns=ns, sheets=''.join(
+            '<Override PartName="/xl/worksheets/sheet{}.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.'
+            'spreadsheetml.worksheet+xml"/>'.format(i)
+            for i in range(1, len(names) + 1)))
+    rels = (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="{ns}/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="{ns}/officeDocument/2006/'
+        'relationships/officeDocument" Target="xl/workbook.xml"/>'
+        '</Relationships>').format(ns=ns)
+    workbook = (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<workbook xmlns="{ns}/spreadsheetml/2006/main" '
+        'xmlns:r="{ns}/officeDocument/2006/relationships"><sheets>{sheets}'
+        '</sheets></workbook>').format(ns=ns, sheets=''.join(
+            '<sheet name="{}" sheetId="{}" r:id="rId{}"/>'.format(
+                escape(name), i, i)
+            for i, name in enumerate(names, 1)))
+    workbook_rels = (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="{ns}/package/2006/relationships">{rels}'
+        '</Relationships>').format(ns=ns, rels=''.join(
+            '<Relationship Id="rId{i}" Type="{ns}/officeDocument/2006/'
+            'relationships/worksheet" Target="worksheets/sheet{i}.xml"/>'
+            .format(i=i, ns=ns)
+            for i in range(1, len(names) + 1)))
+
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as z:
+        z.writestr('[Content_Types].xml', content_types)
+        z.writestr('_rels/.rels', rels)
+        z.writestr('xl/workbook.xml', workbook)
+        z.writestr('xl/_rels/workbook.xml.rels', workbook_rels)
+        for i, name in enumerate(names, 1):
+            z.writestr(
+                'xl/worksheets/sheet{}.xml'.format(i), sheet_xml(sheets[name]))
+
+
+def write_nuts_xls(path, hierarchy):
+    rows = [['NUTS CODE', 'NUTS LABEL']]
+    rows.extend([code, 'Region {}'.format(code)]
+                for code in all_codes(hierarchy))
+    write_xlsx(path, OrderedDict([('NUTS2010', rows)]))
+
+
+def region_polygons(hierarchy, country_size):
+    """
+    Lay out countries on a square grid and split them into regions.
+
+    Level 1 regions are vertical strips of the country, and level 2 regions
+    horizontal pieces of the strips.
+
+    Yields: (NUTS code, level, polygon coordinates)
+    """
+    per_row = int(math.ceil(math.sqrt(len(hierarchy))))
+    for k, (country, level1) in enumerate(hierarchy.items()):
+        x0 = ORIGIN[0] + (k % per_row) * country_size
+        y0 = ORIGIN[1] + (k // per_row) * country_size
+        width = country_size / len(level1)
+        for i, (code1, level2) in enumerate(level1.items()):
+            left = x0 + i * width
+            yield code1, 1, _box(left, y0, left + width, y0 + country_size)
+            height = country_size / len(level2)
+            for j, code2 in enumerate(level2):
+                bottom = y0 + j * height
+                yield code2, 2, _box(left, bottom, left + width, bottom + height)
+
+
+def _box(xmin, ymin, xmax, ymax):
+    return [[(xmin, ymin), (xmax, ymin), (xmax, ymax), (xmin, ymax),
+             (xmin, ymin)]]
+
+
+def write_regions(path, hierarchy, country_size):
+    schema = {'geometry': 'Polygon', 'properties': OrderedDict(
+        [('NUTS_ID', 'str'), ('STAT_LEVL_', 'int')])}
+    if os.path.exists(path):
+        os.remove(path)
+    with fiona.open(path, 'w', driver='GeoJSON', crs=CRS,
+                    schema=schema) as dst:
+        for code, level, coords in region_polygons(hierarchy, country_size):
+            # Germany is included at NUTS 1, the others at NUTS 2
+            if level != (1 if code.startswith('DE') else 2):
+                continue
+            dst.write({
+                'geometry': {'type': 'Polygon', 'coordinates': coords},
+                'properties': {'NUTS_ID': code, 'STAT_LEVL_': level}})
+
+
+# Rows of the rasters generated at a time, so that high resolution grids
+# (e.g., 100 m) can be generated without holding the rasters in memory
+BAND_ROWS = 256
+
+
+def _grid(n_countries, country_size, resolution):
+    """The raster profile for a resolution, covering all countries."""
+    per_row = int(math.ceil(math.sqrt(n_countries)))
+    n_rows = int(math.ceil(n_countries / per_row))
+    return dict(
+        driver='GTiff', count=1, crs=CRS, tiled=True, compress='deflate',
+        width=int(round(per_row * country_size / resolution)),
+        height=int(round(n_rows * country_size / resolution)),
+        transform=rasterio.transform.from_origin(
+            ORIGIN[0], ORIGIN[1] + n_rows * country_size,
+            resolution, resolution))
+
+
+def _coarse_index(start, stop, resolution):
+    """Indices of the 20 km cells containing a range of pixel centers."""
+    return ((np.arange(start, stop) + 0.5) * resolution // 20000).astype(int)
+
+
+def write_rasters(outdata, rs, n_countries, country_size, resolution,
+                  livestock_resolution=None):
+    """
+    Write clc.tif and the glw_*.tif rasters, band of rows by band of rows.
+
+    The land cover classes and animal densities vary on the scale of 20 km,
+    with pixel level noise. The livestock rasters have the same extent as
+    clc.tif, but may have another resolution.
+
+    Returns:
+        The number of pixels of clc.tif.
+    """
+    if livestock_resolution is None:
+        livestock_resolution = resolution
+    profile = _grid(n_countries, country_size, resolution)
+    livestock_profile = _grid(n_countries, country_size, livestock_resolution)
+
+    coarse_shape = tuple(
+        int(math.ceil(profile[key] * resolution / 20000)) + 1
+        for key in ('height', 'width'))
+    clc_coarse = rs.choice(CLC_CLASSES, size=coarse_shape)
+    animals = (('cattle', 50), ('pigs', 80), ('chickens', 500))
+    density_coarse = {
+        animal: scale * rs.lognormal(0, 1, coarse_shape)
+        for animal, scale in animals}
+
+    rasters = [('clc', profile, dict(dtype='uint8', nodata=0))] + [
+        ('glw_{}'.format(animal), livestock_profile,
+         dict(dtype='float32', nodata=-1))
+        for animal, _ in animals]
+    for name, grid, options in rasters:
+        width, height = grid['width'], grid['height']
+        res = grid['transform'].a
+        path = os.path.join(outdata, '{}.tif'.format(name))
+        with rasterio.open(path, 'w', **dict(grid, **options)) as dst:
+            cols = _coarse_index(0, width, res)
+            for row in range(0, height, BAND_ROWS):
+                window = ((row, min(row + BAND_ROWS, height)), (0, width))
+                coarse = np.ix_(_coarse_index(*window[0], resolution=res), cols)
+                if name == 'clc':
+                    data = clc_coarse[coarse]
+                    noise = rs.randint(0, 4, data.shape) == 0
+                    data[noise] = rs.choice(CLC_CLASSES, noise.sum())
+                else:
+                    data = density_coarse[name[len('glw_'):]][coarse]
+                    data = data * rs.uniform(0.5, 1.5, data.shape)
+                dst.write(data.astype(options['dtype']), 1, window=window)
+
+    return profile['width'] * profile['height']
+
+
+def _eurostat_value(rs, missing):
+    # Values are followed by a space and an optional flag, e.g. "12.5 p"
+    if rs.uniform() < missing:
+        return ': '
+    flag = rs.choice(['', '', '', 'p', 'e'])
+    return '{:.1f} {}'.format(rs.lognormal(8, 1.5), flag)
+
+
+def write_eurostat(path, level_names, rows, rs, missing=0.05):
+    """
+    Write a table in the Eurostat bulk download TSV format.
+
+    Args:
+        level_names: Names of the row index levels, e.g. ['unit', 'geo'].
+        rows: Iterable of tuples with the row index labels.
+    """
+    with open(path, 'w') as f:
+        f.write('{}\\time\t{}\n'.format(
+            ','.join(level_names), '\t'.join('{} '.format(y) for y in YEARS)))
+        for labels in rows:
+            values = [_eurostat_value(rs, missing) for y in YEARS]
+            f.write('{}\t{}\n'.format(','.join(labels), '\t'.join(values)))
+
+
+def write_crf(path, rs):
+    """Write a CRF-like workbook with Table4.B(a)s2 (manure management)."""
+    rows = [[None] * 10 for i in range(87)]
+    rows[0][0] = 'TABLE 4.B(a)s2 (synthetic)'
+    rows[5][0:3] = ['Animal category', 'Climate region', 'Indicator']
+    rows[6][3:10] = list(CRF_SYSTEMS)
+
+    rownum = 9
+    for animal in CRF_ANIMALS:
+        # Allocation in percent over climate regions and systems sums to 100
+        allocation = rs.dirichlet(
+            np.ones(len(CRF_CLIMATES) * len(CRF_SYSTEMS)))
+        allocation = 100 * allocation.reshape(len(CRF_CLIMATES), -1)
+        for c, climate in enumerate(CRF_CLIMATES):
+            for indicator in ('Allocation (%)', 'MCF (c)'):
+                row = rows[rownum]
+                # Like the CRF tables, repeated labels are left blank
+                if c == 0 and indicator.startswith('Allocation'):
+                    row[0] = animal
+                if indicator.startswith('Allocation'):
+                    row[1] = climate
+                row[2] = indicator
+                if indicator.startswith('Allocation'):
+                    row[3:10] = list(allocation[c])
+                else:
+                    row[3:10] = list(rs.uniform(0, 80, len(CRF_SYSTEMS)))
+                rownum += 1
+
+    write_xlsx(path, OrderedDict([('Table4.B(a)s2', rows)]))
+
+
+@click.command()
+@click.argument('workdir', type=click.Path())
+@click.option('--countries', type=click.IntRange(1, len(COUNTRIES)),
+              default=4, help='Number of countries. Default 4.')
+@click.option('--regions', type=int, default=4,
+              help='NUTS 2 regions per NUTS 1 region. Default 4.')
+@click.option('--country-size', type=float, default=200,
+              help='Side of each (square) country in km. Default 200.')
+@click.option('--resolution', type=float, default=1000,
+              help='Raster pixel size in m. Default 1000.')
+@click.option('--livestock-resolution', type=float, default=None,
+              help='Pixel size in m of the livestock rasters. Default '
+                   'the same as --resolution.')
+@click.option('--step', type=float, default=20,
+              help='Sampling step in km. Default 20.')
+@click.option('--radii', type=str, default='15,25',
+              help='Sampling radii in km. Default "15,25".')
+@click.option('--seed', type=int, default=0)
+def cli(workdir, countries, regions, country_size, resolution,
+        livestock_resolution, step, radii, seed):
+    """Generate a synthetic working directory in WORKDIR."""
+
+    rs = np.random.RandomState(seed)
+    outdata = os.path.join(workdir, 'outdata')
+    for d in (outdata, os.path.join(workdir, 'indata', 'Eurostat'),
+              os.path.join(workdir, 'indata', 'NIRs'),
+              os.path.join(workdir, 'sampling-settings')):
+        os.makedirs(d, exist_ok=True)
+
+    countries = [c for c in COUNTRIES if c[1] not in ('ES', 'MT')][:countries]
+    hierarchy = nuts_codes(countries, regions)
+
+    write_nuts_xls(os.path.join(outdata, 'NUTS_2010.xls'), hierarchy)
+    write_regions(
+        os.path.join(outdata, 'included_NUTS.geojson'),
+        hierarchy, country_size * 1000)
+    pixels = write_rasters(
+        outdata, rs, len(hierarchy), country_size * 1000, resolution,
+        livestock_resolution)
+
+    geo = all_codes(hierarchy, max_level=2)
+    national = list(hierarchy)
+    eurostat = os.path.join(workdir, 'indata', 'Eurostat')
+    write_eurostat(
+        os.path.join(eurostat, 'ef_olsaareg.tsv'),
+        ['agrarea', 'variable', 'geo'],
+        [(area, v, g) for area in ('TOTAL', 'HA0') for v in
+         EF_OLSAAREG_VARIABLES for g in geo], rs, missing=0)
+    write_eurostat(
+        os.path.join(eurostat, 'ef_oluaareg.tsv'),
+        ['agrarea', 'variable', 'geo'],
+        [(area, v, g) for area in ('TOTAL', 'HA0') for v in
+         EF_OLUAAREG_VARIABLES for g in geo], rs, missing=0)
+    write_eurostat(
+        os.path.join(eurostat, 'agr_r_crops.tsv'),
+        ['crop_pro', 'strucpro', 'geo'],
+        [(c, s, g) for c in CROPS for s in ('AR', 'PR', 'YI') for g in geo],
+        rs, missing=0.3)
+    write_eurostat(
+        os.path.join(eurostat, 'apro_cpp_crop.tsv'),
+        ['crop_pro', 'strucpro', 'geo'],
+        [(c, s, g) for c in CROPS for s in ('AR', 'PR', 'YI')
+         for g in national], rs, missing=0)
+    write_eurostat(
+        os.path.join(eurostat, 'agr_r_animal.tsv'),
+        ['animals', 'month', 'unit', 'geo'],
+        [(a, 'M12', 'THS_HD', g) for a in ANIMALS for g in geo], rs)
+
+    nirs = os.path.join(workdir, 'indata', 'NIRs')
+    for iso, nuts0 in countries:
+        for year in YEARS:
+            write_crf(
+                os.path.join(nirs, '{}-2014-{}-v1.1.xls'.format(iso, year)),
+                rs)
+
+    with open(os.path.join(workdir, 'sampling-settings', 'bench'), 'w') as f:
+        f.write('--step {} --radii {}\n'.format(step, radii))
+
+    config = dict(
+        countries=len(countries), regions=regions, country_size=country_size,
+        resolution=resolution, livestock_resolution=livestock_resolution,
+        step=step, radii=radii, seed=seed,
+        included_regions=sum(
+            len(l1) if c == 'DE' else sum(len(l2) for l2 in l1.values())
+            for c, l1 in hierarchy.items()),
+        raster_pixels=pixels)
+    with open(os.path.join(workdir, 'bench.json'), 'w') as f:
+        json.dump(config, f, indent=2)
+
+
+if __name__ == '__main__':
+    cli()
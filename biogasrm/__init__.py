@@ -1,3 +1,2 @@
 import biogasrm.parameters
 import biogasrm.results
-import biogasrm.spatial_util
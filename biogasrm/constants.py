@@ -234,7 +234,10 @@ ISO3166_3_TO_NUTS0 = {
 
 STAT_YEARS = [2009, 2010, 2011]
 
-NUTS = nuts.NUTS('outdata/NUTS_2010.xls')
+NUTS_PATH = 'outdata/NUTS_2010.xls'
+
+# Loaded on first use, from a cache next to the xls file if up to date
+NUTS = nuts.LazyNUTS(NUTS_PATH)
 
 MAPS = {
     'liquid': [
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""
+Pixel footprints of the samples on a raster grid.
+
+Summing a density raster within each sample (disk and region) means
+rasterizing every sample polygon, which is what makes sample_region_fracs
+slow. A FootprintIndex stores the pixels of each sample once, as runs of
+pixels along the raster rows with a weight per run, so that any raster on
+the same grid can then be summed within the samples without touching the
+polygons: the rows are read band by band and the runs are summed from
+cumulative sums along the rows.
+"""
+
+import logging
+import pickle
+
+import numpy as np
+import pandas as pd
+
+import biogasrm.instrument as instrument
+
+log = logging.getLogger(__name__)
+
+# Bytes per pixel used while summing a band of rows (the data with its mask
+# and the cumulative sums and counts)
+FOOTPRINT_BYTES_PER_PIXEL = 40
+
+
+class FootprintIndex(object):
+    """
+    The pixels within each sample, on a raster grid.
+
+    Made with FootprintIndex.build(). The runs are sorted by row. Run i
+    covers columns col0[i] to col1[i] - 1 of row row[i] of the grid, and
+    belongs to sample sample[i] (a position in samples).
+
+    Attributes:
+        samples: MultiIndex (x, y, r, NUTS_ID) of the samples.
+        sample, row, col0, col1: Integer arrays of the runs.
+        weight: The fraction of each pixel of a run within the sample.
+            All 1 unless the index was built with supersample > 1.
+        crs, left, top, xres, yres, width, height: The grid.
+    """
+    def __init__(self, samples, sample, row, col0, col1, weight, grid):
+        super(FootprintIndex, self).__init__()
+        self.samples = samples
+        self.sample = sample
+        self.row = row
+        self.col0 = col0
+        self.col1 = col1
+        self.weight = weight
+        (self.crs, self.left, self.top, self.xres, self.yres,
+         self.width, self.height) = grid
+
+    @classmethod
+    def build(cls, samples_path, template, supersample=1):
+        """
+        Rasterize the samples on the grid of a raster.
+
+        Args:
+            samples_path: The samples (as written by disks), with
+                properties x, y, r and NUTS_ID.
+            template: An open rasterio dataset with the grid.
+            supersample: Pixels are in a sample if their centers are, like
+                in zonal_sums(), if 1. If N > 1, the weight of each pixel
+                is the fraction of N x N subpixel centers in the sample.
+
+        Returns: A FootprintIndex.
+        """
+        import fiona
+        import rasterio.features
+        import shapely.geometry
+
+        left, _, _, top = template.bounds
+        xres, yres = template.res
+
+        keys = []
+        runs = []
+        with fiona.open(samples_path) as src:
+            for i, f in enumerate(instrument.progress(
+                    src, 'samples', total=len(src))):
+                p = f['properties']
+                keys.append((p['x'], p['y'], p['r'], p['NUTS_ID']))
+                geometry = shapely.geometry.shape(f['geometry'])
+                if geometry.is_empty:
+                    continue
+
+                xmin, ymin, xmax, ymax = geometry.bounds
+                col0 = max(int(np.floor((xmin - left) / xres)), 0)
+                col1 = min(int(np.ceil((xmax - left) / xres)), template.width)
+                row0 = max(int(np.floor((top - ymax) / yres)), 0)
+                row1 = min(int(np.ceil((top - ymin) / yres)), template.height)
+                if col1 <= col0 or row1 <= row0:
+                    continue
+
+                shape = (row1 - row0, col1 - col0)
+                transform = rasterio.transform.from_origin(
+                    left + col0 * xres, top - row0 * yres,
+                    xres / supersample, yres / supersample)
+                inside = ~rasterio.features.geometry_mask(
+                    [geometry], (shape[0] * supersample, shape[1] * supersample),
+                    transform)
+                weights = inside.reshape(
+                    shape[0], supersample, shape[1], supersample).mean(
+                        axis=(1, 3))
+
+                rows, starts, ends, values = _runs(weights)
+                runs.append((
+                    np.full(len(rows), i), rows + row0, starts + col0,
+                    ends + col0, values))
+
+        samples = pd.MultiIndex.from_arrays(
+            list(zip(*keys)) or [[]] * 4, names=['x', 'y', 'r', 'NUTS_ID'])
+        if runs:
+            sample, row, col0, col1, weight = [
+                np.concatenate(a) for a in zip(*runs)]
+        else:
+            sample, row, col0, col1, weight = [np.zeros(0)] * 5
+        order = np.argsort(row, kind='mergesort')
+
+        grid = (template.crs, left, top, xres, yres,
+                template.width, template.height)
+        index = cls(
+            samples, sample[order].astype(np.int32),
+            row[order].astype(np.int32), col0[order].astype(np.int32),
+            col1[order].astype(np.int32), weight[order].astype(np.float32),
+            grid)
+        log.info('Indexed {} samples in {} runs of {} pixels'.format(
+            len(samples), len(index.row), int((index.col1 - index.col0).sum())))
+        return index
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def offsets(self, dataset):
+        """
+        The (row, column) of the grid origin in a raster on the same grid.
+
+        Raises:
+            ValueError if the raster is not aligned with the grid, i.e. has
+            another CRS or resolution, or is shifted by part of a pixel.
+        """
+        xres, yres = dataset.res
+        left, _, _, top = dataset.bounds
+        col = (self.left - left) / xres
+        row = (top - self.top) / yres
+        aligned = (
+            dataset.crs == self.crs and
+            np.isclose(xres, self.xres) and np.isclose(yres, self.yres) and
+            abs(col - round(col)) < 1e-6 and abs(row - round(row)) < 1e-6)
+        if not aligned:
+            raise ValueError(
+                '{} is not aligned with the footprint grid; build an index '
+                'on its grid instead'.format(dataset.name))
+        return int(round(row)), int(round(col))
+
+    def sums(self, dataset, memory_budget=None):
+        """
+        Count and sum the valid pixels of a raster within each sample.
+
+        Args:
+            dataset: An open rasterio dataset aligned with the grid (see
+                offsets()). Band 1 is used.
+            memory_budget: MB of raster data to process at a time.
+
+        Returns:
+            A Series of sums indexed like samples, NaN for samples without
+            valid pixels (like zonal_sums() giving None).
+        """
+        import biogasrm.spatial_util as spatial_util
+
+        row_offset, col_offset = self.offsets(dataset)
+        rows = self.row + row_offset
+        col0 = np.clip(self.col0 + col_offset, 0, dataset.width)
+        col1 = np.clip(self.col1 + col_offset, 0, dataset.width)
+
+        n = len(self.samples)
+        sums = np.zeros(n)
+        counts = np.zeros(n)
+        band_rows = spatial_util.band_height_for_budget(
+            memory_budget, dataset.width + 1,
+            bytes_per_pixel=FOOTPRINT_BYTES_PER_PIXEL)
+        bands = spatial_util.iter_row_bands(
+            dataset.height, dataset.width, band_rows)
+        total = -(-dataset.height // band_rows)
+
+        for window in instrument.progress(bands, 'raster blocks', total):
+            (r0, r1), _ = window
+            first, last = np.searchsorted(rows, [r0, r1])
+            if first == last:
+                continue
+            data = dataset.read(1, window=window, masked=True)
+            valid = ~np.ma.getmaskarray(data)
+
+            shape = (r1 - r0, dataset.width + 1)
+            cumsum = np.zeros(shape)
+            np.cumsum(np.where(valid, data.data, 0), axis=1, out=cumsum[:, 1:])
+            cumcount = np.zeros(shape, dtype=np.int64)
+            np.cumsum(valid, axis=1, out=cumcount[:, 1:])
+
+            run = slice(first, last)
+            r = rows[run] - r0
+            c0, c1 = col0[run], col1[run]
+            run_sums = (cumsum[r, c1] - cumsum[r, c0]) * self.weight[run]
+            run_counts = cumcount[r, c1] - cumcount[r, c0]
+            sums += np.bincount(
+                self.sample[run], weights=run_sums, minlength=n)
+            counts += np.bincount(
+                self.sample[run], weights=run_counts, minlength=n)
+
+        sums[counts == 0] = np.nan
+        return pd.Series(sums, index=self.samples, name='sum')
+
+
+def load(path):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def _runs(weights):
+    """
+    Runs of equal, positive weights along the rows of a 2D array.
+
+    Returns:
+        Arrays of the row, first column, end column (exclusive) and
+        weight of each run, ordered by row and column.
+    """
+    height, width = weights.shape
+    padded = np.zeros((height, width + 2), dtype=weights.dtype)
+    padded[:, 1:-1] = weights
+    # Columns where a new run may start (the weight changes)
+    rows, cols = np.nonzero(padded[:, 1:] != padded[:, :-1])
+    same_row = rows[:-1] == rows[1:]
+    rows, starts, ends = rows[:-1][same_row], cols[:-1][same_row], cols[1:][same_row]
+    values = weights[rows, starts]
+    keep = values > 0
+    return rows[keep], starts[keep], ends[keep], values[keep]
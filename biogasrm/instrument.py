@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+"""
+Timing, memory and progress instrumentation for the command line tools.
+
+Instrumentation is off unless enabled with the --profile option of the
+biogasrm-* commands or the BIOGASRM_PROFILE environment variable. When off,
+span() and progress() do nothing, so they can be left in inner loops.
+
+When on, nested timing spans, peak memory (RSS) and loop throughput are
+recorded and written as a Chrome trace (JSON, open with chrome://tracing
+or https://ui.perfetto.dev) when the command finishes. Progress of long
+loops is logged with throughput and ETA.
+
+Each process writes its own trace, see trace_path(), so that e.g. the
+commands run by make do not overwrite each other's traces.
+"""
+
+import contextlib
+import cProfile
+import functools
+import json
+import logging
+import os
+import sys
+import time
+
+import click
+
+try:
+    import resource
+except ImportError: # Not available on Windows
+    resource = None
+
+log = logging.getLogger(__name__)
+
+ENV_VAR = 'BIOGASRM_PROFILE'
+
+# Seconds between progress log messages
+PROGRESS_INTERVAL = 10
+
+
+def peak_rss_mb(children=False):
+    """
+    Peak resident set size in MB, or None.
+
+    Args:
+        children: Instead the largest peak of the finished child processes
+            of this process, e.g. multiprocessing pool workers.
+    """
+    if resource is None:
+        return None
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    rss = resource.getrusage(who).ru_maxrss
+    # kB on Linux, bytes on macOS
+    return rss / (1024 ** 2 if sys.platform == 'darwin' else 1024)
+
+
+def trace_path(path, command):
+    """
+    The trace path of this process.
+
+    {command} and {pid} in path are replaced with the command name and
+    process id. If path has neither, they are added before the extension,
+    e.g. trace.json becomes trace.make_biogas_raster.12345.json.
+    """
+    if '{command}' in path or '{pid}' in path:
+        return path.format(command=command, pid=os.getpid())
+    root, ext = os.path.splitext(path)
+    return '{}.{}.{}{}'.format(root, command, os.getpid(), ext)
+
+
+class Profiler(object):
+    """Collects trace events for one process."""
+    def __init__(self):
+        super(Profiler, self).__init__()
+        self.enabled = False
+        self.path = None
+        self.cprofile = False
+        self.events = []
+        self.stack = []
+        self.origin = time.perf_counter()
+
+    def now_us(self):
+        return (time.perf_counter() - self.origin) * 1e6
+
+    def begin(self, name, **args):
+        self.stack.append((name, self.now_us(), args, self._start_cprofile()))
+
+    def end(self):
+        name, start, args, profile = self.stack.pop()
+        end = self.now_us()
+        args = dict(
+            args, peak_rss_mb=peak_rss_mb(),
+            children_peak_rss_mb=peak_rss_mb(children=True))
+        self.events.append(dict(
+            name=name, cat='span', ph='X', ts=start, dur=end - start,
+            pid=os.getpid(), tid=0, args=args))
+        self.events.append(dict(
+            name='peak_rss_mb', ph='C', ts=end, pid=os.getpid(),
+            args={'MB': args['peak_rss_mb'],
+                  'children MB': args['children_peak_rss_mb']}))
+        if profile is not None:
+            profile.disable()
+            profile.dump_stats('{}.{}.prof'.format(self.path, name))
+        return (end - start) / 1e6
+
+    def _start_cprofile(self):
+        # One cProfile dump per stage, i.e. per top-level span
+        if not (self.cprofile and not self.stack):
+            return None
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def write(self):
+        summary = {}
+        for event in self.events:
+            if event['ph'] != 'X':
+                continue
+            s = summary.setdefault(
+                event['name'], {'count': 0, 'seconds': 0, 'items': 0})
+            s['count'] += 1
+            s['seconds'] += event['dur'] / 1e6
+            s['items'] += event['args'].get('items', 0)
+        trace = {
+            'traceEvents': self.events,
+            'displayTimeUnit': 'ms',
+            'otherData': {
+                'command': ' '.join(sys.argv),
+                'peak_rss_mb': peak_rss_mb(),
+                'children_peak_rss_mb': peak_rss_mb(children=True),
+                'spans': summary,
+            },
+        }
+        with open(self.path, 'w') as f:
+            json.dump(trace, f, indent=1)
+        log.info('Wrote profile to {}'.format(self.path))
+
+
+_profiler = Profiler()
+
+
+def enable(path, cprofile=False):
+    """
+    Turn on instrumentation.
+
+    Args:
+        path: Where to write the trace (JSON).
+        cprofile: Whether to also dump cProfile stats for each top-level
+            span to path.<span name>.prof.
+    """
+    _profiler.enabled = True
+    _profiler.path = path
+    _profiler.cprofile = cprofile
+
+
+def enabled():
+    return _profiler.enabled
+
+
+def begin(name, **args):
+    """Start a span. Prefer span() where a with block fits."""
+    if _profiler.enabled:
+        _profiler.begin(name, **args)
+
+
+def finish():
+    """End all open spans and write the trace."""
+    if not _profiler.enabled:
+        return
+    while _profiler.stack:
+        _profiler.end()
+    _profiler.write()
+
+
+@contextlib.contextmanager
+def span(name, **args):
+    """
+    Time a block of code.
+
+    Args:
+        name: Name of the span in the trace.
+        **args: Extra (JSON serializable) information for the trace.
+    """
+    if not _profiler.enabled:
+        yield
+        return
+    _profiler.begin(name, **args)
+    try:
+        yield
+    finally:
+        seconds = _profiler.end()
+        log.info('{} took {:.2f} s'.format(name, seconds))
+
+
+def progress(iterable, name, total=None, size=None):
+    """
+    Report progress of a loop.
+
+    Logs the number of items done, throughput and ETA (if the total is
+    known) at most every PROGRESS_INTERVAL seconds, and records the loop
+    as a span with its number of items and throughput.
+
+    Args:
+        iterable: The items.
+        name: What the items are, e.g. 'points' or 'raster blocks'.
+        total: Number of items. Default len(iterable), if possible.
+        size: Optional function giving the size of an item, if items
+            should not be counted as one each (e.g. chunks of LP rows).
+
+    Returns:
+        An iterable over the same items.
+    """
+    if not _profiler.enabled:
+        return iterable
+    if total is None and hasattr(iterable, '__len__') and size is None:
+        total = len(iterable)
+    return _progress(iterable, name, total, size)
+
+
+def _progress(iterable, name, total, size):
+    _profiler.begin(name)
+    start = last = time.perf_counter()
+    done = 0
+    try:
+        for item in iterable:
+            yield item
+            done += 1 if size is None else size(item)
+            now = time.perf_counter()
+            if now - last >= PROGRESS_INTERVAL:
+                last = now
+                rate = done / (now - start)
+                if total:
+                    eta = (total - done) / rate if rate > 0 else float('inf')
+                    log.info('{}: {}/{} ({:.1f}/s, ETA {:.0f} s)'.format(
+                        name, done, total, rate, eta))
+                else:
+                    log.info('{}: {} ({:.1f}/s)'.format(name, done, rate))
+    finally:
+        seconds = time.perf_counter() - start
+        _profiler.stack[-1][2].update(
+            items=done,
+            items_per_second=done / seconds if seconds > 0 else None)
+        _profiler.end()
+
+
+def profile_options(group):
+    """
+    Add --profile and --cprofile options to a click group callback.
+
+    The invoked command runs in a top-level span, and the trace is written
+    when the command finishes.
+    """
+    @click.option('--profile', 'profile_path', type=click.Path(),
+                  default=None, envvar=ENV_VAR,
+                  help='Write a timing and memory trace (Chrome trace JSON) '
+                       'to this path, with the command name and process id '
+                       'added (see trace_path()). Also set by ${}.'.format(
+                           ENV_VAR))
+    @click.option('--cprofile', is_flag=True, default=False,
+                  help='With --profile, also dump cProfile stats to '
+                       '<trace path>.<command>.prof.')
+    @click.pass_context
+    @functools.wraps(group)
+    def wrapper(ctx, profile_path, cprofile, *args, **kwargs):
+        if profile_path:
+            command = ctx.invoked_subcommand or ctx.info_name
+            enable(trace_path(profile_path, command), cprofile=cprofile)
+            begin(command)
+            ctx.call_on_close(finish)
+        return group(*args, **kwargs)
+    return wrapper
@@ -1,47 +1,187 @@
 # -*- coding: utf-8 -*-
 
+import json
+import logging
+import os
+
+import numpy as np
 import pandas
 
+log = logging.getLogger(__name__)
+
+
+def cache_path(path):
+    """Path of the JSON cache of a NUTS xls file."""
+    return os.path.splitext(path)[0] + '.json'
+
+
+def load(path):
+    """
+    Load the NUTS hierarchy from an xls file, via a cache next to it.
+
+    The codes and labels are cached as JSON, so that the slow xls reading
+    is only done once (and again if the xls file is updated).
+
+    Args:
+        path: Path to the NUTS xls file.
+
+    Returns: A NUTS object.
+    """
+    cache = cache_path(path)
+    try:
+        if os.path.getmtime(cache) >= os.path.getmtime(path):
+            with open(cache, 'r') as f:
+                data = json.load(f)
+            return NUTS.from_codes(data['codes'], data['labels'])
+    except (OSError, ValueError, KeyError):
+        pass
+
+    result = NUTS(path)
+    codes = sorted(result._labels)
+    try:
+        with open(cache, 'w') as f:
+            json.dump({
+                'codes': codes,
+                'labels': [result._labels[c] for c in codes]}, f)
+    except OSError as e:
+        log.warning('Could not cache NUTS codes: {}'.format(e))
+    return result
+
+
+class LazyNUTS(object):
+    """
+    A NUTS hierarchy which is loaded on first use.
+
+    Args:
+        path: Path to the NUTS xls file. Relative paths are relative to the
+            working directory at first use.
+    """
+    def __init__(self, path):
+        super(LazyNUTS, self).__init__()
+        self._path = path
+        self._nuts = None
+
+    def _load(self):
+        if self._nuts is None:
+            self._nuts = load(self._path)
+        return self._nuts
+
+    def __getattr__(self, name):
+        # Only called for missing attributes. Private names are not
+        # delegated: on an instance without __dict__ (e.g. while unpickling
+        # or copying) _nuts itself is missing, and would recurse.
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self._load(), name)
+
+    def __reduce__(self):
+        # Pickle (e.g. for worker processes) and copy as unloaded
+        return (LazyNUTS, (self._path,))
+
+
 class NUTS(object):
-    """docstring for NUTS"""
+    """
+    The NUTS hierarchy.
+
+    The codes are stored in a pandas Index, with a parent array and a
+    table of ancestors at each level (positions in the Index), so that
+    codes can be mapped to their ancestors or descendants as one array
+    operation. Built in linear time in the number of codes.
+    """
     def __init__(self, path):
         super(NUTS, self).__init__()
-        self._children = {}
-        self._labels = {}
-        self._region_objects = {}
-
         data = pandas.read_excel(path)
-        codes = data['NUTS CODE']
-        for idx, row in data.iterrows():
-            code, label = row['NUTS CODE'], row['NUTS LABEL']
-            self._labels[code] = label
-            children = set(filter(lambda c: c[:-1] == code, codes))
-            if len(children) > 0:
-                self._children[code] = children
+        self._build(list(data['NUTS CODE']), list(data['NUTS LABEL']))
+
+    @classmethod
+    def from_codes(cls, codes, labels):
+        """Make a NUTS hierarchy from lists of codes and labels."""
+        nuts = cls.__new__(cls)
+        nuts._build(codes, labels)
+        return nuts
+
+    def _build(self, codes, labels):
+        self._labels = dict(zip(codes, labels))
+        self.codes = pandas.Index(list(self._labels))
+        self.levels = np.array([len(c) - 2 for c in self.codes])
+
+        # Position of each code's parent, or -1
+        self.parents = self.codes.get_indexer([c[:-1] for c in self.codes])
 
-        self._levels = {l: set(filter(lambda c: len(c) == l + 2, codes)) for l in (0, 1, 2, 3)}
+        # Position of each code's ancestor at each level (the code itself
+        # at its own level), or -1. Filled top down, level by level.
+        n_levels = self.levels.max() + 1 if len(self.codes) else 0
+        self._ancestors = np.full((len(self.codes), n_levels), -1, dtype=int)
+        self._level_positions = {}
+        for level in range(n_levels):
+            positions = np.flatnonzero(self.levels == level)
+            parents = self.parents[positions]
+            has_parent = parents >= 0
+            self._ancestors[positions[has_parent]] = (
+                self._ancestors[parents[has_parent]])
+            self._ancestors[positions, level] = positions
+            self._level_positions[level] = positions
+
+        self._children = {}
+        for code, parent in zip(self.codes, self.parents):
+            if parent >= 0:
+                self._children.setdefault(self.codes[parent], set()).add(code)
 
     def descendants(self, code, level):
+        """
+        The descendants of a region at a level.
+
+        Args:
+            code: A NUTS code.
+            level: A level below the level of code.
+
+        Returns: A pandas Index of NUTS codes.
+        """
         code_level = len(code) - 2
         if level <= code_level:
             raise ValueError('cannot get descendants at level {} for {}'.format(level, code))
-        if level == code_level + 1:
-            return self._children[code]
-        else:
-            return set.union(*[self.descendants(c, level) for c in self._children[code]])
+        position = self.codes.get_loc(code)
+        candidates = self._level_positions.get(level, np.array([], dtype=int))
+        found = self._ancestors[candidates, code_level] == position
+        return self.codes[candidates[found]]
 
     def children(self, code):
         return self._children[code]
 
-    def ancestor(self, code, level):
+    def ancestor(self, codes, level):
+        """
+        The ancestors of regions at a level.
+
+        Args:
+            codes: A NUTS code, or an array or Index of NUTS codes.
+            level: The level of the ancestors. Codes at or above the level
+                are their own ancestors.
+
+        Returns: A NUTS code if codes is a single code, else a pandas Index.
+        """
         ancestor_code_len = level + 2
         if ancestor_code_len < 2:
-            raise ValueError('cannot get ancestor for {}'.format(code))
-        return code[:ancestor_code_len]
+            raise ValueError('cannot get ancestor for {}'.format(codes))
+        if isinstance(codes, str):
+            return codes[:ancestor_code_len]
+
+        codes = pandas.Index(codes)
+        positions = self.codes.get_indexer(codes)
+        result = np.full(len(codes), -1, dtype=int)
+        if level < self._ancestors.shape[1]:
+            known = positions >= 0
+            result[known] = self._ancestors[positions[known], level]
+        ancestors = self.codes[result].values
+        # Codes not in the hierarchy (or above the level) by their prefix
+        unknown = result < 0
+        if unknown.any():
+            ancestors[unknown] = [c[:ancestor_code_len] for c in codes[unknown]]
+        return pandas.Index(ancestors, name=codes.name)
 
     def parent(self, code):
         parent_level = len(code) - 3
         return self.ancestor(code, parent_level)
 
     def level(self, level):
-        return self._levels[level]
+        """The NUTS codes at a level, as a pandas Index."""
+        return self.codes[self._level_positions.get(level, [])]
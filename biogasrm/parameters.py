@@ -3,6 +3,8 @@
 import pandas
 import biogasrm.constants as constants
 
+DEFAULT_REMOVAL_RATE = 0.4
+
 def defaults():
     # dry weight / wet weight
     params = {}
@@ -123,7 +125,7 @@ def defaults():
         }
     })
 
-    params['REMOVAL_RATE'] = 0.4
+    params['REMOVAL_RATE'] = DEFAULT_REMOVAL_RATE
 
     # Convert residue ratios to VS weight / reported crop production
     params['RESIDUE_RATIOS'] *= (
@@ -1,56 +1,126 @@
 # -*- coding: utf-8 -*-
 
 from collections import defaultdict
+import io
 import json
 import os
 import re
 
 import click
 import numpy as np
-import rasterio
 import pandas
 import pickle
-import fiona
 
 import biogasrm.util as util
-import biogasrm.spatial_util as spatial_util
 import biogasrm.constants as constants
+import biogasrm.instrument as instrument
+import biogasrm.raster_options as raster_options
 
 @click.group()
+@instrument.profile_options
 def cli():
     pass
 
+def _reclassify(weights):
+    """
+    A function mapping (masked) arrays of land cover classes to weights.
+
+    Each distinct class in an array is looked up once, instead of once per
+    pixel, so the memory use is that of a few arrays like the input.
+    """
+    def transform(block):
+        classes, inverse = np.unique(block.data, return_inverse=True)
+        values = np.array([weights[c] for c in classes], dtype=np.float32)
+        return np.ma.masked_array(
+            values[inverse].reshape(block.shape),
+            mask=np.ma.getmaskarray(block))
+    return transform
+
 @cli.command()
-@click.argument('land-cover', type=click.Path(exists=True))
+@click.argument('land-cover', type=raster_options.InputPath())
 @click.argument('dst', type=click.Path())
-def cropland(land_cover, dst):
-    transform = lambda clc_class: constants.CROPLAND_WEIGHTS[clc_class]
-    transform = np.vectorize(transform, otypes=[np.float32])
+@raster_options.memory_budget_option
+def cropland(land_cover, dst, memory_budget):
+    import biogasrm.spatial_util as spatial_util
+    transform = _reclassify(constants.CROPLAND_WEIGHTS)
     spatial_util.transform(
-        land_cover, dst, transform,
-        masked=True, dtype='float32', nodata=-1)
+        land_cover, dst, transform, masked=True,
+        memory_budget=memory_budget, dtype='float32', nodata=-1)
 
 @cli.command()
-@click.argument('land-cover', type=click.Path(exists=True))
+@click.argument('land-cover', type=raster_options.InputPath())
 @click.argument('dst', type=click.Path())
-def water(land_cover, dst):
-    transform = lambda clc_class: constants.WATER_WEIGHTS[clc_class]
-    transform = np.vectorize(transform, otypes=[np.float32])
+@raster_options.memory_budget_option
+def water(land_cover, dst, memory_budget):
+    import biogasrm.spatial_util as spatial_util
+    transform = _reclassify(constants.WATER_WEIGHTS)
     spatial_util.transform(
-        land_cover, dst, transform,
-        masked=True, dtype='float32', nodata=0)
+        land_cover, dst, transform, masked=True,
+        memory_budget=memory_budget, dtype='float32', nodata=0)
 
 
 @cli.command()
-@click.argument('raster', type=click.Path(exists=True))
-@click.argument('regions', type=click.Path(exists=True))
+@click.argument('raster', type=raster_options.InputPath())
+@click.argument('regions', type=raster_options.InputPath())
 @click.option('--key-property', '-k', type=str, default=None)
 @click.option('--output', '-o', type=click.File('w'), default='-')
-def coverage(raster, regions, key_property, output):
-    result = spatial_util.coverage(raster, regions, key_property=key_property)
+@raster_options.memory_budget_option
+def coverage(raster, regions, key_property, output, memory_budget):
+    import biogasrm.spatial_util as spatial_util
+    result = spatial_util.coverage(
+        raster, regions, key_property=key_property,
+        memory_budget=memory_budget)
+    json.dump(result, output)
+
+
+@cli.command()
+@click.argument('raster', type=raster_options.InputPath())
+@click.argument('regions', type=raster_options.InputPath())
+@click.option('--key-property', '-k', type=str, default='NUTS_ID')
+@click.option('--output', '-o', type=click.File('w'), default='-')
+@raster_options.memory_budget_option
+def regional_sums(raster, regions, key_property, output, memory_budget):
+    """Sum a raster within each region (JSON {key: sum})."""
+    import biogasrm.spatial_util as spatial_util
+    result = spatial_util.regional_sums(
+        raster, regions, key_property, memory_budget=memory_budget)
     json.dump(result, output)
 
 
+@cli.command()
+@click.argument('sources', type=raster_options.InputPath(), nargs=-1,
+                required=True)
+@click.argument('dst', type=click.Path())
+@raster_options.memory_budget_option
+def merge(sources, dst, memory_budget):
+    """Merge aligned rasters. The first valid value of each pixel is used."""
+    import biogasrm.spatial_util as spatial_util
+    spatial_util.merge(sources, dst, memory_budget=memory_budget)
+
+
+@cli.command()
+@click.argument('sources', type=raster_options.InputPath(), nargs=-1,
+                required=True)
+@click.argument('dst', type=click.Path())
+@click.option('--like', type=raster_options.InputPath(), required=True,
+              help='Raster with the output CRS and bounds.')
+@click.option('--resolution', type=float, default=None,
+              help='Output resolution (m). Default that of --like.')
+@raster_options.memory_budget_option
+def glw(sources, dst, like, resolution, memory_budget):
+    """
+    Warp and merge GLW livestock rasters in one pass.
+
+    SOURCES are the GLW rasters (e.g. for Europe and Asia), which can be
+    read from the downloaded zip files with /vsizip/ paths. The first
+    valid value of each pixel is used.
+    """
+    import biogasrm.spatial_util as spatial_util
+    spatial_util.warp_merge(
+        sources, dst, like, resolution=resolution,
+        memory_budget=memory_budget)
+
+
 def nuts_partition():
     NUTS = constants.NUTS
     countries = NUTS.level(0)
@@ -58,12 +128,12 @@ def nuts_partition():
         country: constants.NUTS_LEVEL[country]
         for country in countries
         if constants.NUTS_LEVEL[country] != 'exclude'}
-    included = set.union(*(NUTS.descendants(c, levels[c]) for c in levels))
+    included = set().union(*(NUTS.descendants(c, levels[c]) for c in levels))
     return included
 
 
 @cli.command()
-@click.argument('regions', type=click.Path(exists=True))
+@click.argument('regions', type=raster_options.InputPath())
 @click.option('--output', '-o', type=click.Path())
 @click.argument('cover-files', type=click.Path(exists=True), nargs=-1)
 def included_NUTS(regions, output, cover_files):
@@ -92,6 +162,7 @@ def included_NUTS(regions, output, cover_files):
         [c for c in candidates
         if sufficient_cover(c) and c in substrates_known])
 
+    import fiona
     with fiona.open(regions, 'r') as src:
         settings = dict(driver=src.driver, crs=src.crs, schema=src.schema.copy())
         with fiona.open(output, 'w', **settings) as dst:
@@ -101,16 +172,25 @@ def included_NUTS(regions, output, cover_files):
 
 
 @cli.command()
-@click.argument('src', type=click.Path(exists=True))
+@click.argument('src', type=raster_options.InputPath())
 @click.argument('dst', type=click.File('wb'), default='-')
 def read_eurostat(src, dst):
+    """
+    Read a Eurostat bulk download table (TSV) to a pickled DataFrame.
+
+    SRC may be gzipped (*.tsv.gz or /vsigzip/...) or in a zip archive
+    (/vsizip/archive.zip/table.tsv).
+    """
+    with util.open_input(src) as f:
+        text = f.read()
     header = pandas.read_csv(
-        src, delimiter='\s?\t', nrows=1, header=None, engine='python')
+        io.StringIO(text), delimiter='\s?\t', nrows=1, header=None,
+        engine='python')
     row_level_names, col_level_names = [
         s.split(',') for s in header[0][0].split('\\')]
 
     data = pandas.read_csv(
-        src,
+        io.StringIO(text),
         delimiter='\s?[a-z]?\t',
         na_values=[':', ': z'],
         index_col=0,
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+Command line options and types for raster processing and output rasters.
+
+Kept apart from spatial_util, so that the commands can be defined without
+importing rasterio and the other geospatial libraries.
+"""
+
+import functools
+
+import click
+
+# Output raster layouts:
+#   plain: Untiled GeoTIFF.
+#   tiled: Tiled GeoTIFF.
+#   cog: Cloud optimized GeoTIFF, i.e., tiled with internal overviews
+#        stored before the image data.
+RASTER_LAYOUTS = ('plain', 'tiled', 'cog')
+RASTER_COMPRESSIONS = ('none', 'deflate', 'zstd')
+# Oldest GDAL version with each compression, see spatial_util.check_raster_output()
+COMPRESSION_GDAL_VERSIONS = {'zstd': (2, 3)}
+DEFAULT_BLOCKSIZE = 512
+
+# Prefix of GDAL virtual file system paths, e.g. /vsizip/archive.zip/file.tif
+VSI_PREFIX = '/vsi'
+
+# Memory budget (MB) for the raster data processed at a time
+MEMORY_BUDGET_ENV_VAR = 'BIOGASRM_MEMORY_BUDGET'
+DEFAULT_MEMORY_BUDGET = 512
+
+# Floating point precision of sample fractions, sample substrates and the
+# rasters made from them. The LP is always solved in float64.
+PRECISIONS = ('float64', 'float32')
+PRECISION_ENV_VAR = 'BIOGASRM_PRECISION'
+DEFAULT_PRECISION = 'float64'
+
+
+def is_virtual(path):
+    """Whether a path is in a GDAL virtual file system (/vsizip/ etc.)."""
+    return path.startswith(VSI_PREFIX)
+
+
+class InputPath(click.Path):
+    """
+    An existing input file, or a path in a GDAL virtual file system.
+
+    Virtual paths like /vsizip/archive.zip/file.tif or /vsigzip/file.tsv.gz
+    are passed on unchecked, to be opened by GDAL (or util.open_input()).
+    """
+    def __init__(self, **kwargs):
+        kwargs.setdefault('exists', True)
+        super(InputPath, self).__init__(**kwargs)
+
+    def convert(self, value, param, ctx):
+        if is_virtual(value):
+            return value
+        return super(InputPath, self).convert(value, param, ctx)
+
+
+def raster_output_options(command):
+    """Add options for the output raster layout to a click command.
+
+    The options are passed to the command as one dict argument,
+    raster_output, with keyword arguments for open_raster_output(). They
+    are checked against the installed GDAL before the command runs, so
+    that an unsupported layout or compression fails before any data is
+    computed or written.
+    """
+    names = ('layout', 'compress', 'overviews', 'sparse')
+
+    @functools.wraps(command)
+    def wrapper(*args, **kwargs):
+        import biogasrm.spatial_util as spatial_util
+
+        raster_output = {name: kwargs.pop(name) for name in names}
+        try:
+            spatial_util.check_raster_output(**raster_output)
+        except ValueError as e:
+            raise click.UsageError(str(e))
+        kwargs['raster_output'] = raster_output
+        return command(*args, **kwargs)
+
+    options = [
+        click.option('--layout', type=click.Choice(RASTER_LAYOUTS),
+            default='plain',
+            help='Output GeoTIFF layout. Default plain (untiled).'),
+        click.option('--compress', type=click.Choice(RASTER_COMPRESSIONS),
+            default='none',
+            help='Output compression, with predictor. Default none. '
+                 'zstd needs GDAL >= 2.3.'),
+        click.option('--overviews/--no-overviews', default=False,
+            help='Build internal overviews (always done for cog).'),
+        click.option('--sparse/--no-sparse', default=False,
+            help='Omit tiles containing only nodata.'),
+    ]
+    for option in reversed(options):
+        wrapper = option(wrapper)
+    return wrapper
+
+
+def memory_budget_option(command):
+    """Add a --memory-budget option (MB) to a click command.
+
+    The budget is passed to the command as the argument memory_budget.
+    Rasters are processed in windows sized to fit it, see
+    spatial_util.window_size_for_budget().
+    """
+    return click.option(
+        '--memory-budget', type=float, default=DEFAULT_MEMORY_BUDGET,
+        envvar=MEMORY_BUDGET_ENV_VAR,
+        help='Approximate memory in MB for raster data processed at a '
+             'time. Also set by ${}. Default {}.'.format(
+                MEMORY_BUDGET_ENV_VAR, DEFAULT_MEMORY_BUDGET))(command)
+
+
+def precision_option(command):
+    """Add a --precision option (float64 or float32) to a click command.
+
+    The precision is passed to the command as the argument precision.
+    float32 halves the memory of the sample tables; see
+    `biogasrm-results precision-report` for its effect on the results.
+    """
+    return click.option(
+        '--precision', type=click.Choice(PRECISIONS),
+        default=DEFAULT_PRECISION, envvar=PRECISION_ENV_VAR,
+        help='Floating point precision of sample fractions, substrates '
+             'and rasters. Also set by ${}. Default {}.'.format(
+                PRECISION_ENV_VAR, DEFAULT_PRECISION))(command)
@@ -1,29 +1,33 @@
 # -*- coding: utf-8 -*-
 
-import tempfile
 import pickle
 import os
 import re
-from subprocess import check_call
-import shutil
 import json
 import math
+import functools
+import collections
+import multiprocessing
 
 import click
 import numpy as np
 import pandas as pd
-from scipy.optimize import linprog
-import fiona
-import shapely
 
 import biogasrm.parameters as parameters
 import biogasrm.constants as constants
 import biogasrm.util as util
-import biogasrm.spatial_util as spatial_util
+import biogasrm.instrument as instrument
+import biogasrm.raster_options as raster_options
+import biogasrm.store as store
 
 INCLUDED_NUTS_PATH = 'outdata/included_NUTS.geojson'
 
+# The CRS of the sample rasters. Same as CLC2006 (yeah, we are assuming A LOT
+# about the data here...)
+SAMPLE_RASTER_CRS = 'EPSG:3035'
+
 def get_included_nuts_codes():
+    import fiona
     with fiona.open(INCLUDED_NUTS_PATH) as src:
         codes = {feature['properties']['NUTS_ID'] for feature in src}
 
@@ -43,24 +47,29 @@ def _duplicate_columns(data, duplications, allow_missing=False):
     return pd.DataFrame.from_dict(result)
 
 
-def get_excretion(params):
+@functools.lru_cache(maxsize=None)
+def get_population_by_mgmt():
     """
-    Get total excretion of manure in different management systems.
+    Get livestock populations split by manure management system.
 
-    Unit Mg VS / year
+    This is the parameter independent part of get_excretion(). The result
+    is cached, so it must not be modified by the caller.
+
+    Unit heads (1000 heads for poultry).
 
     Returns: DataFrame.
-        Rows: NUTS regions. Columns: 2-level index (livestock, management).
+        Rows: 2-level index (mgmt, NUTS region). Columns: Excretion classes.
     """
 
-    mgmt = pickle.load(open('outdata/manure_mgmt.pkl', 'rb'))
-    animal_pop = pickle.load(open('outdata/animal_pop.pkl', 'rb'))
+    mgmt = store.read_table('manure_mgmt', 'outdata/manure_mgmt.pkl')
+    animal_pop = store.read_table('animal_pop', 'outdata/animal_pop.pkl')
     mgmt = mgmt.stack().unstack(1)[constants.STAT_YEARS].mean(axis=1)
 
     NUTS = constants.NUTS
 
     mgmt = mgmt.unstack(0)
-    NUTS0_parents = {n: NUTS.ancestor(n, 0) for n in animal_pop.index}
+    NUTS0_parents = dict(zip(
+        animal_pop.index, NUTS.ancestor(animal_pop.index, 0)))
 
     # copy manure mgmt to subregions
     mgmt = _duplicate_columns(mgmt, NUTS0_parents, allow_missing=True)
@@ -79,6 +88,21 @@ def get_excretion(params):
         pop_by_mgmt.unstack().T,
         constants.EXCR_CLASSES_TO_EUROSTAT)
 
+    return pop_by_mgmt
+
+
+def get_excretion(params):
+    """
+    Get total excretion of manure in different management systems.
+
+    Unit Mg VS / year
+
+    Returns: DataFrame.
+        Rows: NUTS regions. Columns: 2-level index (livestock, management).
+    """
+
+    pop_by_mgmt = get_population_by_mgmt()
+
     excretion_by_mgmt = pop_by_mgmt * params['EXCRETION_PER_HEAD']
 
     # Aggregate to GLW classes
@@ -88,26 +112,27 @@ def get_excretion(params):
 
     excretion_by_mgmt = excretion_by_mgmt.unstack(0)
 
-    #
-
     return excretion_by_mgmt
 
-def get_residues(params):
+@functools.lru_cache(maxsize=None)
+def get_subnational_harvests():
     """
-    Get available amounts of different residues including other uses.
+    Get crop harvests in NUTS regions, filling gaps in the subnational
+    statistics using harvested areas and national harvests.
 
-    Calculated as total residue production * REMOVAL_RATE.
+    This is the parameter independent part of get_residues(). The result
+    is cached, so it must not be modified by the caller.
 
-    Unit Mg VS / year.
+    Unit Mg harvest / year.
 
     Returns: DataFrame.
-        Rows: NUTS regions. Columns: Residue types.
+        Rows: NUTS regions. Columns: Crops.
     """
 
     years = list(map(str, constants.STAT_YEARS))
 
     # National and subnational harvested areas from Eurostat ef_oluaareg
-    ef_oluaareg = pickle.load(open('outdata/eurostat/ef_oluaareg.pkl', 'rb'))
+    ef_oluaareg = _read_eurostat('ef_oluaareg')
     ef_oluaareg_years = [y for y in years if y in ef_oluaareg.columns]
     ef_oluaareg = (ef_oluaareg
                    .xs('TOTAL', level='agrarea')[ef_oluaareg_years]
@@ -118,12 +143,12 @@ def get_residues(params):
     crop_areas = crop_areas.fillna(0) # Assume zero harvest area for missing data
 
     # National and subnational harvests, but incomplete
-    agr_r_crops = pickle.load(open('outdata/eurostat/agr_r_crops.pkl', 'rb'))
+    agr_r_crops = _read_eurostat('agr_r_crops')
     agr_r_crops = agr_r_crops.xs('PR', level='strucpro')[years].mean(axis=1).unstack(0)
     agr_r_crops *= 1000 # Unit conversion to Mg harvest
 
     # National harvest data from Eurostat apro_cpp_crop table
-    apro_cpp_crop = pickle.load(open('outdata/eurostat/apro_cpp_crop.pkl', 'rb'))
+    apro_cpp_crop = _read_eurostat('apro_cpp_crop')
     apro_cpp_crop *= 1000 # Unit conversion to Mg
     apro_cpp_crop = apro_cpp_crop.xs('PR', level='strucpro')[years].mean(axis=1).unstack(0)
 
@@ -139,30 +164,43 @@ def get_residues(params):
 
 
     NUTS = constants.NUTS
-    candidate_regions = set.union(NUTS.level(0), NUTS.level(1), NUTS.level(2))
-    regions = list(candidate_regions.intersection(set(crop_areas.index)))
+    candidate_regions = NUTS.level(0).append([NUTS.level(1), NUTS.level(2)])
+    regions = list(candidate_regions.intersection(crop_areas.index))
 
     subnational_harvests = pd.DataFrame(index=regions, columns=crop_areas.columns)
     subnational_harvests.update(national_harvests) # National harvests as base alternative
     subnational_harvests.update(agr_r_crops) # Fill in subnational
 
-    missing = subnational_harvests.isnull().stack()
-    missing = missing[missing].index
-
     # Estimate missing data using harvested areas and parent areas' harvests:
+    columns = subnational_harvests.columns
+    ancestors = NUTS.ancestor(subnational_harvests.index, 0)
+    this_area = crop_areas.reindex(index=regions, columns=columns).values
+    anc_area = crop_areas.reindex(index=ancestors, columns=columns).values
+    anc_harvest = subnational_harvests.reindex(ancestors).values.astype(float)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        estimate = anc_harvest * (this_area / anc_area)
+    estimate[(this_area == 0) | (anc_area == 0)] = 0
+    estimate = pd.DataFrame(estimate, index=regions, columns=columns)
 
-    for nuts_code, crop in missing:
-        ancestor = NUTS.ancestor(nuts_code, 0)
-        anc_area = crop_areas.loc[ancestor, crop]
-        this_area = crop_areas.loc[nuts_code, crop]
-        if this_area == 0 or anc_area == 0:
-            harvest = 0
-        else:
-            weight = this_area / anc_area
-            harvest = subnational_harvests.loc[ancestor, crop] * weight
+    subnational_harvests = subnational_harvests.where(
+        subnational_harvests.notnull(), estimate)
+
+    return subnational_harvests
+
+
+def get_residues(params):
+    """
+    Get available amounts of different residues including other uses.
 
-        subnational_harvests.loc[nuts_code, crop] = harvest
+    Calculated as total residue production * REMOVAL_RATE.
 
+    Unit Mg VS / year.
+
+    Returns: DataFrame.
+        Rows: NUTS regions. Columns: Residue types.
+    """
+
+    subnational_harvests = get_subnational_harvests()
 
     RESIDUE_RATIOS = params['RESIDUE_RATIOS']
     residues = pd.DataFrame.from_dict(
@@ -247,24 +285,131 @@ def get_substrates(params, basis='VS'):
 
     return substrates
 
-def get_sample_fracs(sampling):
-    samples_dir = os.path.abspath('outdata/sampling/{}/'.format(sampling))
-    fracs = {}
-    for filename in os.listdir(samples_dir):
-        if not filename.endswith('_fracs.pkl'):
-            continue
-        density_name = filename.replace('_fracs.pkl', '')
-        with open(os.path.join(samples_dir, filename), 'rb') as f:
-            fracs[density_name] = pickle.load(f)
-    fracs = pd.DataFrame(fracs)
+def _read_eurostat(table):
+    return store.read_table(
+        'eurostat/{}'.format(table), 'outdata/eurostat/{}.pkl'.format(table))
+
+
+def get_sample_fracs(sampling, regions=None, bbox=None, dtype=None):
+    """
+    Each sample's fraction of its region, for each density.
+
+    Read from the datastore if the fractions are migrated there (see
+    biogasrm.store), otherwise from the *_fracs.pkl of the sampling.
+
+    Args:
+        sampling: The name of the sampling settings.
+        regions: Optional NUTS_ID prefix to read only those regions.
+        bbox: Optional (xmin, ymin, xmax, ymax) to read only the samples
+            centered there (m).
+        dtype: Optional dtype of the fractions, e.g. 'float32'.
+
+    Returns:
+        A DataFrame indexed (x, y, r, NUTS_ID) with one column per density.
+    """
+    paths = _sample_fracs_paths(sampling)
+    if store.use_samples(sampling, 'fracs', paths):
+        fracs = store.Store().read_samples(
+            sampling, 'fracs', regions=regions, bbox=bbox)
+    else:
+        fracs = {}
+        for path in paths:
+            density_name = os.path.basename(path).replace('_fracs.pkl', '')
+            with open(path, 'rb') as f:
+                fracs[density_name] = pickle.load(f)
+        fracs = pd.DataFrame(fracs)
+        if regions is not None:
+            codes = pd.Series(fracs.index.get_level_values('NUTS_ID'))
+            fracs = fracs[codes.str.startswith(regions).values]
+        if bbox is not None:
+            xmin, ymin, xmax, ymax = bbox
+            x = fracs.index.get_level_values('x')
+            y = fracs.index.get_level_values('y')
+            fracs = fracs[(x >= xmin) & (x <= xmax) & (y >= ymin) & (y <= ymax)]
     fracs.dropna(inplace=True, axis=(0,1))
+    if dtype is not None:
+        fracs = fracs.astype(dtype)
     return fracs
 
 
-def get_sample_substrates(sampling, params):
-    samples = get_sample_fracs(sampling)
-    region_substrates = get_substrates(params)
+def _sample_fracs_paths(sampling):
+    samples_dir = os.path.abspath('outdata/sampling/{}/'.format(sampling))
+    return [
+        os.path.join(samples_dir, filename)
+        for filename in os.listdir(samples_dir)
+        if filename.endswith('_fracs.pkl')]
 
+
+def _stored_sample_centers(sampling, radius):
+    """
+    The centers of the samples of a radius, read from the datastore.
+
+    The fractions are read a chunk at a time and only the centers are
+    kept, so this takes far less memory than get_sample_fracs().
+
+    Returns:
+        A MultiIndex (x, y) of the centers of the samples which
+        get_sample_fracs() would return, sorted.
+    """
+    parts = []
+    for chunk in store.Store().iter_samples(sampling, 'fracs'):
+        chunk = chunk.dropna()
+        chunk = chunk[chunk.index.get_level_values('r') == radius]
+        parts.append(pd.DataFrame({
+            'x': chunk.index.get_level_values('x'),
+            'y': chunk.index.get_level_values('y')}).drop_duplicates())
+    if not parts:
+        return pd.MultiIndex.from_arrays([[], []], names=['x', 'y'])
+    centers = (
+        pd.concat(parts).drop_duplicates().sort_values(['x', 'y']))
+    return pd.MultiIndex.from_arrays(
+        [centers['x'].values, centers['y'].values], names=['x', 'y'])
+
+
+def get_sample_substrates(sampling, params, dtype=None):
+    """
+    The substrates within each sample.
+
+    Args:
+        sampling: The name of the sampling settings.
+        dtype: Optional dtype of the fractions and substrates, e.g.
+            'float32' to halve the memory. Default float64.
+
+    Returns:
+        A DataFrame indexed (x, y, r) with columns (density, substrate).
+    """
+    with instrument.span('get_sample_fracs'):
+        samples = get_sample_fracs(sampling, dtype=dtype)
+    return _sample_substrates(samples, params, dtype=dtype)
+
+
+def _sample_substrates(samples, params, dtype=None):
+    """get_sample_substrates() from already read fractions."""
+    with instrument.span('get_substrates'):
+        region_substrates = get_substrates(params)
+    if dtype is not None:
+        region_substrates = region_substrates.astype(dtype)
+
+    with instrument.span('distribute substrates', samples=len(samples)):
+        sample_substrates = _distribute_substrates(samples, region_substrates)
+    sample_substrates = sample_substrates.dropna(how='all', axis=1)
+    sample_substrates = sample_substrates.fillna(0)
+    return sample_substrates
+
+
+def _distribute_substrates(samples, region_substrates):
+    """
+    Distribute regional substrate amounts to samples.
+
+    Args:
+        samples: Sample fractions (from get_sample_fracs()).
+        region_substrates: Substrate amounts by region (from
+            get_substrates()).
+
+    Returns:
+        A DataFrame indexed (x, y, r) with columns (density, substrate),
+        NaN where a substrate is not distributed like a density.
+    """
     sample_substrates = (
         pd.concat(
             {
@@ -274,14 +419,12 @@ def get_sample_substrates(sampling, params):
                   .groupby(level=['x', 'y', 'r']).sum().stack())
                  for distribution in region_substrates.stack().columns
             }, axis=1)
-        .unstack()
-        .dropna(how='all', axis=1))
+        .unstack())
     sample_substrates.columns.names = ['density', 'substrate']
-    sample_substrates = sample_substrates.fillna(0)
     return sample_substrates
 
 
-def maximize_prod(substrates, params):
+def maximize_prod(substrates, params, processes=1):
     """
     Maximize biogas production from a composition of substrates.
 
@@ -290,20 +433,42 @@ def maximize_prod(substrates, params):
     Args:
         substrates: Either a Series with substrates, or a
             DataFrame where each row is such a Series.
+        processes: Number of worker processes to solve the rows of a
+            DataFrame with. None means one per CPU. Default 1.
 
     Returns:
-        The amount of substrates utilized after optimization.
+        The amount of substrates utilized after optimization. The LP is
+        solved in float64, but a DataFrame of utilized amounts has the
+        dtype of the substrates.
     """
+    lp = compile_lp(params)
     if isinstance(substrates, pd.Series):
-        return _one_maximize_prod(substrates, params)
+        return _one_maximize_prod(substrates, params, lp=lp)
     else:
-        limited = substrates.copy()
-        for idx, row in limited.iterrows():
-            limited.loc[idx] = _one_maximize_prod(row, params)
-        return limited
+        points = substrates[lp.indices].values
+        solutions = solve_lp_rows(lp, points, processes=processes)
+        limited = pd.DataFrame(
+            solutions.astype(points.dtype, copy=False),
+            index=substrates.index, columns=lp.indices)
+        # Substrates without a biogas yield are not utilized
+        return limited.reindex(columns=substrates.columns, fill_value=0)
+
 
+LinearProgram = collections.namedtuple(
+    'LinearProgram', ['indices', 'c', 'A_ub', 'b_ub', 'amount_rows'])
 
-def _one_maximize_prod(substrates, params):
+
+def compile_lp(params):
+    """
+    Build the substrate blending problem solved by maximize_prod().
+
+    The constraint matrix only depends on the parameters, so it can be
+    reused for any number of substrate compositions. The substrate amounts
+    go into the rows amount_rows of b_ub.
+
+    Returns:
+        A LinearProgram.
+    """
     gas_yields = params['BIOGAS_YIELDS'].copy()
 
     biogas_yields = gas_yields.unstack().dropna()
@@ -312,7 +477,6 @@ def _one_maximize_prod(substrates, params):
     indices = biogas_yields.index
 
     biogas_yields = biogas_yields.values
-    point = substrates[indices].values
 
     # Used for constraints:
     vs_fracs = params['VS_FRACS'].unstack()[indices].values
@@ -335,10 +499,12 @@ def _one_maximize_prod(substrates, params):
         b_ub_values.append(b_val)
 
     # Substrate amount constraints
-    for i, amount in enumerate(point):
-        arr = np.zeros(len(point))
+    amount_rows = []
+    for i in range(len(indices)):
+        arr = np.zeros(len(indices))
         arr[i] = 1
-        add_le(arr, amount) # Less than available
+        amount_rows.append(len(A_ub_rows))
+        add_le(arr, 0) # Less than available (filled in when solving)
         add_le(-arr, 0) # More than zero
 
     # Lower DM limit
@@ -357,8 +523,30 @@ def _one_maximize_prod(substrates, params):
     add_le(-biogas_yields, -params['P_min'])
 
     A_ub = np.vstack(A_ub_rows)
-    b_ub = np.array(b_ub_values)
-    result = linprog(c, A_ub=A_ub, b_ub=b_ub)
+    b_ub = np.array(b_ub_values, dtype=float)
+
+    return LinearProgram(
+        indices=indices, c=c, A_ub=A_ub, b_ub=b_ub,
+        amount_rows=np.array(amount_rows))
+
+
+def solve_lp(lp, point):
+    """
+    Solve a compiled LinearProgram for one substrate composition.
+
+    Args:
+        lp: A LinearProgram from compile_lp().
+        point: Array of substrate amounts ordered like lp.indices.
+
+    Returns:
+        Array of utilized substrate amounts.
+    """
+    from scipy.optimize import linprog
+    # The LP is always solved in double precision.
+    point = np.asarray(point, dtype=np.float64)
+    b_ub = lp.b_ub.copy()
+    b_ub[lp.amount_rows] = point
+    result = linprog(lp.c, A_ub=lp.A_ub, b_ub=b_ub)
 
     # 0 : Optimization terminated successfully
     # 1 : Iteration limit reached
@@ -366,12 +554,59 @@ def _one_maximize_prod(substrates, params):
     # 3 : Problem appears to be unbounded
 
     if result['status'] == 0:
-        return pd.Series(index=indices, data=result['x'])
+        return result['x']
     elif result['status'] == 2:
-        return pd.Series(index=indices, data=0*point)
+        return 0*point
     else:
         raise RuntimeError('unexpected status')
 
+
+def _solve_lp_chunk(args):
+    lp, points = args
+    return np.array([solve_lp(lp, point) for point in points])
+
+
+def solve_lp_rows(lp, points, processes=1, chunksize=256):
+    """
+    Solve a compiled LinearProgram for each row of a 2D array.
+
+    Args:
+        lp: A LinearProgram from compile_lp().
+        points: Array with one substrate composition per row, with
+            columns ordered like lp.indices.
+        processes: Number of worker processes. None means one per CPU.
+        chunksize: Number of rows sent to a worker at a time.
+
+    Returns:
+        Array of utilized substrate amounts, same shape as points.
+    """
+    points = np.asarray(points)
+    if len(points) == 0:
+        return np.zeros((0, len(lp.indices)))
+
+    chunks = [
+        (lp, points[i:i+chunksize])
+        for i in range(0, len(points), chunksize)]
+
+    if processes == 1 or len(chunks) == 1:
+        solutions = instrument.progress(
+            map(_solve_lp_chunk, chunks), 'LP rows', len(points), size=len)
+        return np.vstack(list(solutions))
+
+    with multiprocessing.Pool(processes) as pool:
+        solutions = instrument.progress(
+            pool.imap(_solve_lp_chunk, chunks), 'LP rows', len(points),
+            size=len)
+        solutions = list(solutions)
+    return np.vstack(solutions)
+
+
+def _one_maximize_prod(substrates, params, lp=None):
+    if lp is None:
+        lp = compile_lp(params)
+    point = substrates[lp.indices].values
+    return pd.Series(index=lp.indices, data=solve_lp(lp, point))
+
 def biogas_prod(substrates, params):
     """
     Unconstrained production of biogas from substrates.
@@ -383,27 +618,36 @@ def biogas_prod(substrates, params):
 
     Args:
         substrates: either a DataFrame with one substrate set per row,
-            or a Series with a substrate set
+            or a Series with a substrate set. A float32 DataFrame is
+            multiplied in float32, but the production is float64.
     """
-    prod = substrates * params['BIOGAS_YIELDS'].unstack().dropna()
+    yields = params['BIOGAS_YIELDS'].unstack().dropna()
+    if isinstance(substrates, pd.DataFrame):
+        dtype = np.result_type(*substrates.dtypes)
+        if dtype != yields.dtype:
+            yields = yields.astype(dtype)
+    prod = substrates * yields
     if isinstance(prod, pd.DataFrame):
-        return prod.sum(axis=1)
+        return prod.sum(axis=1).astype(np.float64, copy=False)
     else:
         return prod.sum()
 
-def utilized_substrates(sampling, params):
-    substrates = get_sample_substrates(sampling, params)
+def utilized_substrates(sampling, params, dtype=None):
+    substrates = get_sample_substrates(sampling, params, dtype=dtype)
     substrates = substrates.xs(params['RADIUS'], level='r')
-    substrates = maximize_prod(substrates, params)
+    with instrument.span('maximize_prod', rows=len(substrates)):
+        substrates = maximize_prod(substrates, params)
     return substrates
 
 def overall_limit(sampling, params):
     substrates = utilized_substrates(sampling, params)
-    actual = biogas_prod(substrates.sum(), params)
+    coarse = coarse_samples(substrates.index, sampling)
+    actual = biogas_prod(substrates[coarse].sum(), params)
 
     unlimited_substrates = get_sample_substrates(sampling, params).xs(
         params['RADIUS'], level='r')
-    benchmark = biogas_prod(unlimited_substrates.sum(), params)
+    coarse = coarse_samples(unlimited_substrates.index, sampling)
+    benchmark = biogas_prod(unlimited_substrates[coarse].sum(), params)
 
     return actual / benchmark
 
@@ -417,6 +661,182 @@ def total_potential(sampling, params):
     return P_theoretical * overall_limit(sampling, params)
 
 
+def evaluate_radii(sampling, params, processes=1, dtype=None):
+    """
+    Evaluate the potential for all sampled radii in one pass.
+
+    The sample substrates are computed once for all radii and the
+    blending LP is compiled once, instead of once per radius as when
+    calling total_potential() with different params['RADIUS']. Like
+    overall_limit(), the totals are over coarse_samples().
+
+    Args:
+        sampling: The name of the sampling settings.
+        params: The parameters. params['RADIUS'] is ignored.
+        processes: Number of worker processes for the LP stage.
+            None means one per CPU. Default 1.
+        dtype: Optional dtype of the sample substrates, see
+            get_sample_substrates(). The totals are summed in float64.
+
+    Returns:
+        A DataFrame with rows: radii (km) and columns: total_potential (MW)
+        and overall_limit, and a Series with the optimized biogas
+        production (MW) of each sample, indexed (x, y, r).
+    """
+    substrates = get_sample_substrates(sampling, params, dtype=dtype)
+    return _evaluate_substrates(substrates, sampling, params, processes)
+
+
+def _evaluate_substrates(substrates, sampling, params, processes=1):
+    """evaluate_radii() from already computed sample substrates."""
+    utilized = maximize_prod(substrates, params, processes=processes)
+
+    production = biogas_prod(utilized, params)
+    benchmark = biogas_prod(substrates, params)
+
+    coarse = coarse_samples(production.index, sampling)
+    limits = (
+        production[coarse].groupby(level='r').sum() /
+        benchmark[coarse].groupby(level='r').sum())
+
+    P_theoretical = biogas_prod(total_available(params, basis='VS'), params)
+
+    table = pd.DataFrame({
+        'total_potential': P_theoretical * limits,
+        'overall_limit': limits})
+    table.index.name = 'r'
+
+    return table, production
+
+
+# Largest accepted relative difference between the float32 and float64
+# totals, see compare_precision(). The inputs (e.g. the GLW densities and
+# Eurostat averages) are far less accurate than this.
+PRECISION_TOLERANCE = 1e-4
+
+def compare_precision(sampling, params, tolerance=PRECISION_TOLERANCE,
+                      processes=1):
+    """
+    Compare evaluate_radii() in float32 with float64.
+
+    The fractions are read once, and the sample substrates are made and
+    evaluated once in each precision.
+
+    Returns:
+        A dict with the dtype of the fractions as stored, the float64 and
+        float32 total potential and overall limit of each radius and their
+        relative differences, the largest relative difference of the
+        totals, the largest difference of sample production relative to
+        the largest sample production, the memory (bytes) of the sample
+        substrates in each precision, the tolerance and whether the totals
+        are within it (passed). Where the float64 value is 0 (e.g. a
+        radius where no sample is feasible), the absolute difference is
+        used instead of the relative one. Values which are not finite are
+        None.
+
+    Raises:
+        ValueError if the fractions are not stored in float64 (sampled with
+        --precision float32), since the float64 results would then only
+        be upcast float32 results.
+    """
+    with instrument.span('get_sample_fracs'):
+        fracs = get_sample_fracs(sampling)
+    fracs_dtypes = sorted(set(str(dtype) for dtype in fracs.dtypes))
+    if fracs_dtypes != ['float64']:
+        raise ValueError(
+            'the fractions of {} are {}, not float64; sample with '
+            '--precision float64 to compare precisions'.format(
+                sampling, ', '.join(fracs_dtypes)))
+
+    tables = {}
+    productions = {}
+    memory = {}
+    for dtype in ('float64', 'float32'):
+        substrates = _sample_substrates(
+            fracs.astype(dtype), params, dtype=dtype)
+        memory[dtype] = int(substrates.memory_usage(index=False).sum())
+        tables[dtype], productions[dtype] = _evaluate_substrates(
+            substrates, sampling, params, processes=processes)
+        del substrates
+
+    double, single = tables['float64'], tables['float32']
+    differences = _relative_difference(single, double)
+    # A total which is undefined (e.g. overall limit with no substrates) in
+    # both precisions agrees; in only one of them it does not
+    differences[double.isnull() & single.isnull()] = 0
+    differences[double.isnull() != single.isnull()] = np.inf
+    radii = collections.OrderedDict()
+    for r in double.index:
+        radii[str(r)] = {
+            column: {
+                'float64': _json_float(double.loc[r, column]),
+                'float32': _json_float(single.loc[r, column]),
+                'relative_difference': _json_float(
+                    differences.loc[r, column]),
+            }
+            for column in double.columns}
+
+    production = productions['float64']
+    sample_difference = (productions['float32'] - production).abs().max()
+    largest = production.abs().max()
+    if largest > 0:
+        sample_difference /= largest
+    max_difference = float(differences.values.max())
+
+    return {
+        'sampling': sampling,
+        'fracs_dtype': fracs_dtypes[0],
+        'tolerance': tolerance,
+        'radii': radii,
+        'max_relative_difference': _json_float(max_difference),
+        'max_sample_difference': _json_float(sample_difference),
+        'substrates_bytes': memory,
+        'passed': bool(max_difference < tolerance),
+    }
+
+
+def _relative_difference(value, reference):
+    """|value - reference| / |reference|, or |value - reference| where the
+    reference is 0."""
+    difference = np.abs(value - reference)
+    scale = np.abs(reference)
+    return difference / np.where(scale == 0, 1, scale)
+
+
+def _json_float(value):
+    """A float, or None if not finite, which JSON cannot hold."""
+    value = float(value)
+    return value if np.isfinite(value) else None
+
+
+def coarse_samples(index, sampling):
+    """
+    Which samples are on the starting grid of a sampling.
+
+    An adaptive grid (--min-step) has more samples where it is refined,
+    so summing all samples would weight the refined areas more. Its
+    starting grid, at --step, covers the area evenly and is always part
+    of it (see sample.adaptive_points()), so overall statistics are taken
+    over those samples only. For other grids all samples are used.
+
+    Args:
+        index: An index with levels x and y (m).
+        sampling: The name of the sampling settings.
+
+    Returns:
+        A boolean array like index.
+    """
+    settings = read_sampling_settings(sampling)
+    if settings['min_step'] is None:
+        return np.ones(len(index), dtype=bool)
+    step = settings['step'] * constants.M_PER_KM
+    coarse = np.ones(len(index), dtype=bool)
+    for level in ('x', 'y'):
+        units = np.asarray(index.get_level_values(level), dtype=float) / step
+        coarse &= np.abs(units - np.round(units)) < 1e-6
+    return coarse
+
+
 def read_sampling_settings(sampling):
     with open('sampling-settings/{}'.format(sampling), 'r') as f:
         settings_string = f.read()
@@ -427,147 +847,443 @@ def read_sampling_settings(sampling):
             re.search(r'--radii\s+(?P<radii>[0-9\.,]+)', settings_string)
             .group('radii')
             .split(',')]
+    min_step = re.search(
+        '--min-step\s+(?P<min_step>\d+(\.\d+)?)', settings_string)
+    if min_step is not None:
+        min_step = float(min_step.group('min_step'))
+    lattice = re.search('--lattice\s+(?P<lattice>\w+)', settings_string)
+    lattice = 'square' if lattice is None else lattice.group('lattice')
 
-    return {'step': step, 'radii': radii}
+    return {
+        'step': step, 'radii': radii, 'min_step': min_step,
+        'lattice': lattice}
 
 
-def _save_raster_from_points(series, path, nodata=None, sampling='default'):
+def _save_raster_from_points(series, path, nodata=None, sampling='default',
+                             output=None):
+    """
+    Save values at sample centers to a raster.
+
+    Args:
+        series: A Series indexed (x, y), or a DataFrame indexed (x, y)
+            with one column per raster band.
+        output: Optional dict of keyword arguments to
+            spatial_util.open_raster_output() (layout, compression, etc.).
+    """
+    import biogasrm.spatial_util as spatial_util
     if nodata is None:
         nodata = -1
     settings = read_sampling_settings(sampling)
-    arr, transform = spatial_util.make_raster_array(
-        series.to_dict(),
-        settings['step'] * constants.M_PER_KM,
-        nodata=nodata,
-        dtype=series.dtype)
-
-    # Same as CLC2006 (yeah, we are assuming A LOT about the data here...)
-    crs = 'EPSG:3035'
-
-    spatial_util.write_raster(path, arr, transform, crs)
-
-
-def _make_substrate_raster(substrate, dst_path, removal_rate, basis='DM'):
+    step = settings['step'] * constants.M_PER_KM
+    x = series.index.get_level_values('x')
+    y = series.index.get_level_values('y')
+    values = series.values
+
+    if settings['lattice'] == 'hex':
+        # Hexagonal lattice: fill in a square grid with the same step from
+        # the nearest sample, as far as the farthest point from any sample
+        # (the same as for the square lattice, see sample.hex_spacing()).
+        x, y, values = spatial_util.resample_nearest(
+            x, y, values, step, max_distance=step / math.sqrt(2))
+    elif settings['min_step'] is not None:
+        # Adaptive grid: fill in the finest grid from the nearest sample,
+        # up to the corner of a coarsest cell.
+        x, y, values = spatial_util.resample_nearest(
+            x, y, values, settings['min_step'] * constants.M_PER_KM,
+            max_distance=step / math.sqrt(2))
+        step = settings['min_step'] * constants.M_PER_KM
+
+    arr, transform = spatial_util.points_to_raster_array(
+        x, y, values, step, nodata=nodata)
+
+    if isinstance(series, pd.DataFrame):
+        # Missing values in some bands but not in others
+        arr = np.ma.masked_where(np.isnan(arr.data), arr)
+        arr.fill_value = nodata
+
+    with instrument.span('write raster'):
+        spatial_util.write_raster(
+            path, arr, transform, SAMPLE_RASTER_CRS, output=output)
+
+
+# Bytes per pixel used by _make_substrate_raster() (labels, a density
+# with its mask and one float64 band at a time, with temporaries)
+SUBSTRATE_BYTES_PER_PIXEL = 40
+
+def _make_substrate_raster(substrates, dst_path, removal_rate, basis='DM',
+                           window_size=None, memory_budget=None, output=None):
     """
-    Make a raster with the same extent and CRS as the CLC raster,
+    Make a raster with the same extent and CRS as the density rasters,
     but with each cell containing the number of dry metric tonnes
     of a substrate.
 
+    Each requested substrate is written as one band of the output. The
+    regions are rasterized and multiplied with the density rasters window
+    by window, so each density raster is read once regardless of how many
+    substrates are distributed like it. If the density rasters have
+    different resolutions, the output has the finest one.
+
     Args:
-        substrate: A tuple like ('cropland', 'straw') to identify the
-            desired substrate. Possible values can be seen by calling
+        substrates: A tuple like ('cropland', 'straw') to identify the
+            desired substrate, or a list of such tuples to make one band
+            per substrate. Possible values can be seen by calling
             get_substrates() and checking the columns.
         dst_path: Where to put the file. May not exist.
         removal_rate: A number between 0 and 1 to indicate how large
             portion of residues may be removed from fields.
         basis: 'DM' to express amounts as dry matter. 'VS' to express as VS.
+        window_size: The height and width in pixels of the windows
+            processed at a time. Default: fitting memory_budget.
+        memory_budget: MB of raster data to process at a time.
+        output: Optional dict of keyword arguments to
+            spatial_util.open_raster_output() (layout, compression, etc.).
 
     """
+    import rasterio
+    import biogasrm.spatial_util as spatial_util
 
     if os.path.exists(dst_path):
         raise ValueError('Path {} already exists!'.format(dst_path))
     if not (0 <= removal_rate <= 1):
         raise ValueError('Removal rate must be between 0 and 1.')
 
+    if isinstance(substrates, tuple):
+        substrates = [substrates]
+    substrates = list(substrates)
 
-    raster_name = substrate[0]
-    density_template_path = 'outdata/{}.tif'.format(raster_name)
-
-    with open('outdata/regional_sums/{}.json'.format(raster_name), 'r') as f:
-        regional_sums = json.loads(f.read())
-        regional_sums = pd.Series(regional_sums)
+    if window_size is None:
+        window_size = spatial_util.window_size_for_budget(
+            memory_budget, bytes_per_pixel=SUBSTRATE_BYTES_PER_PIXEL)
 
     params = parameters.defaults()
     params['REMOVAL_RATE'] = removal_rate
 
-    amounts = get_substrates(params, basis=basis)[substrate]
-    colname = 'substrate'
-    amounts_per_raster_unit = amounts / regional_sums
-    amounts_per_raster_unit[regional_sums[regional_sums == 0].index] = 0
-    amounts_per_raster_unit.dropna(inplace=True)
-    amounts_per_raster_unit = pd.DataFrame({colname: amounts_per_raster_unit})
+    amounts = get_substrates(params, basis=basis)
+
+    keys, geometries = spatial_util.read_regions(INCLUDED_NUTS_PATH, 'NUTS_ID')
+    bounds = [g.bounds for g in geometries]
+
+    # One lookup table (region index --> amount per raster unit) per band
+    lookups = []
+    for substrate in substrates:
+        raster_name = substrate[0]
+        regional_sums = store.read_table(
+            'regional_sums',
+            'outdata/regional_sums/{}.json'.format(raster_name),
+            column=raster_name)
 
-    tempdir = tempfile.mkdtemp()
-    region_substrates_path = os.path.join(tempdir, 'substrates.geojson')
-    temp_raster_path = os.path.join(tempdir, 'substrate.tif')
+        amounts_per_raster_unit = amounts[substrate] / regional_sums
+        amounts_per_raster_unit[regional_sums[regional_sums == 0].index] = 0
+        lookups.append(amounts_per_raster_unit.reindex(keys).values)
+
+    densities = []
+    for raster_name, _ in substrates:
+        if raster_name not in densities:
+            densities.append(raster_name)
+
+    templates = {
+        raster_name: rasterio.open('outdata/{}.tif'.format(raster_name))
+        for raster_name in densities}
 
     try:
-        spatial_util.write_data_to_regions(
-            src_path=INCLUDED_NUTS_PATH,
-            dst_path=region_substrates_path,
-            key_property='NUTS_ID',
-            data=amounts_per_raster_unit)
-
-        rasterize_command = (
-            'rio rasterize --like {template} '
-            '--property {property_name} --fill {fill} '
-            '-o {dst} {region_substrates_path}'
-            .format(
-                template=density_template_path,
-                property_name=colname,
-                fill=-1, # nodata
-                dst=temp_raster_path,
-                region_substrates_path=region_substrates_path).split(' '))
-
-        result = check_call(rasterize_command)
-        assert 0 == result, 'Rasterization failed!'
-
-        multiply_command = ([
-            'rio', 'calc', '(* (read 1) (read 2))',
-            '-o', dst_path,
-            density_template_path, temp_raster_path])
-
-        result = check_call(multiply_command)
-        assert 0 == result, 'Raster multiplication failed!'
+        # The output is on the finest grid. Coarser densities (e.g., the
+        # livestock rasters at their native resolution) are resampled to
+        # it, scaled by the ratio of pixel areas.
+        first = min(
+            (templates[name] for name in densities),
+            key=spatial_util.pixel_area)
+        scales = {}
+        for raster_name, template in templates.items():
+            if template.crs != first.crs:
+                raise ValueError(
+                    'Density rasters {} and {} have different CRS'.format(
+                        first.name, raster_name))
+            scales[raster_name] = (
+                spatial_util.pixel_area(first) /
+                spatial_util.pixel_area(template))
 
+        nodata = -1
+        profile = first.profile
+        for key in ('tiled', 'blockxsize', 'blockysize', 'compress',
+                    'predictor', 'interleave', 'photometric'):
+            profile.pop(key, None)
+        # Substrate densities in float32 whatever the density rasters are,
+        # so integer (e.g. livestock count) inputs keep fractions and the -1
+        # nodata
+        profile.update(
+            driver='GTiff', count=len(substrates), dtype='float32',
+            nodata=nodata)
+
+        output = output or {}
+        sparse = output.get('sparse', False)
+
+        with spatial_util.open_raster_output(
+                dst_path, profile, **output) as dst:
+            for bidx, (raster_name, substrate) in enumerate(substrates, 1):
+                dst.update_tags(bidx, density=raster_name, substrate=substrate)
+
+            windows = spatial_util.iter_windows(
+                first.height, first.width, window_size)
+            total = spatial_util.window_count(
+                first.height, first.width, window_size)
+            for window in instrument.progress(windows, 'raster blocks', total):
+                transform = first.window_transform(window)
+                shape = tuple(stop - start for start, stop in window)
+                labels = spatial_util.label_window(
+                    geometries, transform, shape, bounds=bounds)
+                outside = labels < 0
+
+                for raster_name in densities:
+                    template = templates[raster_name]
+                    if spatial_util.same_grid(template, first):
+                        density = template.read(1, window=window, masked=True)
+                    else:
+                        density = spatial_util.read_nearest(
+                            template, transform, shape, indexes=1)
+                    if scales[raster_name] != 1:
+                        density = density * scales[raster_name]
+                    invalid = outside | np.ma.getmaskarray(density)
+                    for bidx, substrate in enumerate(substrates, 1):
+                        if substrate[0] != raster_name:
+                            continue
+                        values = lookups[bidx-1][labels] * density.filled(0)
+                        values[invalid | np.isnan(values)] = nodata
+                        if sparse and (values == nodata).all():
+                            continue # Leave the block empty
+                        dst.write(
+                            values.astype(profile['dtype']),
+                            indexes=bidx, window=window)
     finally:
-        shutil.rmtree(tempdir)
+        for template in templates.values():
+            template.close()
+
 
+# Bytes per output pixel used by _make_biogas_raster() (the fractions and
+# substrates of a sample in each of its regions, with temporaries, and the
+# LP results)
+BIOGAS_BYTES_PER_PIXEL = 8192
 
-def _make_biogas_raster(dst_path, sampling='default'):
+def _make_biogas_raster(dst_path, sampling='default', output=None,
+                        memory_budget=None, processes=1, dtype='float64'):
     """
     Make a raster with biogas potentials based on a sampling. The cells
     contain the average biogas production density (in MW/km^2) that would
     result within the default collection distance if a biogas plant would be
     placed in the middle of the cell.
 
+    The raster is made in bands of rows: only the samples of a band are
+    given substrates and optimized before the band is written, so the
+    memory use is bounded by the band size (set by memory_budget) rather
+    than by the number of samples. If the fractions are in the datastore,
+    only the sample centers are kept for the whole raster and the
+    fractions of each band are read by its bounding box. Otherwise they
+    are read from the pickles at once.
+
     Args:
         dst_path: Where to put the file. May not exist.
         sampling: The name of the sampling settings.
+        output: Optional dict of keyword arguments to
+            spatial_util.open_raster_output() (layout, compression, etc.).
+        memory_budget: MB to process at a time.
+        processes: Number of worker processes for the LP stage.
+        dtype: The dtype of the fractions, substrates and raster, e.g.
+            'float32'.
 
     """
+    import rasterio.crs
+    import biogasrm.spatial_util as spatial_util
 
     if os.path.exists(dst_path):
         raise ValueError('Path {} already exists!'.format(dst_path))
 
     params = parameters.defaults()
-    substrates = get_sample_substrates(sampling, params)
+    radius = params['RADIUS']
+
+    # The sample centers, ordered like the index of utilized_substrates()
+    stored = store.use_samples(
+        sampling, 'fracs', _sample_fracs_paths(sampling))
+    with instrument.span('get_sample_fracs'):
+        if stored:
+            centers = _stored_sample_centers(sampling, radius)
+        else:
+            fracs = get_sample_fracs(sampling, dtype=dtype)
+            fracs = fracs[fracs.index.get_level_values('r') == radius]
+            centers = fracs.groupby(level=['x', 'y']).size().index
+    if not len(centers):
+        raise ValueError('radius {} is not sampled in {}'.format(
+            radius, sampling))
+    region_substrates = get_substrates(params).astype(dtype)
+    lp = compile_lp(params)
+
+    x = centers.get_level_values('x').values
+    y = centers.get_level_values('y').values
+
+    # The raster cells and the sample each is taken from, as in
+    # _save_raster_from_points()
+    settings = read_sampling_settings(sampling)
+    step = settings['step'] * constants.M_PER_KM
+    cell_x, cell_y, cell_sample = x, y, np.arange(len(x))
+    if settings['lattice'] == 'hex' or settings['min_step'] is not None:
+        if settings['lattice'] != 'hex':
+            step = settings['min_step'] * constants.M_PER_KM
+        cell_x, cell_y, cell_sample = spatial_util.resample_nearest(
+            x, y, cell_sample, step,
+            max_distance=settings['step'] * constants.M_PER_KM / math.sqrt(2))
+    rows, cols, shape, transform = spatial_util.points_grid(
+        cell_x, cell_y, step)
+
+    nodata = -1
+    profile = dict(
+        driver='GTiff', crs=rasterio.crs.CRS.from_string(SAMPLE_RASTER_CRS),
+        transform=transform,
+        width=shape[1], height=shape[0], count=1, dtype=dtype,
+        nodata=nodata)
+    output = output or {}
+    sparse = output.get('sparse', False)
+
+    band_rows = spatial_util.band_height_for_budget(
+        memory_budget, shape[1], bytes_per_pixel=BIOGAS_BYTES_PER_PIXEL)
+    order = np.argsort(rows, kind='mergesort')
+    rows, cols, cell_sample = rows[order], cols[order], cell_sample[order]
+
+    # The first and last row of the cells of each sample (more than one on
+    # resampled grids)
+    sample_first = np.full(len(x), shape[0])
+    np.minimum.at(sample_first, cell_sample, rows)
+    sample_last = np.full(len(x), -1)
+    np.maximum.at(sample_last, cell_sample, rows)
+    spread = max(int((sample_last - sample_first).max()), 0)
+
+    def center_ids(data):
+        return centers.get_indexer(pd.MultiIndex.from_arrays(
+            [data.index.get_level_values('x'),
+             data.index.get_level_values('y')]))
+
+    if stored:
+        sample_order = np.argsort(sample_first, kind='mergesort')
+        sorted_first = sample_first[sample_order]
+
+        def band_fracs(r0, r1):
+            # Samples with cells in the band start at most spread rows
+            # before it
+            start, stop = np.searchsorted(sorted_first, [r0 - spread, r1])
+            ids = sample_order[start:stop]
+            ids = ids[sample_last[ids] >= r0]
+            data = get_sample_fracs(
+                sampling, dtype=dtype,
+                bbox=(x[ids].min(), y[ids].min(), x[ids].max(), y[ids].max()))
+            data = data[data.index.get_level_values('r') == radius]
+            return data[np.in1d(center_ids(data), ids)]
+    else:
+        # The fractions are sorted by the first row of their sample, so
+        # that the fractions of a band are a slice of them
+        frac_centers = center_ids(fracs)
+        frac_first = sample_first[frac_centers]
+        order = np.argsort(frac_first, kind='mergesort')
+        fracs = fracs.iloc[order]
+        frac_first = frac_first[order]
+        frac_last = sample_last[frac_centers][order]
+
+        def band_fracs(r0, r1):
+            start, stop = np.searchsorted(frac_first, [r0 - spread, r1])
+            return fracs.iloc[start:stop][frac_last[start:stop] >= r0]
+
+    with spatial_util.open_raster_output(dst_path, profile, **output) as dst:
+        bands = spatial_util.iter_row_bands(shape[0], shape[1], band_rows)
+        total = -(-shape[0] // band_rows)
+        for window in instrument.progress(bands, 'raster bands', total):
+            (r0, r1), _ = window
+            values = np.full((r1 - r0, shape[1]), nodata, dtype=dtype)
+            first, last = np.searchsorted(rows, [r0, r1])
+            if first < last:
+                biogas = _biogas_density(
+                    band_fracs(r0, r1), region_substrates, params, lp,
+                    processes=processes)
+                biogas = biogas.reindex(pd.MultiIndex.from_arrays(
+                    [x[cell_sample[first:last]], y[cell_sample[first:last]]]))
+                # Samples without substrates are left out, as in
+                # utilized_substrates()
+                values[rows[first:last] - r0, cols[first:last]] = (
+                    biogas.fillna(nodata).values)
+            elif sparse:
+                continue # Leave the band empty
+            dst.write(values[np.newaxis], window=window)
+
+
+def _biogas_density(fracs, region_substrates, params, lp, processes=1):
+    """
+    Optimized biogas production density (MW/km^2) of some samples.
 
-    # Biogas amounts (MW in a point)
-    biogas = biogas_prod(utilized_substrates(sampling, params), params)
+    Args:
+        fracs: Sample fractions at params['RADIUS'].
+        region_substrates: Substrate amounts by region (VS).
+        lp: The LinearProgram of params.
 
-    # Convert to MW/km^2
-    biogas /= math.pi * (params['RADIUS'] ** 2)
+    Returns:
+        A Series indexed (x, y).
+    """
+    substrates = _distribute_substrates(fracs, region_substrates)
+    substrates = substrates.xs(params['RADIUS'], level='r')
+    # Substrates missing in these samples are zero, as in
+    # get_sample_substrates()
+    points = substrates.reindex(columns=lp.indices).fillna(0).values
+    utilized = pd.DataFrame(
+        solve_lp_rows(lp, points, processes=processes),
+        index=substrates.index, columns=lp.indices)
+    biogas = biogas_prod(utilized, params)
+    return biogas / (math.pi * (params['RADIUS'] ** 2))
+
+
+def _make_radii_raster(dst_path, production, sampling='default', output=None,
+                       dtype=None):
+    """
+    Make a raster like _make_biogas_raster() but with one band per radius.
 
-    _save_raster_from_points(biogas, dst_path, nodata=None, sampling=sampling)
+    Args:
+        dst_path: Where to put the file. May not exist.
+        production: Biogas production (MW) indexed (x, y, r), as returned
+            by evaluate_radii().
+        sampling: The name of the sampling settings.
+        output: Optional dict of keyword arguments to
+            spatial_util.open_raster_output() (layout, compression, etc.).
+        dtype: Optional dtype of the raster, e.g. 'float32'.
+
+    """
+
+    if os.path.exists(dst_path):
+        raise ValueError('Path {} already exists!'.format(dst_path))
+
+    # Convert to MW/km^2, one column per radius
+    biogas = production.unstack('r')
+    biogas = biogas.div(
+        [math.pi * (r ** 2) for r in biogas.columns], axis=1)
+    if dtype is not None:
+        biogas = biogas.astype(dtype)
+
+    _save_raster_from_points(
+        biogas, dst_path, nodata=None, sampling=sampling, output=output)
 
 
 @click.group()
+@instrument.profile_options
 def cli():
     pass
 
-default_removal_rate = parameters.defaults()['REMOVAL_RATE']
-
 @cli.command()
 @click.argument('density', type=str)
 @click.argument('substrate', type=str)
 @click.argument('dst_path', '-o', type=click.Path())
 @click.option('--removal-rate', '-r', type=float,
-    help='Residue removal rate. Default {}.'.format(default_removal_rate),
-    default=default_removal_rate)
+    help='Residue removal rate. Default {}.'.format(parameters.DEFAULT_REMOVAL_RATE),
+    default=parameters.DEFAULT_REMOVAL_RATE)
 @click.option('--basis', '-b', type=click.Choice(['DM', 'VS']),
     help='DM or VS basis?')
-def make_substrate_raster(density, substrate, dst_path, removal_rate, basis):
+@click.option('--band', '-a', type=(str, str), multiple=True,
+    help='Another density and substrate to add as a band. May be repeated.')
+@raster_options.raster_output_options
+@raster_options.memory_budget_option
+def make_substrate_raster(density, substrate, dst_path, removal_rate, basis,
+                          band, raster_output, memory_budget):
     """Rasterize a substrate density.
 
     Args:
@@ -588,20 +1304,31 @@ def make_substrate_raster(density, substrate, dst_path, removal_rate, basis):
             (including for use as bedding).
         basis: "VS" or "DM" to get the results as Mg VS / year or
         as Mg DM / year (per raster cell).
+        band: More (density, substrate) pairs, written as bands 2, 3, ...
+            of the same raster.
+        memory_budget: MB of raster data to process at a time.
 
     """
 
     _make_substrate_raster(
-        (density, substrate), dst_path, removal_rate, basis=basis)
+        [(density, substrate)] + list(band),
+        dst_path, removal_rate, basis=basis, memory_budget=memory_budget,
+        output=raster_output)
 
 @cli.command()
 @click.argument('dst_path', '-o', type=click.Path())
 @click.argument('sampling', '-s', type=str, default='default')
-def make_biogas_raster(dst_path, sampling):
+@click.option('--processes', '-p', type=int, default=1,
+    help='Number of worker processes. Default 1.')
+@raster_options.raster_output_options
+@raster_options.memory_budget_option
+@raster_options.precision_option
+def make_biogas_raster(dst_path, sampling, processes, raster_output,
+                       memory_budget, precision):
     """Rasterize the biogas potential based on a sample of points.
 
     The resulting raster expresses the local biogas potential density
-    in MW/km^2.
+    in MW/km^2. It is made in bands of rows fitting the memory budget.
 
     Args:
         dst_path: The path where to put the resulting raster.
@@ -609,4 +1336,200 @@ def make_biogas_raster(dst_path, sampling):
 
     """
 
-    _make_biogas_raster(dst_path, sampling)
+    _make_biogas_raster(
+        dst_path, sampling, output=raster_output,
+        memory_budget=memory_budget, processes=processes, dtype=precision)
+
+@cli.command()
+@click.argument('distributions', type=click.File('r'))
+@click.argument('dst', type=click.File('wb'))
+@click.option('--sampling', '-s', type=str, default='default',
+    help='The name of the sampling settings.')
+@click.option('--draws', '-n', type=int, default=100,
+    help='Number of parameter draws. Default 100.')
+@click.option('--seed', type=int, default=None,
+    help='Seed for the random number generator.')
+@click.option('--processes', '-p', type=int, default=None,
+    help='Number of worker processes. Default one per CPU.')
+def sensitivity(distributions, dst, sampling, draws, seed, processes):
+    """Monte Carlo sensitivity analysis of the total potential.
+
+    Writes a pickled DataFrame with total_potential, overall_limit and the
+    drawn parameter values for each draw.
+
+    Args:
+        distributions: A JSON file mapping parameter names to
+            distributions, e.g.
+            {"REMOVAL_RATE": {"dist": "uniform", "low": 0.3, "high": 0.5}}.
+            See biogasrm.sensitivity.draw_parameters().
+        dst: The path where to put the result.
+
+    """
+    import biogasrm.sensitivity
+
+    result = biogasrm.sensitivity.run(
+        sampling,
+        json.loads(distributions.read()),
+        draws=draws,
+        seed=seed,
+        processes=processes)
+
+    pickle.dump(result, dst)
+
+
+@cli.command()
+@click.argument('scenarios_file', type=click.File('r'))
+@click.argument('output_dir', type=click.Path(file_okay=False))
+@click.option('--sampling', '-s', type=str, default='default',
+    help='The name of the sampling settings.')
+@click.option('--processes', '-p', type=int, default=None,
+    help='Number of worker processes. Default one per CPU.')
+@click.option('--rasters', is_flag=True,
+    help='Also make a biogas raster for each scenario.')
+@raster_options.raster_output_options
+def scenarios(scenarios_file, output_dir, sampling, processes, rasters,
+              raster_output):
+    """Evaluate a batch of parameter scenarios.
+
+    Writes a table (CSV) with the total potential (MW) and overall limit
+    in total and per country for each scenario to OUTPUT_DIR, and a
+    summary of all scenarios to scenarios.csv. The inputs are loaded once
+    and shared by the worker processes.
+
+    Args:
+        scenarios_file: A JSON or YAML (*.yaml, *.yml) list of scenarios,
+            each a dict of overrides of scalar parameters with an optional
+            name, e.g. [{"name": "low", "REMOVAL_RATE": 0.2, "P_min": 2}].
+            See biogasrm.scenarios.read_scenarios().
+        output_dir: Where to write the tables (and rasters).
+        rasters: Also make a raster with the local biogas potential
+            density (MW/km^2) for each scenario.
+
+    """
+    import biogasrm.scenarios
+
+    biogasrm.scenarios.run(
+        sampling,
+        biogasrm.scenarios.read_scenarios(scenarios_file),
+        output_dir,
+        processes=processes,
+        rasters=rasters,
+        output=raster_output)
+
+
+@cli.command()
+@click.argument('sampling', type=str, default='default')
+@click.option('--output', '-o', type=click.File('w'), default='-',
+    help='Where to write the table (CSV). Default stdout.')
+@click.option('--raster', type=click.Path(), default=None,
+    help='Also make a biogas raster with one band per radius.')
+@click.option('--processes', '-p', type=int, default=1,
+    help='Number of worker processes. Default 1.')
+@raster_options.raster_output_options
+@raster_options.precision_option
+def radii(sampling, output, raster, processes, raster_output, precision):
+    """Evaluate the potential for all sampled radii.
+
+    Writes a table with the total potential (MW) and overall limit
+    for each radius.
+
+    Args:
+        sampling: The name of the sampling settings.
+        output: Where to write the table.
+        raster: Optional path for a raster with the local biogas potential
+            density (MW/km^2), one band per radius in ascending order.
+
+    """
+
+    params = parameters.defaults()
+    result, production = evaluate_radii(
+        sampling, params, processes=processes, dtype=precision)
+
+    if raster is not None:
+        _make_radii_raster(
+            raster, production, sampling=sampling, output=raster_output,
+            dtype=precision)
+
+    result.to_csv(output)
+
+
+@cli.command()
+@click.argument('sampling', type=str, default='default')
+@click.option('--output', '-o', type=click.File('w'), default='-',
+    help='Where to write the report (JSON). Default stdout.')
+@click.option('--tolerance', type=float, default=PRECISION_TOLERANCE,
+    help='Largest accepted relative difference of the totals. '
+         'Default {}.'.format(PRECISION_TOLERANCE))
+@click.option('--processes', '-p', type=int, default=1,
+    help='Number of worker processes. Default 1.')
+def precision_report(sampling, output, tolerance, processes):
+    """Compare the results in float32 and float64 precision.
+
+    Evaluates all sampled radii in both precisions and writes a report of
+    the totals, their relative differences and the memory of the sample
+    substrates. Exits with an error if a total differs by more than the
+    tolerance.
+
+    Args:
+        sampling: The name of the sampling settings.
+
+    """
+    try:
+        report = compare_precision(
+            sampling, parameters.defaults(), tolerance=tolerance,
+            processes=processes)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    json.dump(report, output, indent=2, allow_nan=False)
+    output.write('\n')
+    if not report['passed']:
+        raise click.ClickException(
+            'float32 totals differ by {:.3g} (tolerance {:.3g})'.format(
+                report['max_relative_difference'], tolerance))
+
+
+@cli.command()
+@click.argument('x', type=float)
+@click.argument('y', type=float)
+@click.argument('radius', type=float, required=False)
+def site(x, y, radius):
+    """Evaluate the potential at one plant site.
+
+    Writes a JSON object with the production (MW), production density
+    (MW/km^2) and utilized substrates (Mg VS / year).
+
+    Args:
+        x, y: The site in EPSG:3035 coordinates (m).
+        radius: The collection radius (km). Default the RADIUS parameter.
+
+    """
+    import biogasrm.sites
+
+    engine = biogasrm.sites.SiteEngine(parameters.defaults())
+    result = engine.query(x, y, radius)
+    engine.close()
+
+    click.echo(json.dumps({k: float(v) for k, v in result.items()}))
+
+
+@cli.command()
+@click.argument('src', type=click.File('r'))
+@click.argument('dst', type=click.File('w'), default='-')
+@click.option('--processes', '-p', type=int, default=1,
+    help='Number of worker processes. Default 1.')
+def sites(src, dst, processes):
+    """Evaluate the potential at many plant sites.
+
+    Args:
+        src: A CSV file with columns x and y (EPSG:3035, m) and
+            optionally r (km).
+        dst: Where to write the result (CSV). Default stdout.
+
+    """
+    import biogasrm.sites
+
+    engine = biogasrm.sites.SiteEngine(parameters.defaults())
+    result = engine.query_many(pd.read_csv(src), processes=processes)
+    engine.close()
+
+    result.to_csv(dst)
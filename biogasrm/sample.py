@@ -1,38 +1,82 @@
 # -*- coding: utf-8 -*-
 
 import os
+import contextlib
+import hashlib
 import logging
 from collections import OrderedDict
-from math import ceil
+from math import ceil, floor, log2, sqrt
 import json
 import pickle
 
 import click
-import fiona
-import rasterio
 import shapely
 from shapely.geometry import shape
-import shapely.prepared
-import shapely.ops
-from rasterstats import zonal_stats
 import pandas
+import numpy as np
 
 import biogasrm.constants as constants
+import biogasrm.instrument as instrument
+import biogasrm.raster_options as raster_options
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger(__name__)
 
+# Bytes per pixel used by spatial_util.lattice_sums() (the pixel's cell
+# row and column and masks)
+LATTICE_BYTES_PER_PIXEL = 48
+
+LATTICES = ('square', 'hex')
+
+# Tiled sampling, see plan
+MANIFEST_NAME = 'manifest.json'
+TILES_DIR = 'tiles'
+TILE_RECORD = 'tile.json'
+
+SAMPLES_SCHEMA = {
+    'geometry': 'Polygon',
+    'properties': OrderedDict(
+        [('NUTS_ID', 'str'),
+        ('x', 'float'),
+        ('y', 'float'),
+        ('r', 'float')])
+}
+
 @click.group()
+@instrument.profile_options
 def cli():
     pass
 
+def _sampling_options(command):
+    """Add the options for the sample grid, radii and regions to a command."""
+    options = [
+        click.option('--step', type=float, required=True),
+        click.option('--bbox', '-b', type=float, nargs=4, required=False,
+                     default=None),
+        click.option('--radii', type=str, required=True),
+        click.option('--min-step', type=float, default=None),
+        click.option('--tolerance', type=float, default=0.1),
+        click.option('--refine-by', type=raster_options.InputPath(),
+                     multiple=True),
+        click.option('--lattice', type=click.Choice(LATTICES),
+                     default='square'),
+        click.option('--prepared', type=click.Path(exists=True),
+                     default=None,
+                     help='Prepared regions made from the regions with '
+                          'prepare, to intersect the disks faster.'),
+    ]
+    for option in reversed(options):
+        command = option(command)
+    return command
+
 @cli.command()
-@click.argument('regions-path', type=click.Path(exists=True))
+@click.argument('regions-path', type=raster_options.InputPath())
 @click.argument('output', type=click.Path())
-@click.option('--step', type=float, required=True)
-@click.option('--bbox', '-b', type=float, nargs=4, required=False, default=None)
-@click.option('--radii', type=str, required=True)
-def disks(regions_path, output, step, bbox, radii):
+@_sampling_options
+@click.option('--reuse', type=click.Path(exists=True), default=None)
+@raster_options.memory_budget_option
+def disks(regions_path, output, step, bbox, radii, min_step, tolerance,
+          refine_by, lattice, prepared, reuse, memory_budget):
     """
     Sample disk-shaped areas in a map.
 
@@ -44,102 +88,912 @@ def disks(regions_path, output, step, bbox, radii):
             Multiple values are separated by commas: "10,20,30"
         bbox: Bounding box to restrict samples to. If None, the whole
             map will be covered.
+        reuse: Samples from an earlier run on the same regions (a
+            shapefile). Disks with the same (x, y, r) are copied from
+            there instead of being computed again.
+        min_step: Finest step size in km for an adaptive grid. If given,
+            sampling starts with step and cells are halved down to
+            min_step where the rasters in refine_by vary by more than
+            tolerance. See adaptive_points().
+        tolerance: Relative tolerance for refining the adaptive grid.
+        refine_by: Rasters (e.g., densities) to guide the refinement.
+        lattice: 'square' or 'hex'. The hexagonal lattice has the same
+            largest distance from any location to the nearest center as
+            the square one with the same step, with 23% fewer centers.
+            See hex_spacing().
+        prepared: Regions prepared from regions_path with prepare, which
+            may be simplified and cut into pieces to speed up the
+            intersections. See sampling_regions.SamplingRegions.
+        memory_budget: MB of raster data to read at a time when summing
+            the refine_by rasters.
     """
+    import fiona
 
     radii = [float(r) for r in radii.split(',')]
-    step = step * constants.M_PER_KM
+    regions = _read_sampling_regions(regions_path, prepared)
+    points, total = _sample_points(
+        regions, step, bbox, radii, min_step, tolerance, refine_by, lattice,
+        memory_budget)
+
+    old = None
+    if reuse:
+        old = fiona.open(reuse)
+        old_fids = _index_samples(old)
+        log.info('Reusing {} samples from {}'.format(len(old_fids), reuse))
 
-    with fiona.open(regions_path) as ds:
-        crs = ds.crs
-        driver = 'Shapefile'
-        regions = {r['properties']['NUTS_ID']: shape(r['geometry']) for r in ds}
-        prepared = {key: shapely.prepared.prep(shp) for key, shp in regions.items()}
+    reused = computed = 0
+    visited = set()
+    with fiona.open(output, 'w', driver='Shapefile', crs=regions.crs,
+                    schema=SAMPLES_SCHEMA) as dst:
+        for point in instrument.progress(points, 'points', total):
+            if not regions.prepared_union.contains(point):
+                continue
 
-    whole_area = shapely.ops.cascaded_union(regions.values())
+            for radius in radii:
+                key = sample_key(point.x, point.y, radius)
+                if old is not None and key in old_fids:
+                    for fid in old_fids[key]:
+                        f = old[fid]
+                        dst.write(dict(
+                            geometry=f['geometry'],
+                            properties=f['properties']))
+                    reused += 1
+                    continue
 
-    if not bbox:
-        bbox = whole_area.bounds
-    log.info('Bounds: {}'.format(bbox))
+                computed += 1
+                for f in _disk_features(point, radius, regions, visited):
+                    dst.write(f)
 
-    whole_area = shapely.prepared.prep(whole_area)
+    if old is not None:
+        old.close()
+        log.info(
+            'Reused {} and computed {} samples'.format(reused, computed))
 
-    schema = {
-        'geometry': 'Polygon',
-        'properties': OrderedDict(
-            [('NUTS_ID', 'str'),
-            ('x', 'float'),
-            ('y', 'float'),
-            ('r', 'float')])
-    }
 
+@cli.command()
+@click.argument('regions-path', type=raster_options.InputPath())
+@click.argument('output-dir', type=click.Path(file_okay=False))
+@_sampling_options
+@click.option('--density', 'densities', multiple=True, required=True,
+              type=(raster_options.InputPath(), click.Path(exists=True)),
+              help='A density raster and its regional sums (JSON). '
+                   'Repeat for each density.')
+@click.option('--polygons', type=click.Path(), default=None,
+              help='Also write the samples to this shapefile, like disks.')
+@raster_options.memory_budget_option
+@raster_options.precision_option
+def run(regions_path, output_dir, step, bbox, radii, min_step, tolerance,
+        refine_by, lattice, prepared, densities, polygons, memory_budget,
+        precision):
+    """
+    Sample disks and sum the densities within them in one pass.
+
+    Does what disks followed by sample_region_fracs for each density does,
+    without writing and reading back the sample polygons: the pieces of
+    each disk in the regions are summed over all the density rasters as
+    soon as they are made, and only the sums are kept.
+
+    Writes to output_dir:
+
+        sums.pkl: DataFrame of the density sums.
+            Rows: (x, y, r, NUTS_ID). Columns: densities.
+        <density>_fracs.pkl: Each sample's fraction of its region, as
+            written by sample_region_fracs.
+
+    Args:
+        regions_path: The NUTS regions.
+        output_dir: The sampling directory, e.g. outdata/sampling/default.
+        densities: (raster, regional sums) for each density. The density
+            names are the raster file names without extension.
+        polygons: Optional shapefile to also write the samples to, for
+            inspection. Not needed by the later steps.
+        memory_budget: MB of raster data to read at a time.
+        precision: The dtype of the fractions. The sums are float64.
+
+    The other arguments are as for disks.
+    """
+    names = _density_names(densities)
+    radii = [float(r) for r in radii.split(',')]
+    sums = _sample_sums(
+        regions_path, [raster for raster, _ in densities], names,
+        step, bbox, radii, min_step, tolerance, refine_by, lattice, prepared,
+        polygons, memory_budget)
+
+    os.makedirs(output_dir, exist_ok=True)
+    with open(os.path.join(output_dir, 'sums.pkl'), 'wb') as f:
+        pickle.dump(sums, f)
+    _write_fracs(sums, densities, output_dir, dtype=precision)
+
+
+@cli.command()
+@click.argument('regions-path', type=raster_options.InputPath())
+@click.argument('output', type=click.Path())
+@click.option('--cell-size', type=float, default=50,
+              help='Side (km) of the grid cells to cut the regions into. '
+                   'Default 50.')
+@click.option('--simplify', type=float, default=0,
+              help='Tolerance (m) to simplify the regions with. Default 0 '
+                   '(exact).')
+@click.option('--report', type=click.File('w'), default=None,
+              help='Write a comparison of simplified and exact areas '
+                   '(JSON) here.')
+def prepare(regions_path, output, cell_size, simplify, report):
+    """
+    Prepare the regions for sampling, to intersect the disks faster.
+
+    Saves the union of the regions, and the regions (simplified with
+    --simplify) cut into grid cells of --cell-size, to a pickle which
+    the sampling commands take with --prepared. Each disk is then only
+    intersected with the pieces of regions in the cells it overlaps,
+    instead of with whole regions.
+
+    Args:
+        regions_path: The NUTS regions.
+        output: Where to save the prepared regions.
+        cell_size: Side of the grid cells in km.
+        simplify: Simplification tolerance in map units (m). Simplified
+            regions give approximate samples; check the area report.
+        report: Optional file to write the area report to. See
+            sampling_regions.SamplingRegions.area_report().
+    """
+    import biogasrm.sampling_regions as sampling_regions
+
+    if cell_size <= 0 or simplify < 0:
+        raise ValueError(
+            'the cell size must be positive and the tolerance non-negative')
+
+    with instrument.span('prepare regions'):
+        regions = sampling_regions.SamplingRegions.from_file(
+            regions_path, cell_size=cell_size * constants.M_PER_KM,
+            tolerance=simplify)
+    regions.save(output)
+
+    area_report = regions.area_report()
+    log.info('Largest relative area error: {:.2g}'.format(
+        area_report['max_relative_error']))
+    if report is not None:
+        json.dump(area_report, report, indent=2)
+
+
+def _density_names(densities):
+    """The density names of (raster, regional sums) pairs."""
+    names = [
+        os.path.splitext(os.path.basename(raster))[0]
+        for raster, _ in densities]
+    if len(set(names)) < len(names):
+        raise ValueError('density rasters must have different file names')
+    return names
+
+
+def _sample_sums(regions_path, rasters, names, step, bbox, radii, min_step,
+                 tolerance, refine_by, lattice, prepared, polygons,
+                 memory_budget):
+    """
+    Sample disks and sum the density rasters within each disk and region.
+
+    Args:
+        rasters: Paths of the density rasters.
+        names: The density names, for the columns.
+        radii: The radii of disks in km.
+
+    The other arguments are as for run.
+
+    Returns: DataFrame.
+        Rows: (x, y, r, NUTS_ID). Columns: densities.
+    """
+    import fiona
+    import rasterio
+    import biogasrm.spatial_util as spatial_util
+
+    regions = _read_sampling_regions(regions_path, prepared)
+    points, total = _sample_points(
+        regions, step, bbox, radii, min_step, tolerance, refine_by, lattice,
+        memory_budget)
+    window_size = spatial_util.window_size_for_budget(memory_budget)
+
+    keys, sums = [], []
     visited = set()
-    with fiona.open(output, 'w', driver=driver, crs=crs, schema=schema) as dst:
-        for point in generate_points(step, step, bbox):
-            if not whole_area.contains(point):
+    with contextlib.ExitStack() as stack:
+        datasets = [
+            stack.enter_context(rasterio.open(raster)) for raster in rasters]
+        dst = None
+        if polygons is not None:
+            dst = stack.enter_context(fiona.open(
+                polygons, 'w', driver='Shapefile', crs=regions.crs,
+                schema=SAMPLES_SCHEMA))
+
+        for point in instrument.progress(points, 'points', total):
+            if not regions.prepared_union.contains(point):
                 continue
 
             for radius in radii:
-                disk = point.buffer(radius * constants.M_PER_KM)
-
-                candidates = (
-                    k for k, r in prepared.items() if r.intersects(disk))
-
-                intersections = {
-                    k: regions[k].intersection(disk)
-                    for k in candidates}
-
-                for key, intersection in intersections.items():
-                    if key not in visited:
-                        visited.add(key)
-                        log.info('Visiting {}'.format(key))
-                    if intersection.is_empty:
-                        continue
-                    f = dict(
-                        geometry=shapely.geometry.mapping(intersection),
-                        properties=dict(
-                            NUTS_ID=key,
-                            x=point.x,
-                            y=point.y,
-                            r=radius))
-                    dst.write(f)
+                pieces = list(_disk_intersections(
+                    point, radius, regions, visited))
+                if not pieces:
+                    continue
+                geometries = [intersection for _, intersection in pieces]
+                distance = radius * constants.M_PER_KM
+                bounds = (
+                    point.x - distance, point.y - distance,
+                    point.x + distance, point.y + distance)
+                columns = [
+                    [total for _, total in spatial_util.window_sums(
+                        dataset, geometries, bounds, window_size)]
+                    for dataset in datasets]
+
+                for (key, intersection), row in zip(pieces, zip(*columns)):
+                    keys.append((point.x, point.y, radius, key))
+                    sums.append(row)
+                    if dst is not None:
+                        dst.write(_sample_feature(
+                            point, radius, key, intersection))
+
+    sums = _sums_frame(keys, sums, names)
+    log.info('Summed {} densities in {} samples'.format(
+        len(names), len(sums)))
+    return sums
+
+
+def _sums_frame(keys, sums, names):
+    """A DataFrame of sums from lists of (x, y, r, NUTS_ID) and rows."""
+    index = pandas.MultiIndex.from_arrays(
+        list(zip(*keys)) or [[]] * 4, names=['x', 'y', 'r', 'NUTS_ID'])
+    return pandas.DataFrame(
+        np.array(sums, dtype=float).reshape(len(keys), len(names)),
+        index=index, columns=names)
+
+
+def _write_fracs(sums, densities, output_dir, dtype=None):
+    """
+    Write each sample's fraction of its region, as sample_region_fracs.
+
+    Args:
+        sums: DataFrame from _sample_sums().
+        densities: (raster, regional sums path) for each column of sums.
+        output_dir: Where to write <density>_fracs.pkl.
+        dtype: Optional dtype of the fractions, e.g. 'float32'.
+    """
+    for name, (_, region_sums_path) in zip(sums.columns, densities):
+        with open(region_sums_path, 'r') as f:
+            region_sums = pandas.Series(json.loads(f.read()))
+        sample_fracs = sums[name].rename('sum').divide(
+            region_sums, axis=0, level='NUTS_ID')
+        if dtype is not None:
+            sample_fracs = sample_fracs.astype(dtype)
+        path = os.path.join(output_dir, '{}_fracs.pkl'.format(name))
+        with open(path, 'wb') as f:
+            pickle.dump(sample_fracs, f)
+
+
+@cli.command()
+@click.argument('regions-path', type=raster_options.InputPath())
+@click.argument('output-dir', type=click.Path(file_okay=False))
+@_sampling_options
+@click.option('--density', 'densities', multiple=True, required=True,
+              type=(raster_options.InputPath(), click.Path(exists=True)),
+              help='A density raster and its regional sums (JSON). '
+                   'Repeat for each density.')
+@click.option('--tiles', 'n_tiles', type=int, required=True,
+              help='Number of tiles to split the sampling into.')
+def plan(regions_path, output_dir, step, bbox, radii, min_step, tolerance,
+         refine_by, lattice, prepared, densities, n_tiles):
+    """
+    Split a sampling run into tiles to be run as separate jobs.
+
+    Writes output_dir/manifest.json with the inputs, the sampling settings
+    and the tiles. Each tile is then run with tile, e.g. as one job each on
+    a batch cluster with the input files on a shared file system, and the
+    results are combined with merge. The result is the same as from run.
+
+    The tiles are strips of whole columns of the sample grid, so each
+    sample center is in exactly one tile. If there are more tiles than
+    columns, some tiles are empty. Adaptive grids (--min-step) are not
+    supported, since their refinement depends on the whole bbox.
+
+    The arguments are as for run.
+    """
+    if n_tiles < 1:
+        raise ValueError('the number of tiles must be positive')
+    if min_step is not None:
+        raise ValueError('tiled sampling does not support --min-step')
+    _density_names(densities)
+
+    if not bbox:
+        bbox = _read_sampling_regions(regions_path, prepared).union.bounds
+    xmin, ymin, xmax, ymax = bbox
+
+    # Tile borders halfway between grid columns, safe from rounding
+    dx = step * constants.M_PER_KM
+    if lattice == 'hex':
+        # Every other row is shifted half a spacing
+        dx = hex_spacing(dx) / 2
+    columns = np.arange(ceil(xmin / dx), floor(xmax / dx) + 1)
+    tiles = []
+    for tile_id, tile_columns in enumerate(
+            np.array_split(columns, n_tiles)):
+        tile_bbox = None
+        if len(tile_columns):
+            tile_bbox = [
+                (float(tile_columns[0]) - 0.5) * dx, ymin,
+                (float(tile_columns[-1]) + 0.5) * dx, ymax]
+        tiles.append({
+            'id': tile_id,
+            'bbox': tile_bbox,
+            'output_dir': os.path.join(output_dir, TILES_DIR, str(tile_id)),
+        })
+
+    manifest = {
+        'regions': regions_path,
+        'densities': [list(density) for density in densities],
+        'step': step,
+        'radii': radii,
+        'lattice': lattice,
+        'prepared': prepared,
+        'bbox': list(bbox),
+        'tiles': tiles,
+    }
+
+    os.makedirs(output_dir, exist_ok=True)
+    path = os.path.join(output_dir, MANIFEST_NAME)
+    with open(path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    log.info('Planned {} tiles in {}'.format(len(tiles), path))
+
+
+@cli.command()
+@click.argument('manifest-path', type=click.Path(exists=True, dir_okay=False))
+@click.argument('tile-id', type=int)
+@click.option('--polygons', type=click.Path(), default=None,
+              help='Also write the samples to this shapefile, like disks.')
+@raster_options.memory_budget_option
+def tile(manifest_path, tile_id, polygons, memory_budget):
+    """
+    Run one tile of a sampling planned with plan.
+
+    Reads the inputs listed in the manifest and writes sums.pkl and a
+    completion record, tile.json, to the tile's directory. Tiles are
+    independent and can run in any order, at the same time.
+    """
+    manifest = _read_manifest(manifest_path)
+    tiles = manifest['tiles']
+    if not 0 <= tile_id < len(tiles):
+        raise ValueError('tile id must be from 0 to {}'.format(len(tiles) - 1))
+    tile = tiles[tile_id]
+    densities = manifest['densities']
+    names = _density_names(densities)
+
+    if tile['bbox'] is None:
+        sums = _sums_frame([], [], names)
+    else:
+        radii = [float(r) for r in manifest['radii'].split(',')]
+        sums = _sample_sums(
+            manifest['regions'], [raster for raster, _ in densities], names,
+            manifest['step'], tile['bbox'], radii, None, None, (),
+            manifest['lattice'], manifest['prepared'], polygons,
+            memory_budget)
+
+    # Written last, so that a tile is complete if its record exists
+    os.makedirs(tile['output_dir'], exist_ok=True)
+    path = os.path.join(tile['output_dir'], 'sums.pkl')
+    with open(path + '.tmp', 'wb') as f:
+        pickle.dump(sums, f)
+    os.replace(path + '.tmp', path)
+    with open(os.path.join(tile['output_dir'], TILE_RECORD), 'w') as f:
+        json.dump({'id': tile_id, 'bbox': tile['bbox'],
+                   'samples': len(sums),
+                   'manifest': _manifest_hash(manifest)}, f)
+
+
+@cli.command()
+@click.argument('manifest-path', type=click.Path(exists=True, dir_okay=False))
+@raster_options.precision_option
+def merge(manifest_path, precision):
+    """
+    Combine the tiles of a sampling planned with plan.
+
+    Checks that all the tiles are complete and were run for this manifest
+    (by a hash of it in each tile's record), and writes sums.pkl and
+    <density>_fracs.pkl next to the manifest, as run does.
+    """
+    manifest = _read_manifest(manifest_path)
+    densities = manifest['densities']
+    names = _density_names(densities)
+    digest = _manifest_hash(manifest)
+
+    missing, parts = [], []
+    for tile in manifest['tiles']:
+        record_path = os.path.join(tile['output_dir'], TILE_RECORD)
+        if not os.path.exists(record_path):
+            missing.append(tile['id'])
+            continue
+        with open(record_path, 'r') as f:
+            record = json.load(f)
+        if (record['id'] != tile['id'] or record['bbox'] != tile['bbox'] or
+                record.get('manifest') != digest):
+            raise ValueError(
+                'tile {} was run for another plan'.format(tile['id']))
+        with open(os.path.join(tile['output_dir'], 'sums.pkl'), 'rb') as f:
+            sums = pickle.load(f)
+        if len(sums) != record['samples'] or list(sums.columns) != names:
+            raise ValueError(
+                'the output of tile {} is incomplete'.format(tile['id']))
+        parts.append(sums)
+
+    if missing:
+        raise ValueError('tiles not done: {}'.format(
+            ', '.join(str(tile_id) for tile_id in missing)))
+
+    sums = pandas.concat(parts)
+    if sums.index.duplicated().any():
+        raise ValueError('tiles have overlapping samples')
+    log.info('Merged {} samples from {} tiles'.format(
+        len(sums), len(parts)))
+
+    output_dir = os.path.dirname(manifest_path)
+    with open(os.path.join(output_dir, 'sums.pkl'), 'wb') as f:
+        pickle.dump(sums, f)
+    _write_fracs(sums, densities, output_dir, dtype=precision)
+
+
+def _read_manifest(path):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def _manifest_hash(manifest):
+    """A hash of a plan's settings and tiles, to tell plans apart."""
+    text = json.dumps(manifest, sort_keys=True)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def _read_sampling_regions(regions_path, prepared=None):
+    """
+    Read the regions to sample.
+
+    Args:
+        regions_path: The regions, with a NUTS_ID property.
+        prepared: Optional path of regions prepared from regions_path.
+
+    Returns: A SamplingRegions.
+    """
+    import biogasrm.sampling_regions as sampling_regions
+    if prepared is not None:
+        return sampling_regions.load(prepared, regions_path)
+    return sampling_regions.SamplingRegions.from_file(regions_path)
+
+
+def _sample_points(regions, step, bbox, radii, min_step, tolerance,
+                   refine_by, lattice, memory_budget):
+    """
+    The sample centers, as given by the options of disks.
+
+    Returns:
+        (points, total): An iterable of Points and their number.
+    """
+    step = step * constants.M_PER_KM
+    if min_step is not None:
+        min_step = min_step * constants.M_PER_KM
+        if not refine_by:
+            raise ValueError('an adaptive grid needs rasters to --refine-by')
+        if lattice != 'square':
+            raise ValueError('an adaptive grid needs the square lattice')
+
+    if not bbox:
+        bbox = regions.union.bounds
+    log.info('Bounds: {}'.format(bbox))
+
+    if lattice == 'hex':
+        spacing = hex_spacing(step)
+        return (
+            generate_hex_points(spacing, bbox),
+            count_hex_points(spacing, bbox))
+    if min_step is None:
+        return generate_points(step, step, bbox), count_points(step, step, bbox)
+
+    with instrument.span('adaptive grid'):
+        points = adaptive_points(
+            step, min_step, bbox, refine_by,
+            max(radii) * constants.M_PER_KM, tolerance,
+            memory_budget=memory_budget)
+    return points, len(points)
+
+
+def _disk_intersections(point, radius, regions, visited):
+    """
+    Intersect a disk with the regions (a SamplingRegions).
+
+    Yields: (NUTS_ID, intersection) for the non-empty intersections.
+    """
+    disk = point.buffer(radius * constants.M_PER_KM)
+
+    for key, intersection in regions.intersections(disk):
+        if key not in visited:
+            visited.add(key)
+            log.info('Visiting {}'.format(key))
+        if intersection.is_empty:
+            continue
+        yield key, intersection
+
+
+def _disk_features(point, radius, regions, visited):
+    """
+    Intersect a disk with the regions.
+
+    Yields: Features with the non-empty intersections.
+    """
+    for key, intersection in _disk_intersections(
+            point, radius, regions, visited):
+        yield _sample_feature(point, radius, key, intersection)
+
+
+def _sample_feature(point, radius, key, intersection):
+    return dict(
+        geometry=shapely.geometry.mapping(intersection),
+        properties=dict(
+            NUTS_ID=key,
+            x=point.x,
+            y=point.y,
+            r=radius))
+
+
+def sample_key(x, y, r):
+    """
+    A hashable key for a sample, insensitive to float noise from files.
+    """
+    return (round(x, 3), round(y, 3), round(r, 6))
+
+
+def _index_samples(samples):
+    """
+    Map sample keys to feature ids in an open samples dataset.
+    """
+    fids = {}
+    for fid, f in samples.items():
+        p = f['properties']
+        fids.setdefault(sample_key(p['x'], p['y'], p['r']), []).append(fid)
+    return fids
+
+
+def count_points(dx, dy, bbox):
+    """The number of points generated by generate_points()."""
+    xmin, ymin, xmax, ymax = bbox
+    nx = floor(xmax / dx) - ceil(xmin / dx) + 1
+    ny = floor(ymax / dy) - ceil(ymin / dy) + 1
+    return max(nx, 0) * max(ny, 0)
 
 
 def generate_points(dx, dy, bbox):
     xmin, ymin, xmax, ymax = bbox
 
-    x = dx * ceil(xmin / dx)
-    while x <= xmax:
-        y = dy * ceil(ymin / dy)
-        while y <= ymax:
-            yield shapely.geometry.Point(x, y)
-            y += dy
-        x += dx
+    # Multiples of the step rather than repeated sums, so that points are
+    # exactly the same for any bbox on the same grid.
+    i = ceil(xmin / dx)
+    while dx * i <= xmax:
+        j = ceil(ymin / dy)
+        while dy * j <= ymax:
+            yield shapely.geometry.Point(dx * i, dy * j)
+            j += 1
+        i += 1
+
+def hex_spacing(step):
+    """
+    The spacing of a hexagonal lattice matching a square one.
+
+    Any location is within step / sqrt(2) of a center of a square lattice,
+    and within spacing / sqrt(3) of a center of a hexagonal one. With the
+    same largest distance, the hexagonal lattice has about 23% fewer
+    centers.
+    """
+    return step * sqrt(1.5)
+
+
+def generate_hex_points(spacing, bbox):
+    """
+    Generate points on a hexagonal lattice.
+
+    The rows are spacing * sqrt(3) / 2 apart and have a point every
+    spacing, with every other row shifted half a spacing. So the points
+    are at multiples of spacing / 2 in x, and like generate_points() they
+    are exactly the same for any bbox on the same lattice, ordered by x
+    and then y.
+    """
+    xmin, ymin, xmax, ymax = bbox
+    dx = spacing / 2
+    dy = spacing * sqrt(3) / 2
+
+    i = ceil(xmin / dx)
+    while dx * i <= xmax:
+        # Even columns have the even rows and odd columns the odd rows
+        j = ceil(ymin / dy)
+        j += (j - i) % 2
+        while dy * j <= ymax:
+            yield shapely.geometry.Point(dx * i, dy * j)
+            j += 2
+        i += 1
+
+
+def count_hex_points(spacing, bbox):
+    """The number of points generated by generate_hex_points()."""
+    xmin, ymin, xmax, ymax = bbox
+    dx = spacing / 2
+    dy = spacing * sqrt(3) / 2
+    i0, i1 = ceil(xmin / dx), floor(xmax / dx)
+    j0, j1 = ceil(ymin / dy), floor(ymax / dy)
+    return sum(
+        _count_parity(i0, i1, parity) * _count_parity(j0, j1, parity)
+        for parity in (0, 1))
+
+
+def _count_parity(first, last, parity):
+    # Number of integers n in [first, last] with n % 2 == parity
+    first += (first - parity) % 2
+    return max((last - first) // 2 + 1, 0)
+
+
+def adaptive_points(step, min_step, bbox, rasters, radius, tolerance,
+                    memory_budget=None):
+    """
+    Generate sample centers on a grid refined where the rasters vary.
+
+    Starts with a grid of the given step, and recursively splits each cell
+    in four where the raster sums around its corners differ by more than
+    tolerance times the largest such sum on the starting grid, until
+    cells are min_step wide. The sums are over squares of side 2 * radius,
+    a cheap stand-in for the substrates within the disks.
+
+    All centers are multiples of min_step, so the samples can be rasterized
+    at min_step (see spatial_util.resample_nearest()).
+
+    Args:
+        step: The coarsest step (map units).
+        min_step: The finest step (map units). step / min_step must be
+            a power of two.
+        bbox: (xmin, ymin, xmax, ymax) to sample.
+        rasters: Paths of rasters to guide the refinement.
+        radius: Half side of the squares to sum (map units).
+        tolerance: Relative tolerance, e.g. 0.1.
+        memory_budget: MB of raster data to read at a time.
+
+    Returns:
+        A list of Points, ordered by x and then y like generate_points().
+    """
+    import biogasrm.spatial_util as spatial_util
+
+    factor = step / min_step
+    levels = int(round(log2(factor))) if factor >= 1 else -1
+    if levels < 0 or abs(2 ** levels - factor) > 1e-6:
+        raise ValueError('step must be min_step times a power of two')
+
+    xmin, ymin, xmax, ymax = bbox
+    size = 2 ** levels
+
+    # Integer lattice coordinates, in units of min_step
+    i0 = int(ceil(xmin / step)) * size
+    i1 = int(floor(xmax / step)) * size
+    j0 = int(ceil(ymin / step)) * size
+    j1 = int(floor(ymax / step)) * size
+
+    # Summed-area tables of each raster on the min_step lattice
+    half = int(ceil(radius / min_step))
+    window_size = spatial_util.window_size_for_budget(
+        memory_budget, bytes_per_pixel=LATTICE_BYTES_PER_PIXEL)
+    bounds = (
+        (i0 - half) * min_step, (j0 - half) * min_step,
+        (i1 + half) * min_step, (j1 + half) * min_step)
+    tables = []
+    for path in rasters:
+        log.info('Summing {} on the adaptive grid'.format(path))
+        sums, (col0, row0) = spatial_util.lattice_sums(
+            path, min_step, bounds, window_size=window_size)
+        table = np.zeros((sums.shape[0] + 1, sums.shape[1] + 1))
+        table[1:, 1:] = sums.cumsum(axis=0).cumsum(axis=1)
+        tables.append((table, col0, row0))
+
+    def indicators(i, j):
+        result = []
+        for table, col0, row0 in tables:
+            c0 = np.clip(i - half - col0, 0, table.shape[1] - 1)
+            c1 = np.clip(i + half - col0, 0, table.shape[1] - 1)
+            r0 = np.clip(j - half - row0, 0, table.shape[0] - 1)
+            r1 = np.clip(j + half - row0, 0, table.shape[0] - 1)
+            result.append(
+                table[r1, c1] - table[r0, c1] - table[r1, c0] + table[r0, c0])
+        return np.stack(result, axis=-1)
+
+    coarse_i, coarse_j = np.meshgrid(
+        np.arange(i0, i1 + 1, size), np.arange(j0, j1 + 1, size),
+        indexing='ij')
+    points = set(zip(coarse_i.ravel().tolist(), coarse_j.ravel().tolist()))
+    if not points:
+        return []
+    scale = indicators(coarse_i.ravel(), coarse_j.ravel()).max(axis=0)
+
+    # Cells by their lower left corner
+    cell_i = coarse_i[:-1, :-1].ravel()
+    cell_j = coarse_j[:-1, :-1].ravel()
+    while size > 1 and len(cell_i):
+        corners = np.stack([
+            indicators(cell_i + di, cell_j + dj)
+            for di in (0, size) for dj in (0, size)])
+        spread = corners.max(axis=0) - corners.min(axis=0)
+        refine = (spread > tolerance * scale).any(axis=1)
+
+        size //= 2
+        cell_i, cell_j = cell_i[refine], cell_j[refine]
+        for di in (0, size, 2 * size):
+            for dj in (0, size, 2 * size):
+                points.update(zip(
+                    (cell_i + di).tolist(), (cell_j + dj).tolist()))
+        offsets = [(di, dj) for di in (0, size) for dj in (0, size)]
+        cell_i = np.concatenate([cell_i + di for di, dj in offsets])
+        cell_j = np.concatenate([cell_j + dj for di, dj in offsets])
+        log.info('Refined {} cells to step {}'.format(
+            refine.sum(), size * min_step))
+
+    return [
+        shapely.geometry.Point(i * min_step, j * min_step)
+        for i, j in sorted(points)]
 
 @cli.command()
-@click.argument('samples-path', type=click.Path(exists=True))
-@click.argument('raster-path', type=click.Path(exists=True))
+@click.argument('samples-path', type=raster_options.InputPath())
+@click.argument('raster-path', type=raster_options.InputPath())
 @click.argument('region-sums', type=click.File('r'))
 @click.argument('dst', type=click.File('wb'))
-def sample_region_fracs(samples_path, raster_path, region_sums, dst):
+@click.option('--reuse', type=click.File('rb'), default=None)
+@raster_options.memory_budget_option
+@raster_options.precision_option
+def sample_region_fracs(samples_path, raster_path, region_sums, dst, reuse,
+                        memory_budget, precision):
     """
     Calculate each sample's fraction of a region.
+
+    Args:
+        reuse: Fractions from an earlier run with the same raster and
+            region sums. Samples (x, y, r) with the fractions of all their
+            regions in there, matched by sample_key(), are not computed
+            again.
+        memory_budget: MB of raster data to read at a time.
+        precision: The dtype of the fractions. The sums are float64.
     """
+    import fiona
+    import rasterio
+    import biogasrm.spatial_util as spatial_util
 
     density_name = os.path.splitext(os.path.split(raster_path)[1])[0]
-    stats = zonal_stats(
-        samples_path,
-        raster_path,
-        stats=['sum'],
-        geojson_out=True)
-
-    sample_sums = pandas.DataFrame.from_records(
-        [
-        {key: item['properties'][key]
-        for key in  ('x','y','r','NUTS_ID','sum')}
-        for item in stats], index=['x','y','r','NUTS_ID'])['sum']
+    region_sums = pandas.Series(json.loads(region_sums.read()))
+    window_size = spatial_util.window_size_for_budget(memory_budget)
+
+    old_fracs = None
+    with fiona.open(samples_path) as src, rasterio.open(raster_path) as raster:
+        features = iter(src)
+        total = len(src)
+        if reuse:
+            old_fracs = pickle.load(reuse)
+            old_regions = {}
+            for x, y, r, nuts_id in old_fracs.index:
+                old_regions.setdefault(sample_key(x, y, r), set()).add(nuts_id)
+            samples = [
+                tuple(f['properties'][key] for key in ('x', 'y', 'r', 'NUTS_ID'))
+                for f in src]
+            new_regions = {}
+            for x, y, r, nuts_id in samples:
+                new_regions.setdefault(sample_key(x, y, r), set()).add(nuts_id)
+            # A sample (x, y, r) is reused only if the old fractions cover
+            # all its regions; otherwise all of it is computed again
+            reused = set(
+                key for key, regions in new_regions.items()
+                if regions <= old_regions.get(key, set()))
+            todo = [sample_key(*key[:3]) not in reused for key in samples]
+            total = sum(todo)
+            features = (f for f, new in zip(src, todo) if new)
+
+        keys = []
+        def geometries():
+            for f in instrument.progress(features, 'features', total=total):
+                keys.append(tuple(
+                    f['properties'][key] for key in ('x', 'y', 'r', 'NUTS_ID')))
+                yield shape(f['geometry'])
+
+        sums = [
+            total for _, total in
+            spatial_util.zonal_sums(raster, geometries(), window_size)]
+
+        index = pandas.MultiIndex.from_arrays(
+            list(zip(*keys)) or [[]] * 4, names=['x', 'y', 'r', 'NUTS_ID'])
+        sample_sums = pandas.Series(sums, index=index, name='sum', dtype=float)
+
+        sample_fracs = sample_sums.divide(region_sums, axis=0, level='NUTS_ID')
+
+        if old_fracs is not None:
+            # Keep the old fractions of the reused samples, matched by
+            # sample_key like above and relabeled with the coordinates of
+            # the new samples, so they align with the other densities
+            new_index = {
+                (sample_key(*key[:3]), key[3]): key for key in samples
+                if sample_key(*key[:3]) in reused}
+            old_index = [
+                new_index.get((sample_key(x, y, r), nuts_id))
+                for x, y, r, nuts_id in old_fracs.index]
+            keep = np.array([key is not None for key in old_index], bool)
+            old_fracs = old_fracs[keep]
+            old_fracs.index = pandas.MultiIndex.from_arrays(
+                list(zip(*[key for key in old_index if key is not None]))
+                or [[]] * 4, names=['x', 'y', 'r', 'NUTS_ID'])
+            log.info('Reused {} and computed {} fractions'.format(
+                len(old_fracs), len(sample_fracs)))
+            sample_fracs = pandas.concat([old_fracs, sample_fracs])
+
+    pickle.dump(sample_fracs.astype(precision), dst)
+
+
+@cli.command()
+@click.argument('samples-path', type=raster_options.InputPath())
+@click.argument('template', type=raster_options.InputPath())
+@click.argument('output', type=click.Path())
+@click.option('--supersample', type=int, default=1,
+              help='Weight boundary pixels by the fraction of N x N '
+                   'subpixels in each sample. Default 1 (pixel centers, '
+                   'like sample_region_fracs).')
+def footprints(samples_path, template, output, supersample):
+    """
+    Index the pixels of each sample on the grid of a raster.
+
+    The index stores each sample's footprint as runs of pixels along the
+    rows of the grid of TEMPLATE, so that add-density can compute
+    fractions for any raster aligned with that grid without the sample
+    polygons. Footprints are clipped to TEMPLATE, so use a raster covering
+    the sampled regions.
+
+    Args:
+        samples_path: The samples (from disks, or run --polygons).
+        template: A raster with the grid.
+        output: Where to save the index (pickle).
+        supersample: Subpixels per pixel side for the boundary weights.
+            Weighted fractions are approximate, since the regional sums
+            count whole pixels.
+    """
+    import rasterio
+    import biogasrm.footprints as footprints_
+
+    if supersample < 1:
+        raise ValueError('supersample must be at least 1')
+
+    with rasterio.open(template) as dataset, instrument.span('footprints'):
+        index = footprints_.FootprintIndex.build(
+            samples_path, dataset, supersample=supersample)
+    index.save(output)
+
+
+@cli.command()
+@click.argument('index-path', type=click.Path(exists=True, dir_okay=False))
+@click.argument('raster-path', type=raster_options.InputPath())
+@click.argument('region-sums', type=click.File('r'))
+@click.argument('dst', type=click.File('wb'))
+@raster_options.memory_budget_option
+@raster_options.precision_option
+def add_density(index_path, raster_path, region_sums, dst, memory_budget,
+                precision):
+    """
+    Calculate each sample's fraction of a region from a footprint index.
+
+    Gives the same fractions as sample_region_fracs for a raster aligned
+    with the grid of the index (see footprints), but sums the raster from
+    the stored footprints, so no sample geometries are read or rasterized.
+
+    Args:
+        index_path: The footprint index.
+        raster_path: The density raster, aligned with the index grid.
+        region_sums: The regional sums of the raster (JSON).
+        memory_budget: MB of raster data to read at a time.
+        precision: The dtype of the fractions.
+    """
+    import rasterio
+    import biogasrm.footprints as footprints_
 
     region_sums = pandas.Series(json.loads(region_sums.read()))
+    index = footprints_.load(index_path)
+    with rasterio.open(raster_path) as raster:
+        sample_sums = index.sums(raster, memory_budget=memory_budget)
 
     sample_fracs = sample_sums.divide(region_sums, axis=0, level='NUTS_ID')
-
-    pickle.dump(sample_fracs, dst)
+    pickle.dump(sample_fracs.astype(precision), dst)
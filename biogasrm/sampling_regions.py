@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+"""
+Region geometries prepared for sampling.
+
+Intersecting the disks with detailed region polygons (e.g. coasts and
+islands with thousands of vertices) is the slowest part of sampling. The
+regions can instead be simplified and cut into pieces on a grid, so that
+each disk is only intersected with the small pieces near it. This is done
+once with `biogasrm-sample prepare`, and the result is cached in a pickle
+which the sampling commands take with --prepared.
+"""
+
+import collections
+import logging
+import math
+import os
+import pickle
+
+import shapely.geometry
+import shapely.ops
+import shapely.prepared
+
+log = logging.getLogger(__name__)
+
+
+class SamplingRegions(object):
+    """
+    Regions to sample, with their union, optionally simplified and cut.
+
+    Args:
+        crs: The CRS of the regions (as from fiona).
+        regions: Dict of the region geometries by key (e.g. NUTS_ID), in
+            the order to report intersections in.
+        cell_size: Side of the grid cells to cut the regions into, in map
+            units, or None to keep the regions whole.
+        tolerance: Tolerance to simplify the regions with (map units), or
+            0 to keep them exact. The simplification preserves the
+            topology of each region, but neighbouring regions may get
+            small gaps or overlaps; see area_report().
+        union: The union of the regions. Default computed.
+    """
+    def __init__(self, crs, regions, cell_size=None, tolerance=0, union=None):
+        super(SamplingRegions, self).__init__()
+        self.crs = crs
+        self.cell_size = cell_size
+        self.tolerance = tolerance
+        self.keys = list(regions)
+        self.areas = {key: geometry.area for key, geometry in regions.items()}
+        self.bounds = {
+            key: geometry.bounds for key, geometry in regions.items()}
+        if union is None:
+            union = shapely.ops.unary_union(list(regions.values()))
+        self.union = union
+
+        if tolerance:
+            regions = collections.OrderedDict(
+                (key, geometry.simplify(tolerance, preserve_topology=True))
+                for key, geometry in regions.items())
+        self.regions = regions
+
+        self.pieces = None
+        if cell_size is not None:
+            self.pieces = _cut(regions, cell_size)
+        self._prepare()
+
+    @classmethod
+    def from_file(cls, path, key_property='NUTS_ID', **kwargs):
+        """
+        Read regions from a vector file.
+
+        Args:
+            path: The vector file.
+            key_property: The property identifying the regions.
+            **kwargs: Passed on to SamplingRegions().
+        """
+        import fiona
+        with fiona.open(path) as src:
+            crs = src.crs
+            regions = collections.OrderedDict(
+                (f['properties'][key_property],
+                 shapely.geometry.shape(f['geometry']))
+                for f in src)
+        return cls(crs, regions, **kwargs)
+
+    def _prepare(self):
+        # Prepared geometries cannot be pickled, so they are made on load
+        self.prepared_union = shapely.prepared.prep(self.union)
+        self._positions = {key: i for i, key in enumerate(self.keys)}
+        self._prepared = None
+        if self.pieces is None:
+            self._prepared = collections.OrderedDict(
+                (key, shapely.prepared.prep(geometry))
+                for key, geometry in self.regions.items())
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        for name in ('prepared_union', '_positions', '_prepared'):
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._prepare()
+
+    def intersections(self, geometry):
+        """
+        Intersect a geometry (e.g. a disk) with the regions.
+
+        Yields:
+            (key, intersection) for the regions near the geometry, in the
+            order of the regions. Intersections may be empty.
+        """
+        if self.pieces is None:
+            candidates = (
+                key for key, prepared in self._prepared.items()
+                if prepared.intersects(geometry))
+            for key in candidates:
+                yield key, self.regions[key].intersection(geometry)
+            return
+
+        parts = {}
+        xmin, ymin, xmax, ymax = geometry.bounds
+        size = self.cell_size
+        for col in range(int(math.floor(xmin / size)),
+                         int(math.floor(xmax / size)) + 1):
+            for row in range(int(math.floor(ymin / size)),
+                             int(math.floor(ymax / size)) + 1):
+                for key, piece in self.pieces.get((col, row), ()):
+                    parts.setdefault(key, []).append(
+                        piece.intersection(geometry))
+
+        for key in sorted(parts, key=self._positions.__getitem__):
+            pieces = [part for part in parts[key] if not part.is_empty]
+            if len(pieces) == 1:
+                yield key, pieces[0]
+            else:
+                yield key, shapely.ops.unary_union(pieces)
+
+    def area_report(self):
+        """
+        Compare the areas of the (simplified) regions with the exact ones.
+
+        Returns:
+            A dict with the tolerance, the total exact and simplified areas,
+            the areas of the exact and simplified unions (their difference
+            shows gaps and overlaps between simplified regions), the
+            largest relative error, and a dict of exact area, simplified
+            area and relative error for each region.
+        """
+        regions = collections.OrderedDict()
+        for key in self.keys:
+            area = self.areas[key]
+            simplified = self.regions[key].area
+            regions[key] = {
+                'area': area,
+                'simplified_area': simplified,
+                'relative_error': (simplified - area) / area if area else 0,
+            }
+        errors = [abs(r['relative_error']) for r in regions.values()]
+        return {
+            'tolerance': self.tolerance,
+            'total_area': sum(self.areas.values()),
+            'total_simplified_area': sum(
+                r['simplified_area'] for r in regions.values()),
+            'union_area': self.union.area,
+            'simplified_union_area': shapely.ops.unary_union(
+                list(self.regions.values())).area,
+            'max_relative_error': max(errors) if errors else 0,
+            'regions': regions,
+        }
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load(path, regions_path=None):
+    """
+    Load prepared regions saved by SamplingRegions.save().
+
+    Args:
+        path: The pickle.
+        regions_path: Optional path of the regions the cache was made
+            from, to check that the cache is not older than them.
+
+    Returns: A SamplingRegions.
+    """
+    if (regions_path is not None and os.path.exists(regions_path) and
+            os.path.getmtime(regions_path) > os.path.getmtime(path)):
+        raise ValueError(
+            'prepared regions {} are older than {}; prepare them '
+            'again'.format(path, regions_path))
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def _cut(regions, size):
+    """
+    Cut regions into pieces on a grid.
+
+    Returns:
+        A dict of lists of (key, piece) by grid cell (col, row), where
+        the cells are [col * size, (col + 1) * size) in x, and similarly
+        for rows in y.
+    """
+    pieces = {}
+    for key, geometry in regions.items():
+        if geometry.is_empty:
+            continue
+        prepared = shapely.prepared.prep(geometry)
+        xmin, ymin, xmax, ymax = geometry.bounds
+        for col in range(int(math.floor(xmin / size)),
+                         int(math.floor(xmax / size)) + 1):
+            for row in range(int(math.floor(ymin / size)),
+                             int(math.floor(ymax / size)) + 1):
+                cell = shapely.geometry.box(
+                    col * size, row * size, (col + 1) * size, (row + 1) * size)
+                if not prepared.intersects(cell):
+                    continue
+                if prepared.contains(cell):
+                    piece = cell
+                else:
+                    piece = geometry.intersection(cell)
+                if piece.is_empty or piece.area == 0:
+                    continue
+                pieces.setdefault((col, row), []).append((key, piece))
+    log.info('Cut {} regions into {} pieces'.format(
+        len(regions), sum(len(p) for p in pieces.values())))
+    return pieces
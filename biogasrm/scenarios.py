@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+"""
+Batches of scenarios with different parameters.
+
+A scenario is a set of overrides of the scalar parameters in
+parameters.defaults(), e.g. REMOVAL_RATE, RADIUS, P_min or the C:N and DM
+bounds. The inputs and sample fractions are loaded once, and the scenarios
+are evaluated in worker processes forked from the loading process, so that
+the workers share the loaded state (copy-on-write) instead of each
+reloading it.
+"""
+
+import copy
+import logging
+import multiprocessing
+import os
+import re
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+import biogasrm.parameters as parameters
+import biogasrm.results as results
+import biogasrm.sensitivity as sensitivity
+
+log = logging.getLogger(__name__)
+
+SUMMARY_NAME = 'scenarios.csv'
+
+# State shared with the forked workers, see run()
+_shared = {}
+
+
+def read_scenarios(f):
+    """
+    Read scenarios from a JSON or YAML file.
+
+    The file has a list of scenarios, each a dict of parameter overrides
+    with an optional "name", or a dict of such overrides by name. E.g.
+
+        - name: low-removal
+          REMOVAL_RATE: 0.2
+        - name: large-plants
+          P_min: 5
+          RADIUS: 25
+
+    Args:
+        f: An open file. It is read as YAML (needs PyYAML) if its name
+            ends with .yaml or .yml, else as JSON.
+
+    Returns:
+        A list of (name, overrides) in the order of the file. Unnamed
+        scenarios are named by their position, e.g. scenario-3.
+    """
+    name = getattr(f, 'name', '')
+    if name.endswith(('.yaml', '.yml')):
+        try:
+            import yaml
+        except ImportError:
+            raise ImportError(
+                'YAML scenario files need PyYAML; pip install biogasrm[yaml] '
+                'or use JSON')
+        data = yaml.safe_load(f)
+    else:
+        import json
+        data = json.load(f)
+
+    if isinstance(data, dict):
+        data = [dict(overrides, name=name) for name, overrides in data.items()]
+    if not isinstance(data, list):
+        raise ValueError('scenarios must be a list or a dict of overrides')
+
+    scenarios = []
+    for i, overrides in enumerate(data):
+        overrides = dict(overrides)
+        name = str(overrides.pop('name', 'scenario-{}'.format(i)))
+        if not re.match(r'^[\w.-]+$', name):
+            raise ValueError(
+                "scenario name '{}' is not a valid file name".format(name))
+        scenarios.append((name, overrides))
+
+    names = [name for name, _ in scenarios]
+    if len(set(names)) < len(names):
+        raise ValueError('scenario names must be unique')
+    return scenarios
+
+
+def apply_overrides(base, overrides):
+    """
+    Override scalar parameters.
+
+    Raises:
+        ValueError if a parameter does not exist or is a table.
+    """
+    params = copy.deepcopy(base)
+    for name, value in overrides.items():
+        if name not in base:
+            raise ValueError("unknown parameter '{}'".format(name))
+        if isinstance(base[name], (pd.Series, pd.DataFrame)):
+            raise ValueError(
+                "parameter '{}' is a table and cannot be overridden in a "
+                "scenario".format(name))
+        params[name] = float(value)
+    return params
+
+
+def load(sampling, param_sets):
+    """
+    Load the inputs shared by scenarios.
+
+    Returns:
+        A dict with the regions and substrate columns of get_substrates(),
+        the included NUTS codes, and the samples and fractions matrices
+        (see sensitivity._fracs_matrices()) and results.coarse_samples()
+        of each radius used.
+    """
+    # Also fills the caches of the Eurostat and manure tables
+    substrates = results.get_substrates(param_sets[0])
+    regions, columns = substrates.index, substrates.columns
+
+    fracs = results.get_sample_fracs(sampling)
+    sampled = set(fracs.index.get_level_values('r'))
+    samples = {}
+    coarse = {}
+    for radius in sorted(set(params['RADIUS'] for params in param_sets)):
+        if radius not in sampled:
+            raise ValueError('radius {} is not sampled in {}'.format(
+                radius, sampling))
+        samples[radius] = sensitivity._fracs_matrices(
+            fracs.xs(radius, level='r'), regions)
+        coarse[radius] = results.coarse_samples(samples[radius][0], sampling)
+
+    return {
+        'regions': regions,
+        'columns': columns,
+        'included': set(results.get_included_nuts_codes()),
+        'samples': samples,
+        'coarse': coarse,
+    }
+
+
+def evaluate(params, state):
+    """
+    Evaluate one parameter set.
+
+    The production of each sample is divided between countries in
+    proportion to the unconstrained production of its substrates from
+    each country, so the overall limit of a country is that of the
+    samples drawing substrates from it. The limits are taken over the
+    coarse samples (see results.coarse_samples()).
+
+    Args:
+        params: The parameters.
+        state: From load().
+
+    Returns:
+        A DataFrame with rows 'total' and each country (NUTS0 code), and
+        columns total_potential (MW) and overall_limit, and a Series with
+        the optimized biogas production (MW) of each sample, indexed (x, y).
+    """
+    regions, columns = state['regions'], state['columns']
+    samples, matrices = state['samples'][params['RADIUS']]
+
+    region_substrates = (
+        results.get_substrates(params)
+        .reindex(index=regions, columns=columns)
+        .fillna(0))
+
+    lp = results.compile_lp(params)
+    positions = columns.get_indexer(lp.indices)
+    if (positions < 0).any():
+        raise ValueError('substrates missing for some biogas yields')
+    yields = -lp.c
+
+    points = sensitivity.batch_sample_substrates(
+        region_substrates.values[np.newaxis], matrices, columns)[0]
+    points = points[:, positions]
+    production = results.solve_lp_rows(lp, points).dot(yields)
+
+    # Unconstrained production of the substrates in each region
+    region_yields = region_substrates.values[:, positions] * yields
+    densities = columns[positions].get_level_values('density')
+
+    countries = pd.Index(sorted(set(regions.str[:2])), name='region')
+    indicator = scipy.sparse.csr_matrix(
+        (np.ones(len(regions)),
+         (np.arange(len(regions)), countries.get_indexer(regions.str[:2]))),
+        shape=(len(regions), len(countries)))
+
+    # Unconstrained production of each sample from each country
+    benchmark = np.zeros((len(samples), len(countries)))
+    for density, matrix in matrices.items():
+        density_yields = region_yields[:, densities == density].sum(axis=1)
+        benchmark += matrix.dot(
+            scipy.sparse.diags(density_yields).dot(indicator)).toarray()
+
+    coarse = state['coarse'][params['RADIUS']]
+    benchmark = benchmark[coarse]
+    sample_benchmark = benchmark.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        shares = np.where(
+            sample_benchmark[:, np.newaxis] > 0,
+            benchmark / sample_benchmark[:, np.newaxis], 0)
+        country_limits = (
+            (shares * production[coarse, np.newaxis]).sum(axis=0) /
+            benchmark.sum(axis=0))
+    overall_limit = production[coarse].sum() / sample_benchmark.sum()
+
+    included = regions.isin(state['included'])
+    theoretical = indicator[included].T.dot(
+        region_yields[included].sum(axis=1))
+
+    table = pd.DataFrame(
+        {
+            'total_potential': np.concatenate(
+                [[theoretical.sum() * overall_limit],
+                 theoretical * country_limits]),
+            'overall_limit': np.concatenate(
+                [[overall_limit], country_limits]),
+        },
+        index=pd.Index(['total'] + list(countries), name='region'),
+        columns=['total_potential', 'overall_limit'])
+
+    return table, pd.Series(production, index=samples)
+
+
+def _evaluate_scenario(i):
+    name, params = _shared['scenarios'][i]
+    table, production = evaluate(params, _shared['state'])
+    table.to_csv(os.path.join(_shared['output_dir'], name + '.csv'))
+
+    if _shared['rasters']:
+        biogas = production / (np.pi * params['RADIUS'] ** 2)
+        results._save_raster_from_points(
+            biogas, os.path.join(_shared['output_dir'], name + '.tif'),
+            sampling=_shared['sampling'], output=_shared['output'])
+
+    log.info('Scenario {}: {:.1f} MW'.format(
+        name, table.loc['total', 'total_potential']))
+    return table.loc['total']
+
+
+def run(sampling, scenarios, output_dir, processes=None, rasters=False,
+        output=None, base=None):
+    """
+    Evaluate a batch of scenarios.
+
+    Writes <name>.csv with the table of evaluate() for each scenario, and
+    with rasters also <name>.tif with the local biogas potential density
+    (MW/km^2) at the scenario's RADIUS, to output_dir.
+
+    Args:
+        sampling: The name of the sampling settings.
+        scenarios: A list of (name, overrides), see read_scenarios().
+        output_dir: The directory to write to. Created if missing.
+        processes: Number of worker processes. None means one per CPU.
+            Workers are forked, so more than 1 needs a platform with fork.
+        rasters: Whether to make a raster for each scenario.
+        output: Optional dict of keyword arguments to
+            spatial_util.open_raster_output() for the rasters.
+        base: Parameters to start from. Default parameters.defaults().
+
+    Returns:
+        A DataFrame with one row per scenario, with its overrides and
+        total_potential and overall_limit. Also written to output_dir as
+        SUMMARY_NAME.
+    """
+    if base is None:
+        base = parameters.defaults()
+    if not scenarios:
+        raise ValueError('no scenarios')
+    param_sets = [
+        (name, apply_overrides(base, overrides))
+        for name, overrides in scenarios]
+
+    if rasters:
+        for name, _ in param_sets:
+            path = os.path.join(output_dir, name + '.tif')
+            if os.path.exists(path):
+                raise ValueError('Path {} already exists!'.format(path))
+    os.makedirs(output_dir, exist_ok=True)
+
+    log.info('Loading inputs for {} scenarios'.format(len(scenarios)))
+    _shared.update(
+        scenarios=param_sets,
+        state=load(sampling, [params for _, params in param_sets]),
+        output_dir=output_dir,
+        sampling=sampling,
+        rasters=rasters,
+        output=output)
+
+    try:
+        indices = range(len(param_sets))
+        if processes == 1 or len(param_sets) == 1:
+            totals = list(map(_evaluate_scenario, indices))
+        else:
+            context = multiprocessing.get_context('fork')
+            with context.Pool(processes) as pool:
+                totals = pool.map(_evaluate_scenario, indices)
+    finally:
+        _shared.clear()
+
+    names = [name for name, _ in scenarios]
+    overrides = pd.DataFrame(
+        [overrides for _, overrides in scenarios], index=names)
+    summary = pd.concat(
+        [overrides, pd.DataFrame(totals, index=names)], axis=1)
+    summary.index.name = 'scenario'
+    summary.to_csv(os.path.join(output_dir, SUMMARY_NAME))
+    return summary
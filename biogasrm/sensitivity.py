@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+
+import copy
+import logging
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+import biogasrm.parameters as parameters
+import biogasrm.results as results
+
+log = logging.getLogger(__name__)
+
+# Parameters which may be given a distribution in a sensitivity analysis.
+UNCERTAIN_PARAMETERS = (
+    'RESIDUE_RATIOS',
+    'BIOGAS_YIELDS',
+    'EXCRETION_PER_HEAD',
+    'REMOVAL_RATE',
+    'CN_min',
+    'CN_max',
+    'D_min',
+    'D_max'
+)
+
+# Valid ranges of the drawn values: of scalar parameters, and of the
+# factors which table parameters are multiplied by
+PARAMETER_BOUNDS = {
+    'REMOVAL_RATE': (0, 1),
+    'D_min': (0, 1),
+    'D_max': (0, 1),
+    'CN_min': (0, np.inf),
+    'CN_max': (0, np.inf),
+}
+FACTOR_BOUNDS = (0, np.inf)
+
+# Pairs of parameters which must be ordered (lower, upper) in each draw
+ORDERED_PARAMETERS = (('D_min', 'D_max'), ('CN_min', 'CN_max'))
+
+# Keys: distribution names. Values: functions (random_state, spec, size).
+DISTRIBUTIONS = {
+    'uniform':
+        lambda rs, spec, size: rs.uniform(spec['low'], spec['high'], size),
+    'normal':
+        lambda rs, spec, size: rs.normal(spec['mean'], spec['sd'], size),
+    'lognormal':
+        lambda rs, spec, size: rs.lognormal(spec['mean'], spec['sigma'], size),
+    'triangular':
+        lambda rs, spec, size: rs.triangular(
+            spec['left'], spec['mode'], spec['right'], size),
+}
+
+
+def draw_parameters(distributions, n, seed=None, base=None):
+    """
+    Draw random parameter sets.
+
+    Scalar parameters are replaced by the drawn value, or multiplied by it
+    if the distribution has "relative": true. Table parameters (Series and
+    DataFrames) are always multiplied by the drawn value, one value for the
+    whole table, or one value per cell with "elementwise": true.
+
+    The drawn parameters must be within PARAMETER_BOUNDS (the factors of
+    table parameters non-negative), and each pair of ORDERED_PARAMETERS
+    ordered. Draws outside the bounds are an error, unless the
+    distribution has "clip": true, in which case they are clipped to them.
+
+    Example distributions:
+        {
+            "REMOVAL_RATE": {"dist": "uniform", "low": 0.3, "high": 0.5},
+            "CN_max": {"dist": "triangular",
+                       "left": 30, "mode": 35, "right": 40},
+            "RESIDUE_RATIOS": {"dist": "normal", "mean": 1, "sd": 0.1,
+                               "elementwise": true}
+        }
+
+    Args:
+        distributions (dict): Keys: parameter names. Values: dicts with
+            the name of the distribution under "dist" and its arguments.
+        n (int): Number of draws.
+        seed (int): Seed for the random number generator.
+        base (dict): Parameters to start from. Default parameters.defaults().
+
+    Returns:
+        A list of n parameter dicts, and a DataFrame with the drawn
+        values (one row per draw) for all but elementwise parameters.
+
+    Raises:
+        ValueError for unknown parameters or distributions, draws outside
+        the bounds without "clip", or unordered pairs.
+    """
+
+    rs = np.random.RandomState(seed)
+    if base is None:
+        base = parameters.defaults()
+
+    draws = [copy.deepcopy(base) for i in range(n)]
+    drawn = {}
+
+    for name, spec in sorted(distributions.items()):
+        if name not in UNCERTAIN_PARAMETERS:
+            raise ValueError(
+                "parameter '{}' cannot be given a distribution".format(name))
+        try:
+            draw = DISTRIBUTIONS[spec['dist']]
+        except KeyError:
+            raise ValueError(
+                "unknown distribution for '{}': {}".format(
+                    name, spec.get('dist')))
+
+        default = base[name]
+        if isinstance(default, (pd.Series, pd.DataFrame)):
+            if spec.get('elementwise', False):
+                values = _check_bounds(
+                    name, draw(rs, spec, (n,) + default.shape),
+                    FACTOR_BOUNDS, spec)
+            else:
+                values = _check_bounds(
+                    name, draw(rs, spec, n), FACTOR_BOUNDS, spec)
+                drawn[name] = values
+            for params, value in zip(draws, values):
+                params[name] = default * value
+        else:
+            values = draw(rs, spec, n)
+            if spec.get('relative', False):
+                values = default * values
+            values = _check_bounds(
+                name, values, PARAMETER_BOUNDS.get(name, (-np.inf, np.inf)),
+                spec)
+            drawn[name] = values
+            for params, value in zip(draws, values):
+                params[name] = float(value)
+
+    for lower, upper in ORDERED_PARAMETERS:
+        if lower not in distributions and upper not in distributions:
+            continue
+        unordered = [i for i, params in enumerate(draws)
+                     if params[lower] > params[upper]]
+        if unordered:
+            raise ValueError(
+                '{} > {} in {} of {} draws'.format(
+                    lower, upper, len(unordered), n))
+
+    return draws, pd.DataFrame(drawn, index=range(n))
+
+
+def _check_bounds(name, values, bounds, spec):
+    """Clip drawn values to bounds if spec has "clip", else check them."""
+    low, high = bounds
+    if spec.get('clip', False):
+        return np.clip(values, low, high)
+    outside = (values < low) | (values > high)
+    if outside.any():
+        raise ValueError(
+            "{} of the draws of '{}' are outside [{}, {}]; narrow the "
+            "distribution or give it \"clip\": true".format(
+                int(outside.sum()), name, low, high))
+    return values
+
+
+def _fracs_matrices(fracs, regions):
+    """
+    Make one sparse (samples x regions) matrix of fractions per density.
+
+    Args:
+        fracs (DataFrame): Sample fractions for one radius, as from
+            get_sample_fracs() but without the 'r' level.
+        regions (Index): NUTS codes of the matrix columns.
+
+    Returns:
+        The sample (x, y) index and a dict of matrices keyed by density.
+    """
+    keys = fracs.index.droplevel('NUTS_ID')
+    samples = keys.drop_duplicates().sort_values()
+    rows = samples.get_indexer(keys)
+    cols = regions.get_indexer(fracs.index.get_level_values('NUTS_ID'))
+
+    matrices = {}
+    for density in fracs.columns:
+        values = fracs[density].values
+        ok = (cols >= 0) & ~np.isnan(values)
+        matrices[density] = scipy.sparse.csr_matrix(
+            (values[ok], (rows[ok], cols[ok])),
+            shape=(len(samples), len(regions)))
+
+    return samples, matrices
+
+
+def batch_sample_substrates(region_substrates, matrices, columns):
+    """
+    Distribute region substrates to samples for many parameter draws at once.
+
+    This is the linear part of get_sample_substrates(), computed with the
+    draws as an extra array axis.
+
+    Args:
+        region_substrates: Array (draws x regions x substrates).
+        matrices (dict): Sparse (samples x regions) matrices by density.
+        columns: The (density, substrate) pairs of the last axis.
+
+    Returns:
+        Array (draws x samples x substrates).
+    """
+    n_draws, n_regions, n_cols = region_substrates.shape
+    n_samples = next(iter(matrices.values())).shape[0]
+    result = np.zeros((n_draws, n_samples, n_cols))
+
+    densities = columns.get_level_values('density')
+    for density, matrix in matrices.items():
+        cols = np.flatnonzero(densities == density)
+        if len(cols) == 0:
+            continue
+        block = (region_substrates[:, :, cols]
+                 .transpose(1, 0, 2)
+                 .reshape(n_regions, n_draws * len(cols)))
+        block = matrix.dot(block).reshape(n_samples, n_draws, len(cols))
+        result[:, :, cols] = block.transpose(1, 0, 2)
+
+    return result
+
+
+def _draw_production(args):
+    lp, points = args
+    solutions = results.solve_lp_rows(lp, points)
+    return -lp.c.dot(solutions.sum(axis=0))
+
+
+def run(sampling, distributions, draws=100, seed=None, processes=None,
+        base=None):
+    """
+    Evaluate the total potential and overall limit for random parameter draws.
+
+    Inputs and sample fractions are loaded once and shared by all draws.
+
+    Args:
+        sampling: The name of the sampling settings.
+        distributions (dict): See draw_parameters().
+        draws (int): Number of draws.
+        seed (int): Seed for the random number generator.
+        processes (int): Number of worker processes for the LP stage.
+            None means one per CPU.
+        base (dict): Parameters to start from. Default parameters.defaults().
+
+    Returns: DataFrame.
+        Rows: draws. Columns: total_potential (MW), overall_limit, and the
+        drawn values of all but elementwise parameters.
+    """
+
+    param_sets, drawn = draw_parameters(
+        distributions, draws, seed=seed, base=base)
+    radius = param_sets[0]['RADIUS']
+
+    log.info('Computing region substrates for {} draws'.format(draws))
+    first = results.get_substrates(param_sets[0])
+    regions, columns = first.index, first.columns
+    region_substrates = np.stack([
+        results.get_substrates(params)
+        .reindex(index=regions, columns=columns)
+        .fillna(0)
+        .values
+        for params in param_sets])
+
+    fracs = results.get_sample_fracs(sampling).xs(radius, level='r')
+    fracs = fracs[results.coarse_samples(fracs.index, sampling)]
+    samples, matrices = _fracs_matrices(fracs, regions)
+    sample_substrates = batch_sample_substrates(
+        region_substrates, matrices, columns)
+
+    included = regions.isin(results.get_included_nuts_codes())
+    totals_available = region_substrates[:, included, :].sum(axis=1)
+
+    lps = [results.compile_lp(params) for params in param_sets]
+    tasks = []
+    for lp, points in zip(lps, sample_substrates):
+        positions = columns.get_indexer(lp.indices)
+        if (positions < 0).any():
+            raise ValueError('substrates missing for some biogas yields')
+        tasks.append((lp, points[:, positions]))
+
+    log.info(
+        'Solving {} LPs for {} draws'.format(len(samples) * draws, draws))
+    if processes == 1:
+        actual = list(map(_draw_production, tasks))
+    else:
+        with multiprocessing.Pool(processes) as pool:
+            actual = pool.map(_draw_production, tasks)
+
+    benchmark = [
+        -lp.c.dot(points.sum(axis=0)) for lp, points in tasks]
+    theoretical = [
+        -lp.c.dot(totals[columns.get_indexer(lp.indices)])
+        for lp, totals in zip(lps, totals_available)]
+
+    overall_limit = np.array(actual) / np.array(benchmark)
+    result = pd.DataFrame(
+        {
+            'total_potential': np.array(theoretical) * overall_limit,
+            'overall_limit': overall_limit
+        }, index=drawn.index)
+    result.index.name = 'draw'
+
+    return pd.concat([result, drawn], axis=1)
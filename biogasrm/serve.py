@@ -0,0 +1,418 @@
+# -*- coding: utf-8 -*-
+
+from collections import OrderedDict
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+import json
+import logging
+import math
+import re
+import struct
+import threading
+import zlib
+
+import click
+import numpy as np
+import pandas as pd
+
+import biogasrm.parameters as parameters
+import biogasrm.constants as constants
+import biogasrm.results as results
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger(__name__)
+
+TILE_SIZE = 256
+
+
+class LRUCache(object):
+    """Least recently used cache of bytes objects, bounded by total size."""
+    def __init__(self, max_bytes):
+        super(LRUCache, self).__init__()
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                return None
+            self._items[key] = value
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            if key in self._items:
+                self.size -= len(self._items.pop(key))
+            if len(value) > self.max_bytes:
+                return
+            self._items[key] = value
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self.size -= len(evicted)
+
+
+def encode_png(values, vmax):
+    """Encode a 2D float array as an 8-bit gray + alpha PNG.
+
+    Values are scaled linearly from 0 to vmax. NaN is transparent.
+    """
+    valid = ~np.isnan(values)
+    gray = np.zeros(values.shape, dtype=np.uint8)
+    gray[valid] = np.clip(values[valid] / vmax * 255, 0, 255).astype(np.uint8)
+    alpha = np.where(valid, 255, 0).astype(np.uint8)
+
+    height, width = values.shape
+    pixels = np.dstack([gray, alpha]).reshape(height, width * 2)
+    # Each scanline starts with filter type 0
+    scanlines = np.hstack([np.zeros((height, 1), dtype=np.uint8), pixels])
+
+    def chunk(kind, data):
+        body = kind + data
+        return (struct.pack('>I', len(data)) + body +
+                struct.pack('>I', zlib.crc32(body) & 0xffffffff))
+
+    header = struct.pack('>IIBBBBB', width, height, 8, 4, 0, 0, 0)
+    return (b'\x89PNG\r\n\x1a\n' +
+            chunk(b'IHDR', header) +
+            chunk(b'IDAT', zlib.compress(scanlines.tobytes())) +
+            chunk(b'IEND', b''))
+
+
+class BiogasService(object):
+    """
+    Biogas potentials from one sampling, with all inputs loaded once.
+
+    The blending LP is solved on demand for the samples a query touches,
+    and the results are kept for later queries.
+
+    Args:
+        sampling: The name of the sampling settings.
+        params: The parameters. Default parameters.defaults().
+        raster: Optional path to a biogas raster (see make_biogas_raster)
+            to serve tiles from instead of computing them from the samples.
+        cache_bytes: Maximal total size of cached tiles.
+        vmax: Biogas density (MW/km^2) shown as white in PNG tiles.
+    """
+    def __init__(self, sampling='default', params=None, raster=None,
+                 cache_bytes=64 * 2**20, vmax=0.1):
+        super(BiogasService, self).__init__()
+        if params is None:
+            params = parameters.defaults()
+        self.params = params
+        self.vmax = vmax
+        self.tiles = LRUCache(cache_bytes)
+        self._lock = threading.Lock()
+
+        log.info('Loading substrates for sampling {}'.format(sampling))
+        substrates = results.get_sample_substrates(sampling, params)
+        self.substrates = substrates.xs(params['RADIUS'], level='r')
+        self.lp = results.compile_lp(params)
+        self.points = self.substrates[self.lp.indices].values
+        self.x = self.substrates.index.get_level_values('x').values
+        self.y = self.substrates.index.get_level_values('y').values
+        self._production = np.full(len(self.points), np.nan)
+
+        self.region_substrates = (
+            results.get_substrates(params)
+            .reindex(results.get_included_nuts_codes())
+            .dropna(how='all'))
+
+        if raster is None:
+            settings = results.read_sampling_settings(sampling)
+            if (settings['lattice'] != 'square' or
+                    settings['min_step'] is not None):
+                raise ValueError(
+                    'samples are not on a square grid; give the raster '
+                    'made by make_biogas_raster')
+            self.raster = None
+            self.step = settings['step'] * constants.M_PER_KM
+            self.left = self.x.min() - self.step / 2
+            self.top = self.y.max() + self.step / 2
+            self.cols = np.round(
+                (self.x - self.x.min()) / self.step).astype(int)
+            self.rows = np.round(
+                (self.y.max() - self.y) / self.step).astype(int)
+            self.height = self.rows.max() + 1
+            self.width = self.cols.max() + 1
+        else:
+            import rasterio
+            self.raster = rasterio.open(raster)
+            self.step = self.raster.res[0]
+            self.left, self.top = self.raster.bounds.left, self.raster.bounds.top
+            self.height, self.width = self.raster.shape
+
+        self.max_zoom = max(
+            0, int(math.ceil(math.log2(max(self.height, self.width) / TILE_SIZE))))
+
+    def production(self, mask):
+        """Optimized biogas production (MW) of the samples selected by mask.
+
+        The LPs are solved outside the lock, so concurrent requests solve
+        in parallel. Requests touching the same new samples at the same
+        time may both solve them, with the same result.
+        """
+        with self._lock:
+            production = self._production[mask]
+        todo = np.isnan(production)
+        if todo.any():
+            solutions = results.solve_lp_rows(
+                self.lp, self.points[mask][todo])
+            production[todo] = solutions.dot(-self.lp.c)
+            with self._lock:
+                self._production[np.flatnonzero(mask)[todo]] = production[todo]
+        return production
+
+    def density(self, production):
+        """Convert production (MW) to biogas density (MW/km^2)."""
+        return production / (math.pi * self.params['RADIUS'] ** 2)
+
+    def potentials(self, bbox):
+        """Biogas potentials of the sample centers within a bounding box."""
+        xmin, ymin, xmax, ymax = bbox
+        mask = ((self.x >= xmin) & (self.x <= xmax) &
+                (self.y >= ymin) & (self.y <= ymax))
+        production = self.production(mask)
+        return {
+            'radius': self.params['RADIUS'],
+            'samples': int(mask.sum()),
+            'mean_density': _float(self.density(production).mean())
+                            if len(production) else None,
+            'points': [
+                {'x': x, 'y': y, 'production': p}
+                for x, y, p in zip(
+                    self.x[mask].tolist(), self.y[mask].tolist(),
+                    production.tolist())]
+        }
+
+    def point(self, x, y):
+        """Substrates and biogas potential at the sample nearest to (x, y)."""
+        distances = np.hypot(self.x - x, self.y - y)
+        i = int(np.argmin(distances))
+        if distances[i] > self.step:
+            return None
+        utilized = results.solve_lp(self.lp, self.points[i])
+        production = utilized.dot(-self.lp.c)
+        with self._lock:
+            self._production[i] = production
+
+        def by_substrate(values):
+            return {
+                '{}/{}'.format(*key): _float(v)
+                for key, v in zip(self.lp.indices, values)}
+
+        return {
+            'x': float(self.x[i]),
+            'y': float(self.y[i]),
+            'radius': self.params['RADIUS'],
+            'production': _float(production),
+            'density': _float(self.density(production)),
+            'available': by_substrate(self.points[i]),
+            'utilized': by_substrate(utilized)
+        }
+
+    def region_totals(self, level):
+        """Available substrates (Mg VS) and theoretical potential (MW) per
+        NUTS region at a level."""
+        NUTS = constants.NUTS
+        codes = self.region_substrates.index
+        groups = NUTS.ancestor(codes, level)
+        totals = self.region_substrates.groupby(groups).sum()
+        potential = results.biogas_prod(totals, self.params)
+
+        return {
+            code: {
+                'potential': _float(potential[code]),
+                'substrates': {
+                    '{}/{}'.format(*key): _float(v)
+                    for key, v in row.items()}
+            }
+            for code, row in totals.iterrows()}
+
+    def tile(self, z, tx, ty, fmt):
+        """A tile of biogas densities (MW/km^2) as PNG or raw float32."""
+        if not 0 <= z <= self.max_zoom:
+            raise KeyError('zoom level out of range')
+        factor = 2 ** (self.max_zoom - z)
+        span = TILE_SIZE * factor
+        if not (0 <= tx * span < self.width and 0 <= ty * span < self.height):
+            raise KeyError('tile out of range')
+
+        key = (z, tx, ty, fmt)
+        data = self.tiles.get(key)
+        if data is not None:
+            return data
+
+        if self.raster is None:
+            values = self._tile_from_samples(tx, ty, factor)
+        else:
+            values = self._tile_from_raster(tx, ty, factor)
+
+        if fmt == 'png':
+            data = encode_png(values, self.vmax)
+        else:
+            data = values.astype('<f4').tobytes()
+        self.tiles.put(key, data)
+        return data
+
+    def _tile_from_samples(self, tx, ty, factor):
+        span = TILE_SIZE * factor
+        mask = ((self.cols >= tx * span) & (self.cols < (tx + 1) * span) &
+                (self.rows >= ty * span) & (self.rows < (ty + 1) * span))
+        density = self.density(self.production(mask))
+
+        # Average the samples within each tile pixel
+        pixels = ((self.rows[mask] // factor - ty * TILE_SIZE) * TILE_SIZE +
+                  self.cols[mask] // factor - tx * TILE_SIZE)
+        size = TILE_SIZE * TILE_SIZE
+        sums = np.bincount(pixels, weights=density, minlength=size)
+        counts = np.bincount(pixels, minlength=size)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            values = sums / counts
+        return values.reshape(TILE_SIZE, TILE_SIZE)
+
+    def _tile_from_raster(self, tx, ty, factor):
+        span = TILE_SIZE * factor
+        row_stop = min((ty + 1) * span, self.height)
+        col_stop = min((tx + 1) * span, self.width)
+        out_shape = (
+            int(math.ceil((row_stop - ty * span) / factor)),
+            int(math.ceil((col_stop - tx * span) / factor)))
+        window = ((ty * span, row_stop), (tx * span, col_stop))
+        with self._lock:
+            block = self.raster.read(
+                1, window=window, out_shape=out_shape, masked=True)
+
+        values = np.full((TILE_SIZE, TILE_SIZE), np.nan)
+        values[:out_shape[0], :out_shape[1]] = block.astype(float).filled(np.nan)
+        return values
+
+
+def _float(value):
+    value = float(value)
+    return None if math.isnan(value) else value
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class BiogasRequestHandler(BaseHTTPRequestHandler):
+    """
+    Routes:
+        /                                  Service description.
+        /potential?bbox=xmin,ymin,xmax,ymax Potentials of samples in a bbox.
+        /potential?x=...&y=...             Potential at the nearest sample.
+        /regions?level=2                   Totals per NUTS region.
+        /tiles/{z}/{x}/{y}.png             Biogas density tile (PNG).
+        /tiles/{z}/{x}/{y}.raw             Biogas density tile (float32,
+                                           little endian, 256 x 256).
+    """
+
+    tile_pattern = re.compile(r'^/tiles/(\d+)/(\d+)/(\d+)\.(png|raw)$')
+
+    def do_GET(self):
+        service = self.server.service
+        url = urlparse(self.path)
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+
+        try:
+            match = self.tile_pattern.match(url.path)
+            if match:
+                z, tx, ty = map(int, match.groups()[:3])
+                fmt = match.group(4)
+                try:
+                    data = service.tile(z, tx, ty, fmt)
+                except KeyError as e:
+                    return self._send_json({'error': str(e)}, status=404)
+                content_type = (
+                    'image/png' if fmt == 'png' else 'application/octet-stream')
+                return self._send(data, content_type)
+
+            if url.path == '/':
+                return self._send_json({
+                    'crs': 'EPSG:3035',
+                    'radius': service.params['RADIUS'],
+                    'tile_size': TILE_SIZE,
+                    'max_zoom': service.max_zoom,
+                    'origin': [service.left, service.top],
+                    'resolution': service.step,
+                    'routes': ['/potential', '/regions', '/tiles/{z}/{x}/{y}.png',
+                               '/tiles/{z}/{x}/{y}.raw']})
+
+            if url.path == '/potential':
+                if 'bbox' in query:
+                    bbox = [float(v) for v in query['bbox'].split(',')]
+                    if len(bbox) != 4:
+                        raise ValueError('bbox must be xmin,ymin,xmax,ymax')
+                    return self._send_json(service.potentials(bbox))
+                result = service.point(float(query['x']), float(query['y']))
+                if result is None:
+                    return self._send_json(
+                        {'error': 'no sample near point'}, status=404)
+                return self._send_json(result)
+
+            if url.path == '/regions':
+                level = int(query.get('level', 2))
+                return self._send_json(service.region_totals(level))
+
+        except (KeyError, ValueError) as e:
+            return self._send_json({'error': str(e)}, status=400)
+
+        self._send_json({'error': 'not found'}, status=404)
+
+    def _send(self, data, content_type, status=200):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_json(self, obj, status=200):
+        self._send(json.dumps(obj).encode('utf-8'), 'application/json', status)
+
+    def log_message(self, format, *args):
+        log.info(format % args)
+
+
+@click.command()
+@click.argument('sampling', type=str, default='default')
+@click.option('--host', type=str, default='127.0.0.1',
+    help='Address to listen on. Default 127.0.0.1.')
+@click.option('--port', type=int, default=8000,
+    help='Port to listen on. Default 8000.')
+@click.option('--raster', type=click.Path(exists=True), default=None,
+    help='Serve tiles from this biogas raster instead of the samples.')
+@click.option('--cache-size', type=float, default=64,
+    help='Maximal size of the tile cache in MB. Default 64.')
+@click.option('--vmax', type=float, default=0.1,
+    help='Biogas density (MW/km^2) shown as white in PNG tiles.')
+def cli(sampling, host, port, raster, cache_size, vmax):
+    """Serve biogas potentials over HTTP.
+
+    Everything is computed from the local outdata/ directory, so run this
+    in the working directory.
+
+    Args:
+        sampling: The name of the sampling settings.
+
+    """
+
+    service = BiogasService(
+        sampling, raster=raster, cache_bytes=int(cache_size * 2**20),
+        vmax=vmax)
+
+    server = _ThreadingHTTPServer((host, port), BiogasRequestHandler)
+    server.service = service
+    log.info('Serving on http://{}:{}/'.format(host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import logging
+import math
+import os
+
+import numpy as np
+import pandas as pd
+import rasterio
+
+import biogasrm.parameters as parameters
+import biogasrm.constants as constants
+import biogasrm.results as results
+import biogasrm.spatial_util as spatial_util
+
+log = logging.getLogger(__name__)
+
+LABELS_DIR = 'outdata/region_labels'
+
+# Sites are grouped by the tile (in pixels) of their centers, and each
+# group is summed from one window read covering all its disks
+SITE_TILE_SIZE = 256
+
+# Largest number of (site, pixel) pairs tested at a time, roughly
+SITE_BATCH_ELEMENTS = 2 ** 22
+
+
+def label_raster_path(template, regions_path=None):
+    """
+    Path of the cached region label raster for the grid of a raster.
+
+    Rasters on the same grid share one label raster. The path also depends
+    on the path and modification time of the regions file, so that labels
+    are made again when the regions change.
+    """
+    if regions_path is None:
+        regions_path = results.INCLUDED_NUTS_PATH
+    grid = json.dumps(
+        [template.width, template.height, list(template.bounds),
+         str(template.crs), os.path.abspath(regions_path),
+         os.path.getmtime(regions_path)])
+    digest = hashlib.md5(grid.encode('utf-8')).hexdigest()[:12]
+    return os.path.join(LABELS_DIR, '{}.tif'.format(digest))
+
+
+class _Density(object):
+    """A density raster with its region labels and regional sums."""
+    def __init__(self, name, keys):
+        super(_Density, self).__init__()
+        self.name = name
+        self.raster = rasterio.open('outdata/{}.tif'.format(name))
+
+        labels_path = label_raster_path(
+            self.raster, results.INCLUDED_NUTS_PATH)
+        if not os.path.exists(labels_path):
+            log.info('Rasterizing region labels for {}'.format(name))
+            os.makedirs(LABELS_DIR, exist_ok=True)
+            spatial_util.rasterize_labels(
+                results.INCLUDED_NUTS_PATH, 'NUTS_ID',
+                self.raster.name, labels_path)
+        self.labels = rasterio.open(labels_path)
+        label_keys = spatial_util.read_label_keys(self.labels)
+
+        with open('outdata/regional_sums/{}.json'.format(name), 'r') as f:
+            regional_sums = pd.Series(json.loads(f.read()))
+
+        # Map label indices to the engine's region order
+        positions = pd.Index(keys).get_indexer(label_keys)
+        self.label_positions = np.append(positions, -1)
+        self.regional_sums = regional_sums.reindex(keys).values
+
+        self.left, _, _, self.top = self.raster.bounds
+        self.xres, self.yres = self.raster.res
+
+    def region_sums(self, x, y, radius, n_regions):
+        """
+        Sum of the density within disks, per region.
+
+        Args:
+            x, y, radius: Arrays of the disk centers and radii (m).
+            n_regions: The number of regions.
+
+        Returns:
+            An array (disks, regions).
+        """
+        x, y, radius = np.broadcast_arrays(
+            np.asarray(x, dtype=float), np.asarray(y, dtype=float),
+            np.asarray(radius, dtype=float))
+        sums = np.zeros((len(x), n_regions))
+
+        # Group the disks by the tile of their centers
+        tile_col = np.floor((x - self.left) / self.xres / SITE_TILE_SIZE)
+        tile_row = np.floor((self.top - y) / self.yres / SITE_TILE_SIZE)
+        tiles = pd.Series(np.arange(len(x))).groupby(
+            [tile_row, tile_col]).indices
+
+        for disks in tiles.values():
+            dx, dy, dr = x[disks], y[disks], radius[disks]
+            col0 = int(math.floor(((dx - dr).min() - self.left) / self.xres))
+            col1 = int(math.ceil(((dx + dr).max() - self.left) / self.xres))
+            row0 = int(math.floor((self.top - (dy + dr).max()) / self.yres))
+            row1 = int(math.ceil((self.top - (dy - dr).min()) / self.yres))
+            col0, row0 = max(col0, 0), max(row0, 0)
+            col1 = min(col1, self.raster.width)
+            row1 = min(row1, self.raster.height)
+            if col1 <= col0 or row1 <= row0:
+                continue
+
+            window = ((row0, row1), (col0, col1))
+            density = self.raster.read(1, window=window, masked=True)
+            labels = self.labels.read(1, window=window)
+
+            # Region position of each pixel, -1 if invalid or unlabelled
+            regions = np.where(labels >= 0, self.label_positions[labels], -1)
+            regions[np.ma.getmaskarray(density)] = -1
+            values = density.data.astype(float)
+
+            # The pixel bounds of each disk within the window
+            c0 = np.floor((dx - dr - self.left) / self.xres).astype(int) - col0
+            c1 = np.ceil((dx + dr - self.left) / self.xres).astype(int) - col0
+            r0 = np.floor((self.top - dy - dr) / self.yres).astype(int) - row0
+            r1 = np.ceil((self.top - dy + dr) / self.yres).astype(int) - row0
+            c0, r0 = np.maximum(c0, 0), np.maximum(r0, 0)
+            width = np.maximum(np.minimum(c1, col1 - col0) - c0, 0)
+            height = np.maximum(np.minimum(r1, row1 - row0) - r0, 0)
+            areas = width * height
+
+            # Test all (disk, pixel) pairs of the bounds, in chunks of disks
+            ends = np.cumsum(areas)
+            start = 0
+            while start < len(disks):
+                stop = max(
+                    np.searchsorted(
+                        ends, ends[start] - areas[start] + SITE_BATCH_ELEMENTS,
+                        side='right'),
+                    start + 1)
+                chunk = slice(start, stop)
+                start = stop
+
+                disk = np.repeat(np.arange(stop - chunk.start), areas[chunk])
+                offset = np.arange(len(disk)) - np.repeat(
+                    ends[chunk] - areas[chunk] - ends[chunk.start] +
+                    areas[chunk.start], areas[chunk])
+                w = width[chunk][disk]
+                rows = r0[chunk][disk] + offset // np.maximum(w, 1)
+                cols = c0[chunk][disk] + offset % np.maximum(w, 1)
+
+                # Pixels are in a disk if their centers are
+                cx = self.left + (cols + col0 + 0.5) * self.xres
+                cy = self.top - (rows + row0 + 0.5) * self.yres
+                pixel_regions = regions[rows, cols]
+                inside = (
+                    ((cx - dx[chunk][disk]) ** 2 + (cy - dy[chunk][disk]) ** 2
+                     <= dr[chunk][disk] ** 2) &
+                    (pixel_regions >= 0))
+
+                n_disks = stop - chunk.start
+                sums[disks[chunk]] = np.bincount(
+                    disk[inside] * n_regions + pixel_regions[inside],
+                    weights=values[rows[inside], cols[inside]],
+                    minlength=n_disks * n_regions).reshape(n_disks, n_regions)
+
+        return sums
+
+    def close(self):
+        self.raster.close()
+        self.labels.close()
+
+
+class SiteEngine(object):
+    """
+    Substrates and optimized biogas production at arbitrary plant sites.
+
+    Computes the same thing as a sampling run does for its grid centers,
+    but for any (x, y, r) on the fly: the density rasters are summed within
+    the disk per region, using a cached raster of region labels, and
+    the sums are divided by the regional sums to get the sample fractions.
+
+    Args:
+        params: The parameters. Default parameters.defaults().
+    """
+    def __init__(self, params=None):
+        super(SiteEngine, self).__init__()
+        if params is None:
+            params = parameters.defaults()
+        self.params = params
+
+        region_substrates = results.get_substrates(params)
+        self.keys = results.get_included_nuts_codes()
+        self.region_substrates = region_substrates.reindex(self.keys).fillna(0)
+        self.columns = self.region_substrates.columns
+        self.lp = results.compile_lp(params)
+
+        densities = self.columns.get_level_values('density').unique()
+        self.densities = {name: _Density(name, self.keys) for name in densities}
+
+    def batch_fractions(self, x, y, radius):
+        """
+        Fractions of each region's density within disks.
+
+        Args:
+            x, y: Arrays of centers in map coordinates (EPSG:3035).
+            radius: Radii in km, an array or a scalar.
+
+        Returns:
+            An array (disks, regions, densities), with densities in the
+            order of self.densities.
+        """
+        radius = np.asarray(radius, dtype=float) * constants.M_PER_KM
+        n = len(self.keys)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            fracs = np.stack([
+                density.region_sums(x, y, radius, n) / density.regional_sums
+                for density in self.densities.values()], axis=-1)
+        return np.nan_to_num(fracs)
+
+    def fractions(self, x, y, radius=None):
+        """
+        Fractions of each region's density within a disk.
+
+        Args:
+            x, y: Center in map coordinates (EPSG:3035).
+            radius: Radius in km. Default params['RADIUS'].
+
+        Returns: DataFrame.
+            Rows: NUTS regions. Columns: densities.
+        """
+        if radius is None:
+            radius = self.params['RADIUS']
+        fracs = self.batch_fractions([x], [y], radius)[0]
+        return pd.DataFrame(fracs, index=self.keys, columns=list(self.densities))
+
+    def substrates(self, sites):
+        """
+        Available substrates at sites.
+
+        The sites are summed together, tile by tile, see
+        _Density.region_sums().
+
+        Args:
+            sites: DataFrame with columns x, y and optionally r (km).
+
+        Returns: DataFrame.
+            Rows: like sites. Columns: 2-level index (density, substrate).
+        """
+        radii = sites['r'].values if 'r' in sites else self.params['RADIUS']
+        fracs = self.batch_fractions(sites['x'].values, sites['y'].values, radii)
+
+        result = np.zeros((len(sites), len(self.columns)))
+        densities = self.columns.get_level_values('density')
+        for i, name in enumerate(self.densities):
+            cols = np.flatnonzero(densities == name)
+            result[:, cols] = fracs[:, :, i].dot(
+                self.region_substrates.values[:, cols])
+
+        return pd.DataFrame(result, index=sites.index, columns=self.columns)
+
+    def query_many(self, sites, processes=1):
+        """
+        Optimized biogas production at sites.
+
+        Args:
+            sites: DataFrame with columns x, y and optionally r (km).
+            processes: Number of worker processes for the LP stage.
+
+        Returns: DataFrame.
+            Rows: like sites. Columns: x, y, r, production (MW),
+            density (MW/km^2) and the utilized substrates (Mg VS / year).
+        """
+        substrates = self.substrates(sites)
+        points = substrates[self.lp.indices].values
+        utilized = results.solve_lp_rows(self.lp, points, processes=processes)
+
+        radii = sites['r'] if 'r' in sites else self.params['RADIUS']
+        production = utilized.dot(-self.lp.c)
+
+        result = pd.DataFrame({
+            'x': sites['x'],
+            'y': sites['y'],
+            'r': np.broadcast_to(radii, len(sites)),
+            'production': production,
+            'density': production / (np.pi * np.asarray(radii) ** 2)},
+            index=sites.index,
+            columns=['x', 'y', 'r', 'production', 'density'])
+        utilized = pd.DataFrame(
+            utilized, index=sites.index,
+            columns=['{}/{}'.format(*key) for key in self.lp.indices])
+
+        return pd.concat([result, utilized], axis=1)
+
+    def query(self, x, y, radius=None):
+        """Optimized biogas production at one site. See query_many()."""
+        if radius is None:
+            radius = self.params['RADIUS']
+        sites = pd.DataFrame({'x': [x], 'y': [y], 'r': [radius]})
+        return self.query_many(sites).iloc[0]
+
+    def close(self):
+        for density in self.densities.values():
+            density.close()
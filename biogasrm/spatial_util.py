@@ -2,21 +2,47 @@
 
 import os
 import json
+import contextlib
+import shutil
+import subprocess
+import tempfile
 
 import rasterio
-from rasterstats import zonal_stats
+import rasterio.crs
+import rasterio.features
+import rasterio.transform
+from rasterio.enums import Resampling
 import shapely
+import shapely.geometry
 import fiona
 import numpy as np
 import pandas as pd
-import gdal
-import click
 
-def transform(in_path, out_path, func, band=1, masked=False, **options):
-    #make output raster with **options
-    #loop over chunks in input raster
-    #transform chunks with func and write to output raster
-    #close
+import biogasrm.instrument as instrument
+from biogasrm.raster_options import (
+    RASTER_LAYOUTS, RASTER_COMPRESSIONS, COMPRESSION_GDAL_VERSIONS,
+    DEFAULT_BLOCKSIZE, DEFAULT_MEMORY_BUDGET, raster_output_options)
+
+# Rough number of bytes used per pixel of a window while processing it
+# (the data, masks and temporary arrays), to size windows for a budget.
+WINDOW_BYTES_PER_PIXEL = 32
+
+
+def transform(in_path, out_path, func, band=1, masked=False,
+              memory_budget=None, **options):
+    """Apply a function to a raster, band of rows by band of rows.
+
+    Args:
+        in_path: The input raster.
+        out_path: The output raster.
+        func: Function from an array of input values to an array of
+            output values (of the output dtype).
+        band: The band to transform.
+        masked: Whether to pass func masked arrays.
+        memory_budget: MB of data to process at a time. Default
+            DEFAULT_MEMORY_BUDGET.
+        **options: Updates to the output profile (dtype, nodata, etc.).
+    """
 
     if not isinstance(band, int):
         raise ValueError('only single bands supported for now')
@@ -24,8 +50,12 @@ def transform(in_path, out_path, func, band=1, masked=False, **options):
     with rasterio.open(in_path) as src:
         profile = src.profile
         profile.update(options)
+        rows = band_height_for_budget(
+            memory_budget, src.width, multiple=src.block_shapes[band-1][0])
         with rasterio.open(out_path, 'w', **profile) as dst:
-            for ji, window in src.block_windows(band):
+            windows = iter_row_bands(src.height, src.width, rows)
+            total = -(-src.height // rows)
+            for window in instrument.progress(windows, 'raster blocks', total):
                 block = src.read(indexes=band, window=window, masked=masked)
                 transformed = func(block)
                 assert transformed.dtype == profile['dtype']
@@ -34,43 +64,357 @@ def transform(in_path, out_path, func, band=1, masked=False, **options):
                     transformed = transformed.filled(nodata)
                 dst.write(transformed, indexes=band, window=window)
 
-def coverage(raster, regions, key_property=None):
+def coverage(raster, regions, key_property=None, memory_budget=None):
+    """The fraction of each region's area covered by valid raster pixels.
+
+    Args:
+        raster: Path to the raster.
+        regions: Path to a vector file with the regions.
+        key_property: The property identifying the regions. Default 'id'.
+        memory_budget: MB of data to process at a time. Default
+            DEFAULT_MEMORY_BUDGET.
+
+    Returns:
+        A dict {key: coverage}.
+    """
     if key_property is None:
         key_property = 'id'
 
-    with rasterio.open(raster) as r:
-        res = r.res
-        cell_area = res[0] * res[1]
+    keys, geometries = read_regions(regions, key_property)
+    window_size = window_size_for_budget(memory_budget)
 
-    def _not_nodata(x):
-        return (~x.mask).sum()
+    with rasterio.open(raster) as src:
+        cell_area = src.res[0] * src.res[1]
+        counts = [
+            count for count, _ in zonal_sums(
+                src, instrument.progress(geometries, 'regions'), window_size)]
 
-    with fiona.open(regions) as features:
-        key_mapping = {}
+    result = {
+        key: count * cell_area / geometry.area
+        for key, geometry, count in zip(keys, geometries, counts)}
 
-        areas = {}
-        keys = []
+    return result
 
-        stats = zonal_stats(
-            features,
-            raster,
-            stats='',
-            add_stats={'count':_not_nodata},
-            geojson_out=True)
 
-    def _coverage(item):
-        count = item['properties']['count']
-        total_area = shapely.geometry.shape(item['geometry']).area
-        return count * cell_area / total_area
+def regional_sums(raster, regions, key_property, memory_budget=None):
+    """The sum of a raster within each region.
 
-    result = {
-        item['properties'][key_property]: _coverage(item)
-        for item in stats}
+    Args:
+        raster: Path to the raster.
+        regions: Path to a vector file with the regions.
+        key_property: The property identifying the regions.
+        memory_budget: MB of data to process at a time. Default
+            DEFAULT_MEMORY_BUDGET.
+
+    Returns:
+        A dict {key: sum}, without regions which have no valid pixels.
+    """
+    keys, geometries = read_regions(regions, key_property)
+    window_size = window_size_for_budget(memory_budget)
+
+    with rasterio.open(raster) as src:
+        sums = [
+            total for _, total in zonal_sums(
+                src, instrument.progress(geometries, 'regions'), window_size)]
+
+    return {key: total for key, total in zip(keys, sums) if total is not None}
+
+
+def zonal_sums(dataset, geometries, window_size=1024):
+    """Count and sum the valid pixels of a raster within geometries.
+
+    Pixels are counted in a geometry if their centers are inside it, like
+    in rasterstats. The pixels within the bounds of each geometry are read
+    in windows of at most window_size by window_size pixels, so the memory
+    use does not grow with the size of the geometries.
+
+    Args:
+        dataset: An open rasterio dataset. Band 1 is used.
+        geometries: An iterable of shapely geometries.
+        window_size: The maximal height and width of the windows read.
+
+    Yields:
+        (count, sum) for each geometry. The sum is None if the count is 0.
+    """
+    left, _, _, top = dataset.bounds
+    xres, yres = dataset.res
+
+    for geometry in geometries:
+        count, total = 0, 0.0
+        if geometry.is_empty:
+            yield count, None
+            continue
+
+        xmin, ymin, xmax, ymax = geometry.bounds
+        col0 = max(int(np.floor((xmin - left) / xres)), 0)
+        col1 = min(int(np.ceil((xmax - left) / xres)), dataset.width)
+        row0 = max(int(np.floor((top - ymax) / yres)), 0)
+        row1 = min(int(np.ceil((top - ymin) / yres)), dataset.height)
+
+        if col1 > col0 and row1 > row0:
+            windows = iter_windows(row1 - row0, col1 - col0, window_size)
+            for (r0, r1), (c0, c1) in windows:
+                window = ((row0 + r0, row0 + r1), (col0 + c0, col0 + c1))
+                data = dataset.read(1, window=window, masked=True)
+                inside = ~rasterio.features.geometry_mask(
+                    [geometry], data.shape, dataset.window_transform(window))
+                inside &= ~np.ma.getmaskarray(data)
+                count += int(inside.sum())
+                total += float(data.data[inside].sum(dtype=np.float64))
 
+        yield count, (total if count else None)
+
+
+def window_sums(dataset, geometries, bounds, window_size=1024):
+    """Count and sum the valid pixels of a raster within nearby geometries.
+
+    Like zonal_sums(), but for geometries within a small area, e.g. the
+    pieces of a disk in different regions: the raster is read once for
+    the bounds of the area instead of once per geometry. If the area is
+    larger than window_size by window_size pixels, zonal_sums() is used.
+
+    Args:
+        dataset: An open rasterio dataset. Band 1 is used.
+        geometries: A list of shapely geometries within bounds.
+        bounds: (xmin, ymin, xmax, ymax) of the area.
+        window_size: The maximal height and width of the windows read.
+
+    Returns:
+        A list of (count, sum) for each geometry. The sum is None if the
+        count is 0.
+    """
+    left, _, _, top = dataset.bounds
+    xres, yres = dataset.res
+
+    xmin, ymin, xmax, ymax = bounds
+    col0 = max(int(np.floor((xmin - left) / xres)), 0)
+    col1 = min(int(np.ceil((xmax - left) / xres)), dataset.width)
+    row0 = max(int(np.floor((top - ymax) / yres)), 0)
+    row1 = min(int(np.ceil((top - ymin) / yres)), dataset.height)
+
+    if col1 <= col0 or row1 <= row0:
+        return [(0, None)] * len(geometries)
+    if (row1 - row0) * (col1 - col0) > window_size ** 2:
+        return list(zonal_sums(dataset, geometries, window_size))
+
+    window = ((row0, row1), (col0, col1))
+    data = dataset.read(1, window=window, masked=True)
+    valid = ~np.ma.getmaskarray(data)
+    transform = dataset.window_transform(window)
+
+    result = []
+    for geometry in geometries:
+        if geometry.is_empty:
+            result.append((0, None))
+            continue
+        inside = ~rasterio.features.geometry_mask(
+            [geometry], data.shape, transform)
+        inside &= valid
+        count = int(inside.sum())
+        total = float(data.data[inside].sum(dtype=np.float64))
+        result.append((count, total if count else None))
     return result
 
 
-def make_raster_array(values, step, nodata=None, dtype=None):
+def merge(src_paths, dst_path, memory_budget=None):
+    """Merge rasters, band of rows by band of rows.
+
+    Like rio merge, the first valid value (in the order of src_paths) is
+    used for each pixel. The output has the grid of the first raster, and
+    the others are resampled to it (nearest neighbor) if needed. All
+    rasters must have the same CRS and number of bands.
+
+    Args:
+        src_paths: The rasters to merge.
+        dst_path: The output raster, with the profile of the first one.
+        memory_budget: MB of data to process at a time. Default
+            DEFAULT_MEMORY_BUDGET.
+    """
+    sources = [rasterio.open(path) for path in src_paths]
+    try:
+        first = sources[0]
+        for src in sources[1:]:
+            if src.crs != first.crs or src.count != first.count:
+                raise ValueError(
+                    'Rasters {} and {} have different CRS or bands'.format(
+                        first.name, src.name))
+
+        profile = first.profile
+        nodata = first.nodata if first.nodata is not None else 0
+        # Finer sources are read at their own resolution
+        pixels_read = sum(
+            max(1, pixel_area(first) / pixel_area(src)) for src in sources)
+        rows = band_height_for_budget(
+            memory_budget, first.width,
+            bytes_per_pixel=WINDOW_BYTES_PER_PIXEL * pixels_read,
+            multiple=first.block_shapes[0][0])
+
+        with rasterio.open(dst_path, 'w', **profile) as dst:
+            windows = iter_row_bands(first.height, first.width, rows)
+            total = -(-first.height // rows)
+            for window in instrument.progress(windows, 'raster blocks', total):
+                merged = first.read(window=window, masked=True)
+                transform = first.window_transform(window)
+                for src in sources[1:]:
+                    missing = np.ma.getmaskarray(merged)
+                    if not missing.any():
+                        break
+                    if same_grid(src, first):
+                        data = src.read(window=window, masked=True)
+                    else:
+                        data = read_nearest(src, transform, merged.shape[1:])
+                    merged[missing] = data[missing]
+                dst.write(
+                    merged.filled(nodata).astype(profile['dtype']),
+                    window=window)
+    finally:
+        for src in sources:
+            src.close()
+
+
+def warp_merge(src_paths, dst_path, like, resolution=None,
+               memory_budget=None):
+    """Warp rasters to the CRS and extent of another one, and merge them.
+
+    Does what rio warp followed by rio merge does, without intermediate
+    rasters: the output is written band of rows by band of rows, and each
+    band is warped (nearest neighbor) from the sources directly. The
+    sources may be GDAL virtual paths, e.g. /vsizip/archive.zip/file.tif.
+    The first valid value (in the order of src_paths) is used for each
+    pixel.
+
+    Args:
+        src_paths: The rasters to merge (band 1 of each).
+        dst_path: The output raster (tiled GeoTIFF), with the data type and
+            nodata value of the first source.
+        like: A raster with the CRS and bounds of the output.
+        resolution: Output resolution in the units of the CRS. Default the
+            resolution of like.
+        memory_budget: MB of data to process at a time. Default
+            DEFAULT_MEMORY_BUDGET.
+    """
+    import rasterio.warp
+
+    with rasterio.open(like) as template:
+        crs = template.crs
+        left, bottom, right, top = template.bounds
+        if resolution is None:
+            resolution = template.res[0]
+
+    width = int(np.ceil((right - left) / resolution))
+    height = int(np.ceil((top - bottom) / resolution))
+    transform = rasterio.transform.from_origin(
+        left, top, resolution, resolution)
+
+    sources = [rasterio.open(path) for path in src_paths]
+    try:
+        first = sources[0]
+        dtype = first.dtypes[0]
+        nodata = first.nodata if first.nodata is not None else -1
+        profile = {
+            'driver': 'GTiff',
+            'count': 1,
+            'dtype': dtype,
+            'nodata': nodata,
+            'crs': crs,
+            'transform': transform,
+            'width': width,
+            'height': height,
+        }
+        rows = band_height_for_budget(
+            memory_budget, width,
+            bytes_per_pixel=WINDOW_BYTES_PER_PIXEL * len(sources),
+            multiple=DEFAULT_BLOCKSIZE)
+
+        with open_raster_output(dst_path, profile, layout='tiled') as dst:
+            windows = iter_row_bands(height, width, rows)
+            total = -(-height // rows)
+            for window in instrument.progress(windows, 'raster blocks', total):
+                (row0, row1), (col0, col1) = window
+                shape = (row1 - row0, col1 - col0)
+                band_transform = rasterio.transform.from_origin(
+                    left + col0 * resolution, top - row0 * resolution,
+                    resolution, resolution)
+                merged = np.full(shape, nodata, dtype=dtype)
+                missing = np.ones(shape, dtype=bool)
+                for src in sources:
+                    data = np.full(shape, nodata, dtype=dtype)
+                    rasterio.warp.reproject(
+                        source=rasterio.band(src, 1),
+                        destination=data,
+                        src_nodata=src.nodata,
+                        dst_transform=band_transform,
+                        dst_crs=crs,
+                        dst_nodata=nodata,
+                        resampling=rasterio.warp.Resampling.nearest)
+                    valid = missing & (data != nodata)
+                    merged[valid] = data[valid]
+                    missing &= ~valid
+                    if not missing.any():
+                        break
+                dst.write(merged, 1, window=window)
+    finally:
+        for src in sources:
+            src.close()
+
+
+def pixel_area(dataset):
+    """The area of a pixel of a raster, in map units."""
+    return dataset.res[0] * dataset.res[1]
+
+
+def same_grid(a, b):
+    """Whether two rasters have the same CRS, extent and resolution."""
+    return a.crs == b.crs and a.shape == b.shape and a.bounds == b.bounds
+
+
+def read_nearest(dataset, transform, shape, indexes=None):
+    """Read a raster resampled to another grid, by nearest neighbor.
+
+    Each pixel of the grid gets the value of the raster pixel containing
+    its center. Only the part of the raster covering the grid is read.
+
+    Args:
+        dataset: An open rasterio dataset, north up.
+        transform: The Affine transform of the grid (e.g. of a window of
+            another raster), in the CRS of dataset and north up.
+        shape: The (rows, cols) shape of the grid.
+        indexes: Band index or list of band indexes like in
+            dataset.read(). Default all bands.
+
+    Returns:
+        A masked array of shape (bands, rows, cols), or (rows, cols) if
+        indexes is an int. Pixels outside the raster are masked.
+    """
+    if indexes is None:
+        indexes = list(range(1, dataset.count + 1))
+    bands = () if isinstance(indexes, int) else (len(indexes),)
+    dtype = dataset.dtypes[0]
+    result = np.ma.masked_all(bands + tuple(shape), dtype=dtype)
+
+    left, _, _, top = dataset.bounds
+    xres, yres = dataset.res
+    x = transform.c + transform.a * (np.arange(shape[1]) + 0.5)
+    y = transform.f + transform.e * (np.arange(shape[0]) + 0.5)
+    cols = np.floor((x - left) / xres).astype(int)
+    rows = np.floor((top - y) / yres).astype(int)
+    col_ok = (cols >= 0) & (cols < dataset.width)
+    row_ok = (rows >= 0) & (rows < dataset.height)
+    if not (col_ok.any() and row_ok.any()):
+        return result
+
+    c0, c1 = cols[col_ok].min(), cols[col_ok].max() + 1
+    r0, r1 = rows[row_ok].min(), rows[row_ok].max() + 1
+    data = dataset.read(indexes, window=((r0, r1), (c0, c1)), masked=True)
+    out_rows = np.flatnonzero(row_ok)[:, np.newaxis]
+    out_cols = np.flatnonzero(col_ok)[np.newaxis, :]
+    result[..., out_rows, out_cols] = data[
+        ..., rows[out_rows] - r0, cols[out_cols] - c0]
+    return result
+
+
+def make_raster_array(values, step, nodata=None, dtype=None,
+                      lattice='square', tol=1e-3):
     """
     Make a raster from dictionary
 
@@ -80,70 +424,399 @@ def make_raster_array(values, step, nodata=None, dtype=None):
         step (number): The step size (xstep == ystep) to accept values at.
         nodata (number): The value to use if no value is provided.
         dtype: The data type of the raster.
+        lattice: 'square' for points on the grid, or 'hex' for the centers
+            of the matching hexagonal lattice (see sample.hex_spacing()),
+            which are resampled to the grid by nearest neighbour.
+        tol (number): Maximal deviation from the grid, in steps.
 
-    Asserts that values are either (1) missing or (2) situated at an
-    even number of steps from the top left (x, y) pair.
+    Returns:
+        A MaskedArray and the rasterio Affine transform of the raster, as
+        points_to_raster_array(), which does the same thing with arrays.
 
+    Raises:
+        ValueError if there are no values or they are not situated at an
+        even number of steps (within tol) from the top left (x, y) pair.
     """
 
-    # Move points so that the cells have the points in the middle
-    # (only tested when making EPSG:3035; may give bad results for other projs)
-    values = {
-        (x - step / 2, y + step / 2): value for (x, y), value in values.items()
-    }
-    points = iter(values)
-    topleft_x, topleft_y = next(points)
-    bottomright_x, bottomright_y = topleft_x, topleft_y
-    for x, y in points:
-        topleft_x = min(x, topleft_x)
-        topleft_y = max(y, topleft_y)
-        bottomright_x = max(x, bottomright_x)
-        bottomright_y = min(y, bottomright_y)
-
-    # Make a rasterio-style transformation from map coordinates
-    # to raster coordinates:
-    T = ~rasterio.transform.from_origin(topleft_x, topleft_y, step, step)
-
-    colmax, rowmax = T * (bottomright_x, bottomright_y)
-
-    def almost_int(n, tol=1e-3):
-        answer = abs(round(n) - n) < tol
-        if not answer:
-            print(n)
-        return answer
-    assert almost_int(colmax)
-    assert almost_int(rowmax)
-    colmax = int(colmax)
-    rowmax = int(rowmax)
-
-    shape = (rowmax + 1, colmax + 1)
+    points = list(values.keys())
+    x = [p[0] for p in points]
+    y = [p[1] for p in points]
+    data = [values[p] for p in points]
+    if lattice == 'hex':
+        x, y, data = resample_nearest(
+            x, y, data, step, max_distance=step / np.sqrt(2))
+    return points_to_raster_array(
+        x, y, data, step, nodata=nodata, dtype=dtype, tol=tol)
+
+
+def points_to_raster_array(x, y, values, step, nodata=None, dtype=None,
+                           tol=1e-3):
+    """
+    Make a raster from arrays of point coordinates and values.
+
+    The points are the centers of the raster cells. Each point is placed
+    in its cell with one vectorized operation.
+
+    Args:
+        x, y (array-like): Map coordinates of the points, e.g. the
+            'x' and 'y' levels of a Series MultiIndex.
+        values (array-like): The values, either one per point, or
+            a 2D array (points x bands) to make a multi-band raster.
+        step (number): The step size (xstep == ystep) to accept values at.
+        nodata (number): The value to use if no value is provided.
+        dtype: The data type of the raster. Default the dtype of values.
+        tol (number): Maximal deviation from the grid, in steps.
+
+    Returns:
+        A MaskedArray, 2D (rows, cols) or 3D (bands, rows, cols), and
+        the rasterio Affine transform of the raster.
+
+    Raises:
+        ValueError if there are no points or they are not situated at
+        an even number of steps (within tol) from the top left (x, y) pair.
+    """
+
+    values = np.asarray(values)
+    if dtype is None:
+        dtype = values.dtype
+
+    irows, icols, shape, transform = points_grid(x, y, step, tol=tol)
+    if values.ndim == 2:
+        shape = (values.shape[1],) + shape
 
     data = np.zeros(shape, dtype=dtype)
     mask = np.ones(shape, dtype=bool)
 
-    for point, value in values.items():
-        col, row = T * point
-        assert almost_int(col)
-        assert almost_int(row)
-        col, row = map(int, (col, row))
-        data[row, col] = value
-        mask[row, col] = False
+    if values.ndim == 2:
+        data[:, irows, icols] = values.T
+        mask[:, irows, icols] = False
+    else:
+        data[irows, icols] = values
+        mask[irows, icols] = False
 
     raster = np.ma.array(data, mask=mask, fill_value=nodata)
+
+    return raster, transform
+
+
+def points_grid(x, y, step, tol=1e-3):
+    """
+    Place points in the cells of the smallest raster with them in the middle.
+
+    Args:
+        x, y (array-like): Map coordinates of the points.
+        step (number): The cell size.
+        tol (number): Maximal deviation from the grid, in steps.
+
+    Returns:
+        Arrays of the row and column of each point, the shape (rows, cols)
+        of the raster and its rasterio Affine transform.
+
+    Raises:
+        ValueError as points_to_raster_array().
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if len(x) == 0:
+        raise ValueError('no points to make a raster from')
+
+    # Move points so that the cells have the points in the middle
+    # (only tested when making EPSG:3035; may give bad results for other projs)
+    left = x - step / 2
+    top = y + step / 2
+    topleft_x, topleft_y = left.min(), top.max()
+
+    cols = (left - topleft_x) / step
+    rows = (topleft_y - top) / step
+    icols = np.round(cols).astype(int)
+    irows = np.round(rows).astype(int)
+
+    deviation = max(
+        np.abs(cols - icols).max(), np.abs(rows - irows).max())
+    if not deviation < tol:
+        raise ValueError(
+            'points deviate up to {} steps from a grid with step {}'.format(
+                deviation, step))
+
+    shape = (irows.max() + 1, icols.max() + 1)
     transform = rasterio.transform.from_origin(
         topleft_x, topleft_y, step, step)
+    return irows, icols, shape, transform
 
-    return raster, transform
+def resample_nearest(x, y, values, step, max_distance):
+    """
+    Resample scattered points to a regular grid by nearest neighbour.
 
-def write_raster(path, array, transform, crs):
-    """Write a 1-band GeoTIFF
+    The grid nodes are the multiples of step within the bounding box of
+    the points. Nodes without any point within max_distance are left out,
+    so that the result does not spread beyond the sampled area.
+
+    Args:
+        x, y (array-like): Map coordinates of the points.
+        values (array-like): One value per point, or a 2D array
+            (points x bands).
+        step (number): The grid step.
+        max_distance (number): How far to look for a point.
+
+    Returns:
+        Arrays x, y and values for the grid nodes, which can be given
+        to points_to_raster_array().
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    values = np.asarray(values)
+    if len(x) == 0:
+        raise ValueError('no points to resample')
+
+    cols = np.arange(np.ceil(x.min() / step), np.floor(x.max() / step) + 1)
+    rows = np.arange(np.ceil(y.min() / step), np.floor(y.max() / step) + 1)
+    grid_x, grid_y = np.meshgrid(cols * step, rows * step)
+    grid_x, grid_y = grid_x.ravel(), grid_y.ravel()
+
+    import scipy.spatial
+    tree = scipy.spatial.cKDTree(np.column_stack([x, y]))
+    distance, nearest = tree.query(
+        np.column_stack([grid_x, grid_y]),
+        distance_upper_bound=max_distance * (1 + 1e-9))
+    found = np.isfinite(distance)
+
+    return grid_x[found], grid_y[found], values[nearest[found]]
+
+
+def lattice_sums(path, step, bounds, window_size=1024):
+    """
+    Sum a raster in square cells aligned with multiples of step.
+
+    Each pixel is counted in the cell containing its center. The raster is
+    read window by window, so it may be much larger than memory.
+
+    Args:
+        path: The raster.
+        step (number): The cell size, in map units.
+        bounds: (xmin, ymin, xmax, ymax) to cover, widened to whole cells.
+
+    Returns:
+        A 2D array of sums, with row 0 at the bottom (y increasing with the
+        row number), and the (column, row) multiples of step of its
+        lower left corner.
+    """
+    xmin, ymin, xmax, ymax = bounds
+    col0 = int(np.floor(xmin / step))
+    row0 = int(np.floor(ymin / step))
+    shape = (
+        int(np.ceil(ymax / step)) - row0,
+        int(np.ceil(xmax / step)) - col0)
+    sums = np.zeros(shape[0] * shape[1])
+
+    with rasterio.open(path) as src:
+        left, _, _, top = src.bounds
+        xres, yres = src.res
+        windows = iter_windows(src.height, src.width, window_size)
+        total = window_count(src.height, src.width, window_size)
+        for window in instrument.progress(windows, 'raster blocks', total):
+            (r0, r1), (c0, c1) = window
+            data = src.read(1, window=window, masked=True)
+            cx = left + (np.arange(c0, c1) + 0.5) * xres
+            cy = top - (np.arange(r0, r1) + 0.5) * yres
+            cols = np.floor(cx / step).astype(int) - col0
+            rows = np.floor(cy / step).astype(int) - row0
+            rows, cols = np.meshgrid(rows, cols, indexing='ij')
+            ok = (
+                ~np.ma.getmaskarray(data) &
+                (rows >= 0) & (rows < shape[0]) &
+                (cols >= 0) & (cols < shape[1]))
+            if not ok.any():
+                continue
+            sums += np.bincount(
+                rows[ok] * shape[1] + cols[ok],
+                weights=data.data[ok].astype(float),
+                minlength=len(sums))
+
+    return sums.reshape(shape), (col0, row0)
+
+
+def raster_creation_options(layout='plain', compress=None, dtype=None,
+                            sparse=False, blocksize=DEFAULT_BLOCKSIZE):
+    """GeoTIFF creation options for an output layout.
+
+    Args:
+        layout: One of RASTER_LAYOUTS.
+        compress: One of RASTER_COMPRESSIONS, or None for no compression.
+        dtype: The data type of the raster, to choose the predictor.
+        sparse: Whether to omit blocks containing only nodata.
+        blocksize: Tile width and height for tiled layouts.
+
+    Returns:
+        A dict of creation options, to update a rasterio profile with.
+    """
+    if layout not in RASTER_LAYOUTS:
+        raise ValueError('unknown raster layout {}'.format(layout))
+
+    options = {}
+    if layout in ('tiled', 'cog'):
+        options.update(tiled=True, blockxsize=blocksize, blockysize=blocksize)
+
+    if compress not in (None, 'none'):
+        if compress not in RASTER_COMPRESSIONS:
+            raise ValueError('unknown compression {}'.format(compress))
+        options['compress'] = compress
+        if dtype is not None:
+            floating = np.issubdtype(np.dtype(dtype), np.floating)
+            # Floating point predictor for floats, else horizontal differencing
+            options['predictor'] = 3 if floating else 2
+
+    if sparse:
+        options['sparse_ok'] = True
+
+    return options
+
+
+def overview_factors(width, height, blocksize=DEFAULT_BLOCKSIZE):
+    """Overview decimation factors 2, 4, 8, ... down to about one block."""
+    factors = []
+    factor = 2
+    while max(width, height) / factor >= blocksize / 2:
+        factors.append(factor)
+        factor *= 2
+    return factors
+
+
+def gdal_version():
+    """The version of the GDAL library used by rasterio, e.g. (2, 1, 4)."""
+    version = getattr(rasterio, '__gdal_version__', None)
+    if version is None:
+        from rasterio._base import gdal_version as _gdal_version
+        version = _gdal_version()
+    return tuple(int(part) for part in version.split('.')[:3] if part.isdigit())
+
+
+def _has_rasterio_shutil():
+    try:
+        import rasterio.shutil
+    except ImportError:
+        return False
+    return True
+
+
+def check_raster_output(layout='plain', compress=None, overviews=False,
+                        sparse=False, blocksize=DEFAULT_BLOCKSIZE):
+    """Check that an output layout can be written with the installed GDAL.
+
+    Takes the arguments of open_raster_output(), to be called before
+    anything is computed or written.
+
+    Raises:
+        ValueError if the layout or compression is unknown or not
+        supported here: zstd needs GDAL >= 2.3, and cog needs rasterio
+        >= 1.0 or the gdal_translate program of GDAL.
+    """
+    raster_creation_options(layout, compress=compress)
+
+    required = COMPRESSION_GDAL_VERSIONS.get(compress)
+    if required is not None and gdal_version() < required:
+        raise ValueError(
+            '{} compression needs GDAL >= {}, but GDAL {} is installed'.format(
+                compress, '.'.join(map(str, required)),
+                '.'.join(map(str, gdal_version()))))
+
+    if layout == 'cog' and not _has_rasterio_shutil():
+        if shutil.which('gdal_translate') is None:
+            raise ValueError(
+                'the cog layout needs rasterio >= 1.0 or gdal_translate '
+                'on the PATH')
+
+
+def _copy_with_overviews(src_path, dst_path, options):
+    """Copy a GeoTIFF with its overviews, storing them before the image data.
+
+    Uses rasterio.shutil (rasterio >= 1.0) if available, else
+    gdal_translate with COPY_SRC_OVERVIEWS=YES (GDAL >= 1.8).
+    """
+    if _has_rasterio_shutil():
+        import rasterio.shutil
+        rasterio.shutil.copy(
+            src_path, dst_path, driver='GTiff', copy_src_overviews=True,
+            **options)
+        return
+
+    command = ['gdal_translate', '-q', '-of', 'GTiff',
+               '-co', 'COPY_SRC_OVERVIEWS=YES']
+    for key, value in sorted(options.items()):
+        if isinstance(value, bool):
+            value = 'YES' if value else 'NO'
+        command += ['-co', '{}={}'.format(key.upper(), str(value).upper())]
+    subprocess.check_call(command + [src_path, dst_path])
+
+
+@contextlib.contextmanager
+def open_raster_output(path, profile, layout='plain', compress=None,
+                       overviews=False, sparse=False,
+                       blocksize=DEFAULT_BLOCKSIZE):
+    """Open a GeoTIFF for writing with a given output layout.
+
+    For the 'cog' layout the raster is written to a temporary file next to
+    path, and copied to path with its overviews when the context exits.
 
     Args:
         path: File path to save.
-        array: Numpy array or MaskedArray.
+        profile: The rasterio profile (driver, dtype, transform, etc.).
+        layout: One of RASTER_LAYOUTS.
+        compress: One of RASTER_COMPRESSIONS, or None for no compression.
+        overviews: Whether to build internal overviews. Always done for
+            the 'cog' layout.
+        sparse: Whether to omit blocks containing only nodata.
+        blocksize: Tile width and height for tiled layouts.
+
+    Yields:
+        The open dataset.
+
+    Raises:
+        ValueError if the layout or compression is not supported, see
+        check_raster_output(). Checked before the dataset is opened.
+    """
+    check_raster_output(layout, compress=compress)
+    options = raster_creation_options(
+        layout, compress=compress, dtype=profile['dtype'],
+        sparse=sparse, blocksize=blocksize)
+    profile = dict(profile)
+    profile.update(driver='GTiff', **options)
+
+    if layout == 'cog':
+        tempdir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(path)))
+        target = os.path.join(tempdir, 'cog-source.tif')
+    else:
+        tempdir = None
+        target = path
+
+    try:
+        with rasterio.open(target, 'w', **profile) as dst:
+            yield dst
+
+        if overviews or layout == 'cog':
+            with rasterio.open(target, 'r+') as dst:
+                factors = overview_factors(dst.width, dst.height, blocksize)
+                if factors:
+                    dst.build_overviews(factors, Resampling.average)
+
+        if layout == 'cog':
+            _copy_with_overviews(target, path, options)
+    finally:
+        if tempdir is not None:
+            shutil.rmtree(tempdir)
+
+
+def write_raster(path, array, transform, crs, output=None):
+    """Write a GeoTIFF
+
+    Args:
+        path: File path to save.
+        array: Numpy array or MaskedArray, either 2D (rows, cols) for
+            a 1-band raster or 3D (bands, rows, cols).
         transform: The rasterio Affine transform
             from (col, row) coords to map coords.
         crs: A rasterio crs or EPSG string, e.g. 'EPSG:3035'.
+        output: Optional dict of keyword arguments to open_raster_output()
+            to choose the layout, compression, etc.
 
     Example:
         >>> import numpy
@@ -156,26 +829,215 @@ def write_raster(path, array, transform, crs):
         >>> write_raster('/tmp/file.tif', array, T, crs)
     """
 
+    if array.ndim == 2:
+        array = array[np.newaxis]
+
+    if isinstance(crs, str):
+        crs = rasterio.crs.CRS.from_string(crs)
+
     settings = dict(
         crs=crs,
-        affine=transform,
-        width=array.shape[1],
-        height=array.shape[0],
+        transform=transform,
+        width=array.shape[2],
+        height=array.shape[1],
         driver='GTiff',
-        count=1,
+        count=array.shape[0],
         dtype=array.dtype.name
     )
 
-    if isinstance(crs, str):
-        crs = rasterio.crs.CRS.from_string(crs)
-
     if isinstance(array, np.ma.MaskedArray):
         assert 'nodata' not in settings
         settings['nodata'] = array.fill_value
         array = array.filled()
 
-    with rasterio.open(path, 'w', **settings) as dst:
-        dst.write(array, indexes=1)
+    with open_raster_output(path, settings, **(output or {})) as dst:
+        dst.write(array)
+
+
+def iter_windows(height, width, size):
+    """Generate windows covering a raster in square-ish blocks.
+
+    Args:
+        height, width: The raster shape.
+        size: The maximal window height and width in pixels.
+
+    Yields:
+        Windows ((row_start, row_stop), (col_start, col_stop)).
+    """
+    for row in range(0, height, size):
+        for col in range(0, width, size):
+            yield (
+                (row, min(row + size, height)),
+                (col, min(col + size, width)))
+
+
+def window_count(height, width, size):
+    """The number of windows generated by iter_windows()."""
+    return -(-height // size) * -(-width // size)
+
+
+def iter_row_bands(height, width, rows):
+    """Generate full-width windows of a number of rows.
+
+    Yields:
+        Windows ((row_start, row_stop), (0, width)).
+    """
+    for row in range(0, height, rows):
+        yield ((row, min(row + rows, height)), (0, width))
+
+
+def window_size_for_budget(memory_budget=None,
+                           bytes_per_pixel=WINDOW_BYTES_PER_PIXEL):
+    """The height and width of square windows fitting a memory budget.
+
+    Args:
+        memory_budget: MB. Default DEFAULT_MEMORY_BUDGET.
+        bytes_per_pixel: Bytes used per pixel while processing a window.
+
+    Returns:
+        The window size in pixels, a multiple of 256 if at least 256.
+    """
+    if memory_budget is None:
+        memory_budget = DEFAULT_MEMORY_BUDGET
+    if memory_budget <= 0:
+        raise ValueError('the memory budget must be positive')
+    size = int(np.sqrt(memory_budget * 2**20 / bytes_per_pixel))
+    if size >= 256:
+        size -= size % 256
+    return max(size, 16)
+
+
+def band_height_for_budget(memory_budget, width,
+                           bytes_per_pixel=WINDOW_BYTES_PER_PIXEL,
+                           multiple=1):
+    """The number of rows of full-width windows fitting a memory budget.
+
+    Args:
+        memory_budget: MB. None for DEFAULT_MEMORY_BUDGET.
+        width: The raster width.
+        bytes_per_pixel: Bytes used per pixel while processing a window.
+        multiple: Round down to a multiple of this (e.g., the block height
+            of the raster), if possible.
+
+    Returns:
+        The number of rows, at least 1.
+    """
+    if memory_budget is None:
+        memory_budget = DEFAULT_MEMORY_BUDGET
+    if memory_budget <= 0:
+        raise ValueError('the memory budget must be positive')
+    rows = int(memory_budget * 2**20 / (bytes_per_pixel * width))
+    if rows >= multiple:
+        rows -= rows % multiple
+    return max(rows, 1)
+
+
+def read_regions(path, key_property):
+    """Read region geometries from a vector file.
+
+    Returns:
+        A list of keys and a list of shapely geometries in the same order.
+    """
+    keys, geometries = [], []
+    with fiona.open(path) as src:
+        for feature in src:
+            keys.append(feature['properties'][key_property])
+            geometries.append(shapely.geometry.shape(feature['geometry']))
+    return keys, geometries
+
+
+def label_window(geometries, transform, shape, bounds=None):
+    """Rasterize geometries to an array of geometry indices.
+
+    Pixels are assigned to a geometry if their centers are inside it,
+    like in rasterio.features.rasterize() and rasterstats.
+
+    Args:
+        geometries: A list of shapely geometries.
+        transform: The Affine transform of the window.
+        shape: The (rows, cols) shape of the window.
+        bounds: Optional precomputed list of geometry bounds, to avoid
+            recomputing them for every window.
+
+    Returns:
+        An int32 array where each pixel holds the index of the geometry
+        it belongs to, or -1 if none.
+    """
+    if bounds is None:
+        bounds = [g.bounds for g in geometries]
+
+    rows, cols = shape
+    xs = (transform * (0, 0))[0], (transform * (cols, 0))[0]
+    ys = (transform * (0, 0))[1], (transform * (0, rows))[1]
+    xmin, xmax = min(xs), max(xs)
+    ymin, ymax = min(ys), max(ys)
+
+    shapes = [
+        (geometry, i)
+        for i, (geometry, (gxmin, gymin, gxmax, gymax))
+        in enumerate(zip(geometries, bounds))
+        if gxmin < xmax and gxmax > xmin and gymin < ymax and gymax > ymin]
+
+    if not shapes:
+        return np.full(shape, -1, dtype='int32')
+
+    return rasterio.features.rasterize(
+        shapes, out_shape=shape, transform=transform,
+        fill=-1, dtype='int32')
+
+
+def rasterize_labels(regions_path, key_property, template_path, dst_path,
+                     window_size=1024):
+    """Make a raster of region indices on the grid of a template raster.
+
+    Pixels are assigned to the region containing their centers. The
+    regions are numbered in the order they appear in the regions file,
+    and the keys are stored in the raster tags, so that
+    read_label_keys() can map indices back to keys.
+
+    Args:
+        regions_path: Vector file with the regions.
+        key_property: The property identifying the regions.
+        template_path: Raster to take the grid from.
+        dst_path: Where to write the label raster.
+        window_size: The height and width in pixels of the windows
+            processed at a time.
+    """
+    keys, geometries = read_regions(regions_path, key_property)
+    bounds = [g.bounds for g in geometries]
+    dtype = 'int16' if len(keys) < 2**15 else 'int32'
+
+    with rasterio.open(template_path) as template:
+        profile = dict(
+            driver='GTiff',
+            crs=template.crs,
+            transform=template.window_transform(
+                ((0, template.height), (0, template.width))),
+            width=template.width,
+            height=template.height,
+            count=1,
+            dtype=dtype,
+            nodata=-1)
+
+        with open_raster_output(
+                dst_path, profile, layout='tiled', compress='deflate',
+                sparse=True) as dst:
+            dst.update_tags(keys=json.dumps(keys))
+            windows = iter_windows(
+                template.height, template.width, window_size)
+            total = window_count(template.height, template.width, window_size)
+            for window in instrument.progress(windows, 'label blocks', total):
+                transform = template.window_transform(window)
+                shape = tuple(stop - start for start, stop in window)
+                labels = label_window(geometries, transform, shape, bounds)
+                if (labels < 0).all():
+                    continue
+                dst.write(labels.astype(dtype), indexes=1, window=window)
+
+
+def read_label_keys(dataset):
+    """The region keys of a label raster made by rasterize_labels()."""
+    return json.loads(dataset.tags()['keys'])
 
 
 def write_data_to_regions(src_path, dst_path, key_property, data):
@@ -0,0 +1,551 @@
+# -*- coding: utf-8 -*-
+"""
+An HDF5 datastore for the tables of the pipeline.
+
+The tables made by the pipeline are pickles and JSON files, which are
+read in full by every consumer and tie the outputs to the pandas version
+that wrote them. `biogasrm-store migrate` copies them into one directory
+of HDF5 files (outdata/store/ by default), written by pandas in its
+"table" format, which later pandas versions read as well:
+
+    tables/<name>.h5
+        Region tables, e.g. animal_pop, manure_mgmt and the Eurostat
+        tables (named eurostat/<table>), and regional_sums and coverage
+        with one column per density raster.
+    sampling/<sampling>/<name>/samples.h5
+        Sample tables indexed (x, y, r, NUTS_ID), i.e. fracs (one column
+        per density, like results.get_sample_fracs()) and sums, with one
+        node per country, sorted by x and y. index.json has the bounding
+        box of the sample centers of each country.
+
+The index levels are queryable columns of the HDF5 tables, so tables can
+be read partially by region prefix (only the nodes of the matching
+countries are opened, and only the rows of the matching regions read) and
+by bounding box (only the rows with centers in it are read). The rasters
+and vector files stay as they are, since they are read through GDAL.
+
+PyTables is needed to use the store (the pytables package in
+conda-requirements.txt, or pip install biogasrm[store]). Without it, or
+for tables not in the store, the consumers in results read the original
+files.
+"""
+
+import glob
+import json
+import logging
+import os
+import pickle
+import re
+
+import click
+import pandas as pd
+
+import biogasrm.instrument as instrument
+
+log = logging.getLogger(__name__)
+
+STORE_PATH = 'outdata/store'
+OUTDATA_PATH = 'outdata'
+
+# Rows per chunk when iterating over a sample table
+CHUNK_SIZE = 16384
+
+# Compression of the HDF5 files (see pandas.HDFStore)
+COMPLIB = 'blosc'
+COMPLEVEL = 5
+
+# The node of a region table in its file
+TABLE_KEY = 'table'
+
+SAMPLE_INDEX = ['x', 'y', 'r', 'NUTS_ID']
+
+# Index levels holding region codes, for reading region tables by prefix.
+# Tables without either are filtered on their first index level.
+REGION_LEVELS = ('NUTS_ID', 'geo')
+
+# Node attribute for what pandas cannot restore by itself
+METADATA_ATTR = 'biogasrm'
+
+
+# Oldest versions the store works with, as (module, version). pandas
+# 0.20 needs PyTables >= 3.2 for HDFStore.
+REQUIRED_VERSIONS = (('tables', '3.2'),)
+
+
+def _version_tuple(version):
+    parts = []
+    for part in version.split('.'):
+        digits = re.match(r'\d+', part)
+        if digits is None:
+            break
+        parts.append(int(digits.group()))
+        if digits.group() != part: # e.g. 0rc1
+            break
+    return tuple(parts)
+
+
+def _missing_requirements():
+    """The requirements of the store which are not installed."""
+    missing = []
+    for name, required in REQUIRED_VERSIONS:
+        try:
+            module = __import__(name)
+        except ImportError:
+            missing.append('{} >= {}'.format(name, required))
+            continue
+        if _version_tuple(module.__version__) < _version_tuple(required):
+            missing.append('{} >= {} (found {})'.format(
+                name, required, module.__version__))
+    return missing
+
+
+def available():
+    """Whether the store can be used, i.e. PyTables is installed."""
+    return not _missing_requirements()
+
+
+def _hdf(path, mode='r'):
+    """Open an HDFStore, or raise ImportError without PyTables."""
+    missing = _missing_requirements()
+    if missing:
+        raise ImportError(
+            'the datastore needs {}; install pytables'.format(
+                ', '.join(missing)))
+    if mode == 'r':
+        return pd.HDFStore(path, mode=mode)
+    return pd.HDFStore(path, mode=mode, complib=COMPLIB, complevel=COMPLEVEL)
+
+
+class Store(object):
+    """
+    An HDF5 datastore directory.
+
+    Args:
+        path: The store directory. Default STORE_PATH.
+    """
+    def __init__(self, path=STORE_PATH):
+        super(Store, self).__init__()
+        self.path = path
+
+    def table_path(self, name):
+        return os.path.join(self.path, 'tables', name + '.h5')
+
+    def samples_path(self, sampling, name):
+        return os.path.join(self.path, 'sampling', sampling, name)
+
+    def has_table(self, name):
+        return os.path.exists(self.table_path(name))
+
+    def has_samples(self, sampling, name):
+        return os.path.exists(
+            os.path.join(self.samples_path(sampling, name), 'index.json'))
+
+    def write_table(self, name, data):
+        """
+        Write a region table.
+
+        Args:
+            name: The table name, e.g. 'animal_pop' or 'eurostat/agr_r_crops'.
+            data: A DataFrame or Series.
+        """
+        path = self.table_path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with _replacing(path) as tmp_path:
+            with _hdf(tmp_path, mode='w') as hdf:
+                _put(hdf, TABLE_KEY, data)
+
+    def read_table(self, name, regions=None):
+        """
+        Read a region table.
+
+        Args:
+            name: The table name.
+            regions: Optional region code prefix (e.g. 'SE' or 'SE12') to
+                read only those rows. See REGION_LEVELS.
+
+        Returns: The DataFrame or Series as written.
+        """
+        with _hdf(self.table_path(name)) as hdf:
+            if regions is None:
+                return _select(hdf, TABLE_KEY)
+            names = _metadata(hdf, TABLE_KEY)['index']
+            level = next((l for l in REGION_LEVELS if l in names), None)
+            if level is not None:
+                # A single index is queried as 'index' whatever its name
+                column = level if len(names) > 1 else 'index'
+                return _select(
+                    hdf, TABLE_KEY, where=_prefix_where(column, regions))
+            data = _select(hdf, TABLE_KEY)
+        codes = pd.Series(data.index.get_level_values(0)).astype(str)
+        return data[codes.str.startswith(regions).values]
+
+    def write_samples(self, sampling, name, data):
+        """
+        Write a sample table.
+
+        Args:
+            sampling: The name of the sampling settings.
+            name: The table name, e.g. 'fracs' or 'sums'.
+            data: A DataFrame indexed (x, y, r, NUTS_ID), or a Series
+                which is written as a one-column table.
+        """
+        if isinstance(data, pd.Series):
+            data = data.to_frame()
+        if list(data.index.names) != SAMPLE_INDEX:
+            raise ValueError('sample tables must be indexed {}'.format(
+                SAMPLE_INDEX))
+
+        directory = self.samples_path(sampling, name)
+        os.makedirs(directory, exist_ok=True)
+        index_path = os.path.join(directory, 'index.json')
+        if os.path.exists(index_path):
+            os.remove(index_path)
+
+        countries = pd.Series(
+            data.index.get_level_values('NUTS_ID')).astype(str).str[:2]
+        partitions = {}
+        path = os.path.join(directory, 'samples.h5')
+        with _replacing(path) as tmp_path:
+            with _hdf(tmp_path, mode='w') as hdf:
+                for country, rows in data.groupby(countries.values):
+                    rows = rows.sort_index()
+                    _put(hdf, country, rows)
+                    x = rows.index.get_level_values('x')
+                    y = rows.index.get_level_values('y')
+                    partitions[country] = {
+                        'bbox': [float(x.min()), float(y.min()),
+                                 float(x.max()), float(y.max())],
+                        'rows': len(rows),
+                    }
+
+        # Written last: the table is complete once this exists
+        index = {'columns': [str(c) for c in data.columns],
+                 'partitions': partitions}
+        with open(index_path, 'w') as f:
+            json.dump(index, f, indent=2)
+
+    def read_samples(self, sampling, name, regions=None, bbox=None,
+                     columns=None):
+        """
+        Read a sample table, or part of it.
+
+        Args:
+            sampling: The name of the sampling settings.
+            name: The table name.
+            regions: Optional NUTS_ID prefix. Only the countries matching
+                it are read.
+            bbox: Optional (xmin, ymin, xmax, ymax) of the sample centers
+                to read (map units, inclusive).
+            columns: Optional list of columns to read. Default all.
+
+        Returns:
+            A DataFrame indexed (x, y, r, NUTS_ID), sorted by the index.
+        """
+        directory = self.samples_path(sampling, name)
+        with open(os.path.join(directory, 'index.json'), 'r') as f:
+            index = json.load(f)
+
+        where = []
+        if regions is not None and len(regions) > 2:
+            where.append(_prefix_where('NUTS_ID', regions))
+        if bbox is not None:
+            xmin, ymin, xmax, ymax = (float(v) for v in bbox)
+            where.append(
+                'x >= {!r} & x <= {!r} & y >= {!r} & y <= {!r}'.format(
+                    xmin, xmax, ymin, ymax))
+
+        frames = []
+        with _hdf(os.path.join(directory, 'samples.h5')) as hdf:
+            for country, partition in sorted(index['partitions'].items()):
+                if regions is not None and not (
+                        country.startswith(regions) or
+                        regions.startswith(country)):
+                    continue
+                if bbox is not None and not _overlaps(
+                        partition['bbox'], bbox):
+                    continue
+                frames.append(_select(
+                    hdf, country, where=where or None, columns=columns))
+
+        if frames:
+            return pd.concat(frames).sort_index()
+        return pd.DataFrame(
+            columns=columns or index['columns'],
+            index=pd.MultiIndex.from_arrays([[]] * 4, names=SAMPLE_INDEX))
+
+    def iter_samples(self, sampling, name, columns=None):
+        """
+        Read a sample table in chunks of at most CHUNK_SIZE rows.
+
+        Args:
+            columns: Optional list of columns to read. Default all.
+
+        Yields:
+            DataFrames indexed (x, y, r, NUTS_ID).
+        """
+        directory = self.samples_path(sampling, name)
+        with open(os.path.join(directory, 'index.json'), 'r') as f:
+            index = json.load(f)
+        with _hdf(os.path.join(directory, 'samples.h5')) as hdf:
+            for country in sorted(index['partitions']):
+                for chunk in hdf.select(
+                        country, columns=columns, chunksize=CHUNK_SIZE):
+                    yield chunk
+
+
+def _overlaps(a, b):
+    return not (a[0] > b[2] or a[2] < b[0] or a[1] > b[3] or a[3] < b[1])
+
+
+def _prefix_where(column, prefix):
+    """A where condition for the string column starting with prefix."""
+    upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    return '{0} >= {1!r} & {0} < {2!r}'.format(column, prefix, upper)
+
+
+class _replacing(object):
+    """
+    Context manager giving a temporary path which replaces path on success,
+    so that an interrupted write leaves no partial file behind.
+    """
+    def __init__(self, path):
+        super(_replacing, self).__init__()
+        self.path = path
+        self.tmp_path = path + '.tmp'
+
+    def __enter__(self):
+        return self.tmp_path
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            os.replace(self.tmp_path, self.path)
+        elif os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+def _put(hdf, key, data):
+    """
+    Write a DataFrame or Series as a node in table format.
+
+    Column names which are not strings (e.g. the MultiIndex of years of the
+    Eurostat tables) are written as positional names, and restored from the
+    node's attributes on reading, as are the index names.
+    """
+    extra = {'index': list(data.index.names)}
+    if isinstance(data, pd.Series):
+        extra['series'] = data.name
+        data = data.to_frame(name='value')
+    if isinstance(data.columns, pd.MultiIndex) or not all(
+            isinstance(c, str) for c in data.columns):
+        columns = data.columns
+        extra['columns'] = {
+            'names': list(columns.names),
+            'values': [list(c) if isinstance(c, tuple) else c
+                       for c in columns],
+            'multiindex': isinstance(columns, pd.MultiIndex),
+        }
+        data = data.copy()
+        data.columns = ['c{}'.format(i) for i in range(len(columns))]
+
+    hdf.put(key, data, format='table', dropna=False)
+    setattr(hdf.get_storer(key).attrs, METADATA_ATTR, json.dumps(extra))
+
+
+def _metadata(hdf, key):
+    return json.loads(getattr(hdf.get_storer(key).attrs, METADATA_ATTR))
+
+
+def _select(hdf, key, where=None, columns=None):
+    """
+    Read a node written by _put().
+
+    Args:
+        where: Optional condition (or list of conditions, all of which must
+            hold) on the index levels, in the syntax of HDFStore.select().
+        columns: Only read these columns (and the index).
+    """
+    data = hdf.select(key, where=where, columns=columns)
+
+    extra = _metadata(hdf, key)
+    data.index.names = extra['index']
+    if 'columns' in extra:
+        meta = extra['columns']
+        values = meta['values']
+        positions = [int(c[1:]) for c in data.columns]
+        if meta['multiindex']:
+            data.columns = pd.MultiIndex.from_tuples(
+                [tuple(values[i]) for i in positions], names=meta['names'])
+        else:
+            data.columns = pd.Index(
+                [values[i] for i in positions], name=meta['names'][0])
+    if 'series' in extra:
+        data = data['value'].rename(extra['series'])
+    return data
+
+
+def read_table(name, path, column=None, store=None):
+    """
+    Read a table from the store, or from its original file.
+
+    The store is used if PyTables is available and the table is in the
+    store and not older than the original file (which the Makefile may
+    have remade since the migration).
+
+    Args:
+        name: The table name in the store.
+        path: The original pickle or JSON file ({key: value}).
+        column: The column of the store table which the original file
+            holds, e.g. a density of regional_sums.
+        store: A Store. Default Store().
+    """
+    if store is None:
+        store = Store()
+    if available() and store.has_table(name) and not _newer(
+            path, store.table_path(name)):
+        data = store.read_table(name)
+        if column is not None:
+            data = data[column].dropna()
+        return data
+    if path.endswith('.json'):
+        with open(path, 'r') as f:
+            return pd.Series(json.loads(f.read()))
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def use_samples(sampling, name, paths, store=None):
+    """
+    Whether to read a sample table from the store.
+
+    Args:
+        paths: The original files of the table, to check that the store
+            is not older than them.
+    """
+    if store is None:
+        store = Store()
+    if not (available() and store.has_samples(sampling, name)):
+        return False
+    index = os.path.join(store.samples_path(sampling, name), 'index.json')
+    return not any(_newer(path, index) for path in paths)
+
+
+def _newer(path, than):
+    return (os.path.exists(path) and
+            os.path.getmtime(path) > os.path.getmtime(than))
+
+
+def _json_table(paths):
+    """A DataFrame of {key: value} JSON files, one column per file name."""
+    columns = {}
+    for path in paths:
+        with open(path, 'r') as f:
+            columns[os.path.splitext(os.path.basename(path))[0]] = pd.Series(
+                json.loads(f.read()), dtype=float)
+    data = pd.DataFrame(columns)
+    data.index.name = 'NUTS_ID'
+    return data
+
+
+def migrate(outdata=OUTDATA_PATH, store=None):
+    """
+    Copy the tables in an outdata directory to a store.
+
+    Migrates outdata/*.pkl and outdata/eurostat/*.pkl (DataFrames and
+    Series; other pickles are skipped), outdata/regional_sums/*.json and
+    outdata/coverage/*.json, and for each sampling outdata/sampling/*/
+    *_fracs.pkl (as fracs) and sums.pkl (as sums).
+
+    Returns:
+        A list of the names of the migrated tables.
+    """
+    if store is None:
+        store = Store()
+    migrated = []
+
+    pickles = sorted(
+        glob.glob(os.path.join(outdata, '*.pkl')) +
+        glob.glob(os.path.join(outdata, 'eurostat', '*.pkl')))
+    for path in instrument.progress(pickles, 'tables'):
+        name = os.path.relpath(os.path.splitext(path)[0], outdata)
+        name = name.replace(os.sep, '/')
+        with open(path, 'rb') as f:
+            data = pickle.load(f)
+        if not isinstance(data, (pd.DataFrame, pd.Series)):
+            log.info('Skipping {}, which is not a table'.format(path))
+            continue
+        store.write_table(name, data)
+        migrated.append(name)
+
+    for name in ('regional_sums', 'coverage'):
+        paths = sorted(glob.glob(os.path.join(outdata, name, '*.json')))
+        if paths:
+            store.write_table(name, _json_table(paths))
+            migrated.append(name)
+
+    for directory in sorted(glob.glob(os.path.join(outdata, 'sampling', '*'))):
+        sampling = os.path.basename(directory)
+        paths = sorted(glob.glob(os.path.join(directory, '*_fracs.pkl')))
+        if paths:
+            fracs = {}
+            for path in paths:
+                density = os.path.basename(path)[:-len('_fracs.pkl')]
+                with open(path, 'rb') as f:
+                    fracs[density] = pickle.load(f)
+            store.write_samples(sampling, 'fracs', pd.DataFrame(fracs))
+            migrated.append('{}/fracs'.format(sampling))
+        sums_path = os.path.join(directory, 'sums.pkl')
+        if os.path.exists(sums_path):
+            with open(sums_path, 'rb') as f:
+                store.write_samples(sampling, 'sums', pickle.load(f))
+            migrated.append('{}/sums'.format(sampling))
+
+    return migrated
+
+
+@click.group()
+@instrument.profile_options
+def cli():
+    pass
+
+
+@cli.command(name='migrate')
+@click.option('--outdata', type=click.Path(exists=True, file_okay=False),
+              default=OUTDATA_PATH,
+              help='The directory with the tables. Default outdata.')
+@click.option('--store', 'store_path', type=click.Path(file_okay=False),
+              default=STORE_PATH,
+              help='The store directory. Default outdata/store.')
+def migrate_command(outdata, store_path):
+    """
+    Copy the pickled and JSON tables into the HDF5 datastore.
+
+    Run again after remaking tables; until then the consumers read the
+    newer original files.
+    """
+    migrated = migrate(outdata, Store(store_path))
+    log.info('Migrated {} tables to {}'.format(len(migrated), store_path))
+
+
+@cli.command()
+@click.argument('name')
+@click.option('--sampling', '-s', type=str, default=None,
+              help='Read the sample table NAME of this sampling.')
+@click.option('--regions', type=str, default=None,
+              help='Only regions with this NUTS_ID prefix.')
+@click.option('--bbox', type=(float, float, float, float), default=None,
+              help='Only samples centered in xmin ymin xmax ymax.')
+@click.option('--store', 'store_path', type=click.Path(file_okay=False),
+              default=STORE_PATH,
+              help='The store directory. Default outdata/store.')
+@click.option('--output', '-o', type=click.File('w'), default='-',
+              help='Where to write the table (CSV). Default stdout.')
+def show(name, sampling, regions, bbox, store_path, output):
+    """Write a table, or part of it, from the datastore as CSV."""
+    store = Store(store_path)
+    if sampling is None:
+        if bbox is not None:
+            raise click.UsageError('--bbox is only for sample tables')
+        data = store.read_table(name, regions=regions)
+    else:
+        data = store.read_samples(sampling, name, regions=regions, bbox=bbox)
+    data.to_csv(output)
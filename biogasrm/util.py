@@ -3,18 +3,51 @@
 import os
 import os.path
 import logging
+import gzip
+import io
+import zipfile
 import itertools
 import collections
 import time
 
-from osgeo import gdal, ogr, osr, gdalconst, gdal_array
 import numpy as np
 import pandas
-import rasterio
-import rasterio.crs
 
 logger = logging.getLogger(__name__)
 
+def open_input(path):
+    """Open a text file for reading, possibly compressed.
+
+    Besides plain paths, this accepts gzipped files (*.gz) and the GDAL
+    virtual file system paths /vsigzip/file.gz and
+    /vsizip/archive.zip/member, so that inputs can be read in place.
+
+    Args:
+        path (str): The file path.
+
+    Returns:
+        A text file object.
+    """
+    if path.startswith('/vsigzip/'):
+        return gzip.open(path[len('/vsigzip/'):], 'rt')
+    if path.startswith('/vsizip/'):
+        archive, member = _split_zip_path(path[len('/vsizip/'):])
+        with zipfile.ZipFile(archive) as zf:
+            data = zf.read(member)
+        return io.StringIO(data.decode('utf-8'))
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt')
+    return open(path, 'r')
+
+def _split_zip_path(path):
+    # The archive is the first path component ending with .zip
+    parts = path.split('/')
+    for i, part in enumerate(parts):
+        if part.lower().endswith('.zip'):
+            return '/'.join(parts[:i+1]), '/'.join(parts[i+1:])
+    raise ValueError('no zip archive in path {}'.format(path))
+
+
 def aggregate(data, coldict, allow_missing=False):
     """Aggregate columns of a pandas DataFrame or Series
 
@@ -1,16 +1,26 @@
+import os
+
 import shapely.geometry
-import shapely.ops
 import fiona
 
-path = 'outdata/included_NUTS.geojson'
-region_criterion = lambda r: r['properties']['NUTS_ID'].startswith('SE')
+import biogasrm.sampling_regions as sampling_regions
 
-with fiona.open(path) as ds:
-    regions = tuple(
-        shapely.geometry.shape(r['geometry']) for r in ds
-        if region_criterion(r))
+path = 'outdata/included_NUTS.geojson'
+prepared_path = 'outdata/prepared_regions.pkl'
+region_criterion = lambda key: key.startswith('SE')
 
-big_region = shapely.ops.cascaded_union(regions)
+# The bounds of a union are those of its parts together, so the regions
+# need not be dissolved. Use the prepared regions if they are made.
+if os.path.exists(prepared_path):
+    bounds = sampling_regions.load(prepared_path, path).bounds
+else:
+    with fiona.open(path) as ds:
+        bounds = {
+            r['properties']['NUTS_ID']:
+                shapely.geometry.shape(r['geometry']).bounds
+            for r in ds}
 
-print(*map(str, big_region.bounds))
+bounds = [b for key, b in bounds.items() if region_criterion(key)]
+xmin, ymin, xmax, ymax = zip(*bounds)
 
+print(min(xmin), min(ymin), max(xmax), max(ymax))
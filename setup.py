@@ -30,8 +30,12 @@ setup(
         biogasrm-prep=biogasrm.prep_data:cli
         biogasrm-sample=biogasrm.sample:cli
         biogasrm-results=biogasrm.results:cli
+        biogasrm-serve=biogasrm.serve:cli
+        biogasrm-store=biogasrm.store:cli
     ''',
     extras_require = {
+        'store': ['tables>=3.2'],
+        'yaml': ['PyYAML'],
         },
     # See https://pypi.python.org/pypi?%3Aaction=list_classifiers
     classifiers=[